@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def file_signature(path):
+    """Inode, время изменения и размер файла или None, если файла нет"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+class AssetCache:
+    """
+    Кэш статических фрагментов запроса к модели (add_info.txt, память бота).
+
+    Файл читается один раз; изменение проверяется по inode, времени изменения
+    и размеру не чаще раза в check_interval секунд. Сохранение файла из GUI или
+    самим ботом сразу сбрасывает запись через invalidate. Кроме текста
+    кэшируются производные значения (разобранный JSON, количество токенов),
+    которые пересчитываются только для новой версии файла.
+    """
+    def __init__(self, check_interval=2.0):
+        """
+        Параметры:
+            check_interval (float): Минимальный интервал между проверками файла в секундах
+        """
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def _entry(self, path):
+        """Актуальная запись для path (перечитывается, если файл изменился)"""
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry and now - entry['checked'] < self.check_interval:
+            return entry
+        signature = file_signature(path)
+        if entry and entry['signature'] == signature:
+            entry['checked'] = now
+            return entry
+
+        text = None
+        if signature is not None:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                logger.debug(f"Файл {path} загружен в кэш")
+            except (OSError, UnicodeDecodeError) as e:
+                logger.error(f"Ошибка при чтении {path}: {e}")
+                # Повторная попытка при следующем обращении
+                signature = None
+        entry = {'signature': signature, 'text': text, 'checked': now, 'derived': {}}
+        self.entries[path] = entry
+        return entry
+
+    def get(self, path):
+        """
+        Содержимое файла.
+
+        Возвращает:
+            str: Текст файла или None, если файл отсутствует или не читается
+        """
+        with self.lock:
+            return self._entry(path)['text']
+
+    def version(self, path):
+        """Версия файла (inode, время изменения, размер) для ключей внешних кэшей"""
+        with self.lock:
+            return self._entry(path)['signature']
+
+    def derived(self, path, name, compute):
+        """
+        Значение compute(текст файла), вычисленное один раз для текущей версии файла.
+
+        Параметры:
+            path (str): Файл
+            name (str): Имя производного значения (например, 'json' или 'tokens:<модель>')
+            compute (callable): Вычисление значения по тексту
+
+        Возвращает:
+            Значение compute или None, если файла нет. Результат общий для
+            всех вызывающих и не должен изменяться.
+        """
+        with self.lock:
+            entry = self._entry(path)
+            if entry['text'] is None:
+                return None
+            if name in entry['derived']:
+                return entry['derived'][name]
+        # Вычисление (например, запрос count_tokens) выполняется без блокировки кэша
+        value = compute(entry['text'])
+        with self.lock:
+            return entry['derived'].setdefault(name, value)
+
+    def invalidate(self, path=None):
+        """Сброс кэша файла path (или всех файлов), следующее обращение перечитает файл"""
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
@@ -0,0 +1,310 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+from bot import (
+    session as forum_session, HEADERS, AUDIO_HEADERS, IMAGE_HEADERS, page_fetcher, downloader, media_cache, stream_cache,
+    parse_thread_list, parse_thread_page, thread_walk, classify_thread_data, extract_thread_id, known_page_count,
+    audio_stream_url, record_audio_download, record_image_download, download_smule_audio, media_host
+)
+from downloader import DownloadResult, AUDIO_CONTENT_TYPES, IMAGE_CONTENT_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный режим доступен только при установленном aiohttp
+ASYNC_AVAILABLE = aiohttp is not None
+
+RETRY_STATUSES = (502, 503, 504)
+
+class AsyncHttpEngine:
+    """
+    Асинхронные HTTP-запросы на aiohttp.
+
+    Одна сессия с пулом соединений на всё время работы (open/close или
+    async with), общее ограничение соединений и ограничение на хост, таймауты
+    соединения и чтения, повторные попытки при 502/503/504 и сетевых ошибках.
+    Страницы форума запрашиваются через page_fetcher (условные запросы и кэш
+    разбора), разбор HTML выполняется в пуле потоков, чтобы не блокировать
+    цикл событий.
+    """
+    def __init__(self, limit=100, per_host_limit=8, media_per_host_limit=2, timeout=15, max_retries=3):
+        """
+        Параметры:
+            limit (int): Максимальное количество одновременных соединений
+            per_host_limit (int): Максимальное количество соединений с одним хостом
+            media_per_host_limit (int): Одновременные скачивания медиафайлов с одного хоста
+            timeout (int): Таймаут соединения и чтения в секундах
+            max_retries (int): Количество попыток запроса
+        """
+        self.limit = limit
+        self.per_host_limit = per_host_limit
+        self.media_per_host_limit = media_per_host_limit
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = None
+        self.media_semaphores = {}
+
+    async def open(self):
+        if aiohttp is None:
+            raise RuntimeError("Для асинхронной загрузки требуется пакет aiohttp")
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.per_host_limit),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout, sock_read=self.timeout)
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def sync_cookies(self):
+        """
+        Копирование cookie сессии bot.session (авторизация на форуме, если она
+        включена, см. bot.get_forum_poster), чтобы страницы тредов загружались
+        так же, как синхронным путём
+        """
+        for cookie in forum_session.cookies:
+            if cookie.domain:
+                self.session.cookie_jar.update_cookies({cookie.name: cookie.value}, URL(f"https://{cookie.domain.lstrip('.')}/"))
+
+    async def get(self, url, headers=None):
+        """
+        GET-запрос с повторными попытками.
+
+        Возвращает:
+            tuple: (код ответа, заголовки, тело ответа)
+        """
+        for attempt in range(self.max_retries):
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    body = await response.read()
+                    if response.status not in RETRY_STATUSES or attempt == self.max_retries - 1:
+                        return response.status, response.headers, body
+                    logger.warning(f"HTTP {response.status} при запросе {url} (попытка {attempt + 1}/{self.max_retries})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                logger.warning(f"Ошибка при запросе {url} (попытка {attempt + 1}/{self.max_retries}): {e!r}")
+            await asyncio.sleep(2 ** attempt)
+
+    async def fetch_page(self, url, parse):
+        """
+        Загрузка и разбор страницы форума (см. ConditionalFetcher.fetch).
+
+        Возвращает:
+            tuple: (результат разбора, True если взят из кэша) или (None, False) при ошибке
+        """
+        entry, request_headers = page_fetcher.prepare(url, HEADERS)
+        try:
+            status, response_headers, body = await self.get(url, request_headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при запросе к странице {url}: {e!r}")
+            return None, False
+        hit, result = page_fetcher.cached_result(url, entry, status, response_headers)
+        if hit:
+            return result, True
+        if status >= 400:
+            logger.error(f"Ошибка при запросе к странице {url}: HTTP {status}")
+            return None, False
+        result = await asyncio.get_running_loop().run_in_executor(None, parse, body)
+        page_fetcher.store(url, response_headers, result)
+        return result, False
+
+    async def download(self, url, filename, headers=None, allowed_types=None):
+        """
+        Потоковое скачивание url в filename с ограничением downloader.max_bytes
+        и не более media_per_host_limit одновременных скачиваний с хоста.
+
+        Возвращает:
+            DownloadResult
+        """
+        semaphore = self.media_semaphores.setdefault(media_host(url), asyncio.Semaphore(self.media_per_host_limit))
+        part_path = f"{filename}.part"
+        started = time.monotonic()
+        downloaded = 0
+        async with semaphore:
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status >= 400:
+                        logger.error(f"Ошибка при скачивании {url}: HTTP {response.status}")
+                        return DownloadResult(False, response.status)
+                    content_type = response.headers.get('Content-Type', '').lower()
+                    if allowed_types and content_type and not content_type.startswith(allowed_types):
+                        logger.error(f"Недопустимый тип содержимого {content_type} для {url}")
+                        return DownloadResult(False, response.status)
+                    if response.content_length and response.content_length > downloader.max_bytes:
+                        logger.error(f"Файл {url} слишком большой: {response.content_length} байт (максимум {downloader.max_bytes})")
+                        return DownloadResult(False, response.status)
+
+                    with open(part_path, 'wb') as file:
+                        async for chunk in response.content.iter_chunked(downloader.chunk_size):
+                            downloaded += len(chunk)
+                            if downloaded > downloader.max_bytes:
+                                logger.error(f"Файл {url} превысил максимальный размер {downloader.max_bytes} байт")
+                                break
+                            file.write(chunk)
+                    if downloaded > downloader.max_bytes:
+                        os.remove(part_path)
+                        return DownloadResult(False, response.status)
+                    os.replace(part_path, filename)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                logger.error(f"Ошибка при скачивании {url}: {e!r}")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return DownloadResult(False)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Скачано {downloaded} байт за {elapsed:.2f} сек. ({downloaded / elapsed / 1024:.1f} КБ/с): {url}")
+        return DownloadResult(True, response.status, downloaded)
+
+async def list_threads_async(engine, forum_url):
+    """Асинхронный вариант list_threads"""
+    logger.info(f"Запрос списка тредов с форума: {forum_url}")
+    threads, _ = await engine.fetch_page(forum_url, lambda content: parse_thread_list(content, forum_url))
+    if not threads:
+        logger.warning("Не удалось найти ни одного треда на странице форума.")
+        return []
+    return threads
+
+async def fetch_thread_page_async(engine, url, page):
+    """Асинхронный вариант fetch_thread_page"""
+    page_url = f"{url}page-{page}" if page > 1 else url
+    thread_page, _ = await engine.fetch_page(page_url, parse_thread_page)
+    return thread_page
+
+async def parse_thread_async(engine, url, bot_config, page_count=None, last_known_id=None):
+    """Асинхронный вариант parse_thread (страницы обходятся тем же bot.thread_walk)"""
+    logger.info(f"Парсинг треда: {url}")
+    walk = thread_walk(bot_config, page_count, last_known_id)
+    try:
+        page = next(walk)
+        while True:
+            page = walk.send(await fetch_thread_page_async(engine, url, page))
+    except StopIteration as stop:
+        return stop.value
+
+async def detect_new_message_async(engine, thread_url, last_ids, bot_config, thread_info=None):
+    """Асинхронный вариант detect_new_message"""
+    thread_id = extract_thread_id(thread_url)
+    page_count = known_page_count(thread_id, thread_info)
+    thread_data = await parse_thread_async(engine, thread_url, bot_config, page_count, last_ids.get(thread_id))
+    return classify_thread_data(thread_url, thread_id, thread_data, last_ids)
+
+async def download_audio_async(engine, url, filename):
+    """Асинхронный вариант download_audio. Smule требует браузера и скачивается в отдельном потоке"""
+    if 'smule.com' in url:
+        return await asyncio.to_thread(download_smule_audio, url, filename)
+    if media_cache.copy_to(url, filename):
+        return True
+    if stream_cache.is_dead(url):
+        logger.info(f"Ссылка {url} ранее признана недоступной, скачивание пропущено")
+        return False
+    stream_url = audio_stream_url(url)
+    result = await engine.download(stream_url, filename, AUDIO_HEADERS, AUDIO_CONTENT_TYPES)
+    return record_audio_download(url, stream_url, filename, result)
+
+async def download_image_async(engine, url, filename):
+    """Асинхронный вариант download_image"""
+    if media_cache.copy_to(url, filename):
+        return True
+    if not await engine.download(url, filename, IMAGE_HEADERS, IMAGE_CONTENT_TYPES):
+        return False
+    record_image_download(url, filename)
+    return True
+
+async def detect_new_messages_async(engine, threads, last_ids, bot_config, should_stop=None):
+    """
+    Одновременная проверка тредов из list_threads.
+
+    Параметры:
+        engine (AsyncHttpEngine): Открытый движок
+        should_stop (callable): Возвращает True, если новые треды проверять не нужно
+
+    Возвращает:
+        list: Пары (тред, результат detect_new_message или None) в порядке threads;
+            треды, проверка которых не начиналась из-за should_stop, не включаются
+    """
+    engine.sync_cookies()
+    skipped = object()
+
+    async def check(thread):
+        if should_stop and should_stop():
+            return skipped
+        try:
+            return await detect_new_message_async(engine, thread['url'], last_ids, bot_config, thread)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке треда {thread['url']}: {e}")
+            logger.error(traceback.format_exc())
+            return None
+
+    detections = await asyncio.gather(*(check(thread) for thread in threads))
+    return [(thread, detection) for thread, detection in zip(threads, detections) if detection is not skipped]
+
+class AsyncScraper:
+    """
+    Цикл событий в отдельном потоке и AsyncHttpEngine, которые создаются при
+    первой проверке и работают до close: соединения с форумом переиспользуются
+    между циклами проверки.
+    """
+    def __init__(self, limit=100, per_host_limit=8):
+        """
+        Параметры:
+            limit (int): Максимальное количество одновременных соединений
+            per_host_limit (int): Максимальное количество соединений с одним хостом
+        """
+        self.engine = AsyncHttpEngine(limit, per_host_limit)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    def _run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def _start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-scraper', daemon=True)
+        self.thread.start()
+        self._run(self.engine.open())
+
+    def detect_new_messages(self, threads, last_ids, bot_config, should_stop=None):
+        """
+        Синхронный вызов detect_new_messages_async для рабочих потоков.
+        Одновременно выполняется не более одного цикла проверки.
+        """
+        with self.lock:
+            self._start()
+            return self._run(detect_new_messages_async(self.engine, threads, last_ids, bot_config, should_stop))
+
+    def close(self, timeout=10):
+        """Закрытие сессии и остановка цикла событий"""
+        with self.lock:
+            if self.loop is None:
+                return
+            try:
+                self._run(self.engine.close(), timeout)
+                self._run(self.loop.shutdown_default_executor(), timeout)
+            except Exception as e:
+                logger.warning(f"Ошибка при закрытии асинхронной сессии: {e!r}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+            self.loop.close()
+            self.loop = None
+            self.thread = None
@@ -0,0 +1,111 @@
+"""
+Память и время разбора страниц форума: полное дерево против частичного
+разбора через SoupStrainer (THREAD_PAGE_STRAINER / THREAD_LIST_STRAINER).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_partial_parsing.py [--thread-html page.html ...] [--list-html forum.html ...]
+
+Без аргументов используются синтетические страницы XenForo с шапкой,
+боковой панелью и скриптами. Для замеров на реальных данных сохраните
+страницы треда и раздела musforums.ru из браузера и передайте их пути.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import post_extractor
+from post_extractor import HTML_PARSER, THREAD_PAGE_STRAINER, THREAD_LIST_STRAINER, make_soup, extract_posts
+from bench_post_parsing import make_page
+
+def page_chrome(body):
+    """Обрамление страницы как на форуме: меню, виджеты, скрипты, подвал"""
+    menu = ''.join(f'<li><a href="/forums/{i}/" class="p-navEl-link">Раздел {i}</a></li>' for i in range(40))
+    widgets = ''.join(
+        f'<div class="block" data-widget-key="w{i}"><h3 class="block-minorHeader">Виджет {i}</h3>'
+        + ''.join(f'<div class="contentRow"><a href="/members/u{j}.1/" class="username">u{j}</a> <time data-time="{j}">{j}</time></div>' for j in range(15))
+        + '</div>' for i in range(6))
+    scripts = ''.join(f'<script>XF.config_{i} = {{"a": {i}, "b": "{"x" * 400}"}};</script>' for i in range(25))
+    return (
+        f'<html><head>{scripts}<link rel="stylesheet" href="/css.php"></head><body>'
+        f'<header class="p-header"><nav class="p-nav"><ul>{menu}</ul></nav></header>'
+        f'<div class="p-body">{body}<aside class="p-body-sidebar">{widgets}</aside></div>'
+        f'<footer class="p-footer"><ul>{menu}</ul></footer></body></html>'
+    ).encode('utf-8')
+
+def make_thread_page(page, posts_per_page=20):
+    html = make_page(page, posts_per_page).decode('utf-8')
+    body = html[html.index('<body>') + len('<body>'):html.index('</body>')]
+    nav = ''.join(f'<li class="pageNav-page"><a href="/threads/x.5/page-{p}">{p}</a></li>' for p in range(1, 8))
+    return page_chrome(f'<div class="pageNav"><ul class="pageNav-main">{nav}</ul></div>{body}')
+
+def make_list_page(threads=30):
+    items = ''.join(
+        f'<div class="structItem structItem--thread js-inlineModContainer" data-author="user{i}">'
+        f'<div class="structItem-cell structItem-cell--main"><div class="structItem-title"><a href="/threads/t.{i}/">Тред {i}</a></div>'
+        f'<span class="structItem-pageJump"><a href="/threads/t.{i}/page-2">2</a></span></div>'
+        f'<div class="structItem-cell structItem-cell--meta"><dl><dt>Ответы</dt><dd>{i * 3}</dd></dl></div>'
+        f'<div class="structItem-cell structItem-cell--latest"><time data-time="{1700000000 + i}">вчера</time>'
+        f'<a href="/members/p{i}.1/" class="username">p{i}</a></div></div>' for i in range(threads))
+    return page_chrome(f'<div class="structItemContainer">{items}</div>')
+
+def measure(pages, strainer, repeat):
+    """Лучшее время разбора страниц и пиковая память одного разбора"""
+    post_extractor.partial_parsing = strainer is not None
+    best = min(timed(pages, strainer) for _ in range(repeat))
+    tracemalloc.start()
+    soup = make_soup(pages[0], strainer)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del soup
+    return best / len(pages), peak
+
+def timed(pages, strainer):
+    started = time.perf_counter()
+    for page in pages:
+        make_soup(page, strainer)
+    return time.perf_counter() - started
+
+def report(name, pages, strainer, repeat):
+    full_time, full_memory = measure(pages, None, repeat)
+    partial_time, partial_memory = measure(pages, strainer, repeat)
+    print(f"{name} ({len(pages)} стр., {sum(map(len, pages)) // len(pages) // 1024} КБ на страницу, парсер {HTML_PARSER}):")
+    print(f"  полный разбор     {full_time * 1000:7.1f} мс  {full_memory / 1024:8.0f} КБ")
+    print(f"  частичный разбор  {partial_time * 1000:7.1f} мс  {partial_memory / 1024:8.0f} КБ")
+    print(f"  выигрыш: время x{full_time / partial_time:.2f}, память x{full_memory / partial_memory:.2f}")
+
+def read_files(paths):
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--thread-html', nargs='*', default=[], help='Сохранённые страницы тредов')
+    arg_parser.add_argument('--list-html', nargs='*', default=[], help='Сохранённые страницы разделов')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    thread_pages = read_files(args.thread_html) or [make_thread_page(page) for page in range(3)]
+    list_pages = read_files(args.list_html) or [make_list_page()]
+
+    # Частичный разбор не должен менять извлекаемые сообщения
+    for page in thread_pages:
+        post_extractor.partial_parsing = False
+        full = extract_posts(make_soup(page))
+        post_extractor.partial_parsing = True
+        partial = extract_posts(make_soup(page, THREAD_PAGE_STRAINER))
+        if full != partial:
+            print("ВНИМАНИЕ: сообщения при частичном разборе отличаются от полного")
+            break
+
+    report("Страницы треда", thread_pages, THREAD_PAGE_STRAINER, args.repeat)
+    report("Страницы раздела", list_pages, THREAD_LIST_STRAINER, args.repeat)
+
+if __name__ == '__main__':
+    main()
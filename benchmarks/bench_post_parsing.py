@@ -0,0 +1,191 @@
+"""
+Сравнение разбора страницы треда: прежний parse_posts (три дополнительных
+разбора HTML на сообщение) и однопроходный post_extractor.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_post_parsing.py [--pages 5] [--posts 20] [--repeat 3]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from post_extractor import HTML_PARSER, extract_posts
+
+def make_post(post_id, user, index):
+    """Сообщение XenForo с цитатой, спойлером, смайликами, аудио и изображениями"""
+    body = (
+        f'Сообщение <b>номер</b> {index} <img class="smilie" src="/styles/smilies/smile.png" alt=":)"> '
+        '<blockquote class="bbCodeBlock bbCodeBlock--expandable bbCodeBlock--quote">'
+        '<div class="bbCodeBlock-title"><a href="/goto/post?id=1">Вася сказал(а):</a></div>'
+        '<div class="bbCodeBlock-content"><div class="bbCodeBlock-expandContent">'
+        'цитата <img class="smilie" alt=";)"> '
+        '<blockquote class="bbCodeBlock bbCodeBlock--quote"><div class="bbCodeBlock-content">вложенная</div></blockquote>'
+        f'<a href="https://voca.ro/quoted{index}">запись</a></div>'
+        '<div class="bbCodeBlock-expandLink"><a>Нажмите для раскрытия...</a></div></div></blockquote> '
+        f'<a href="https://voca.ro/rec{index}">моя запись</a> '
+        f'<a href="https://www.smule.com/recording/song/{index}_{index}?share=1">smule</a> '
+        f'<img src="/data/attachments/{index}.png" alt="скрин"> '
+        f'<a href="/data/attachments/Full{index}.JPG">полный размер</a> '
+        '<div class="bbCodeSpoiler"><button><span class="bbCodeSpoiler-button-title">Текст</span></button>'
+        '<div class="bbCodeSpoiler-content"><div>скрытый <b>текст</b> '
+        '<blockquote class="bbCodeBlock bbCodeBlock--quote"><div class="bbCodeBlock-title">Петя</div>'
+        '<div class="bbCodeBlock-content">в спойлере</div></blockquote></div></div></div>'
+        '<!-- комментарий -->'
+    )
+    return (
+        f'<article class="message message--post js-post" data-author="{user}" data-content="post-{post_id}" id="js-post-{post_id}">'
+        f'<span class="u-anchorTarget" id="post-{post_id}"></span>'
+        '<div class="message-inner"><div class="message-cell message-cell--user"><h4 class="message-name">'
+        f'<a href="/members/{user}.1/" class="username">{user}</a></h4></div>'
+        '<div class="message-cell message-cell--main"><div class="message-main">'
+        '<div class="message-content js-messageContent"><div class="message-userContent"><article class="message-body">'
+        f'<div class="bbWrapper">{body}</div></article></div></div>'
+        f'<footer><a href="/threads/x.5/post-{post_id}">#{index}</a></footer></div></div></div></article>'
+    )
+
+def make_page(page, posts_per_page):
+    posts = ''.join(make_post(1000 + page * posts_per_page + i, f'user{i % 3}', i) for i in range(posts_per_page))
+    return (
+        '<html><head><script>var x = 1;</script></head><body>'
+        '<div class="p-title"><h1 class="p-title-value">Тред</h1></div>'
+        '<div class="p-description"><a href="/members/creator.1/" class="username">Автор</a></div>'
+        f'<div class="block-body js-replyNewMessageContainer">{posts}</div></body></html>'
+    ).encode('utf-8')
+
+# Прежняя реализация из bot.py - для сравнения результатов и времени
+
+def legacy_extract_post_id(post_content):
+    match = re.search(r'id="post-(\d+)"', post_content)
+    return match.group(1) if match else None
+
+def legacy_extract_audio_links(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    audio_links = []
+    for a_tag in soup.find_all('a', href=True):
+        href = a_tag['href']
+        if 'vocaroo.com' in href or 'voca.ro' in href or 'smule.com' in href:
+            audio_links.append(href)
+    return audio_links
+
+def legacy_extract_image_links(content, base_url="https://musforums.ru"):
+    soup = BeautifulSoup(content, 'html.parser')
+    image_links = []
+    supported_formats = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+    for img_tag in soup.find_all('img', src=True):
+        src = img_tag['src']
+        if (not img_tag.get('class') or 'smilie' not in img_tag.get('class')) and \
+           any(src.lower().endswith(fmt) for fmt in supported_formats):
+            if src.startswith('/'):
+                src = f"{base_url}{src}"
+            image_links.append(src)
+    for a_tag in soup.find_all('a', href=True):
+        href = a_tag['href'].lower()
+        if any(href.endswith(fmt) for fmt in supported_formats):
+            if href.startswith('/'):
+                href = f"{base_url}{href}"
+            image_links.append(href)
+    return image_links
+
+def legacy_parse_posts(soup):
+    messages = []
+    for post in soup.find_all('div', class_='message-inner'):
+        user_tag = post.find('a', class_='username')
+        user = user_tag.text.strip() if user_tag else "Неизвестный пользователь"
+        message_content = post.find('div', class_='message-content')
+        audio_links = legacy_extract_audio_links(str(message_content))
+        image_links = legacy_extract_image_links(str(message_content))
+        if message_content:
+            for unwanted in message_content.find_all('div', class_='bbCodeBlock-expandLink'):
+                unwanted.extract()
+            for img in message_content.find_all('img', class_='smilie'):
+                alt_text = img.get('alt', '')
+                if alt_text:
+                    img.replace_with(alt_text)
+            for quote in message_content.find_all('blockquote', class_='bbCodeBlock--quote'):
+                title_div = quote.find('div', class_='bbCodeBlock-title')
+                author = title_div.get_text(strip=True) if title_div else None
+                content_div = quote.find('div', class_='bbCodeBlock-expandContent')
+                if not content_div:
+                    content_div = quote.find('div', class_='bbCodeBlock-content')
+                if content_div:
+                    for img in content_div.find_all('img', class_='smilie'):
+                        alt_text = img.get('alt', '')
+                        if alt_text:
+                            img.replace_with(alt_text)
+                    content_text = content_div.get_text(strip=True)
+                    if author:
+                        quote.replace_with(f'[QUOTE={author}]{content_text}[/QUOTE]')
+                    else:
+                        quote.replace_with(f'[QUOTE]{content_text}[/QUOTE]')
+            for spoiler in message_content.find_all('div', class_='bbCodeSpoiler'):
+                title_span = spoiler.find('span', class_='bbCodeSpoiler-button-title')
+                spoiler_title = title_span.get_text(strip=True) if title_span else ''
+                content = spoiler.find('div', class_='bbCodeSpoiler-content')
+                if content:
+                    content_text = content.get_text(strip=True)
+                    if spoiler_title:
+                        spoiler.replace_with(f'[SPOILER={spoiler_title}]{content_text}[/SPOILER]')
+                    else:
+                        spoiler.replace_with(f'[SPOILER]{content_text}[/SPOILER]')
+            message = message_content.get_text(separator=' ', strip=True)
+            if audio_links:
+                message += "\n[Аудио от " + user + ": " + ", ".join(audio_links) + "]"
+            if image_links:
+                message += "\n[Изображения от " + user + ": " + ", ".join(image_links) + "]"
+        else:
+            message = "Нет содержания."
+        messages.append({
+            'id': legacy_extract_post_id(str(post)),
+            'author': user,
+            'content': message,
+            'audio_links': audio_links,
+            'image_links': image_links
+        })
+    return messages
+
+def run(pages, parser, parse):
+    started = time.perf_counter()
+    messages = []
+    for page in pages:
+        messages.extend(parse(BeautifulSoup(page, parser)))
+    return time.perf_counter() - started, messages
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--pages', type=int, default=5)
+    arg_parser.add_argument('--posts', type=int, default=20)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    pages = [make_page(page, args.posts) for page in range(args.pages)]
+    variants = [
+        ('прежний parse_posts, html.parser', 'html.parser', legacy_parse_posts),
+        ('post_extractor, html.parser', 'html.parser', extract_posts),
+    ]
+    if HTML_PARSER != 'html.parser':
+        variants.append((f'post_extractor, {HTML_PARSER}', HTML_PARSER, extract_posts))
+
+    # Результаты должны совпадать везде, кроме ID: прежняя версия искала якорь
+    # post-N внутри message-inner, где его нет, и возвращала None
+    _, reference = run(pages, 'html.parser', legacy_parse_posts)
+    for name, parser, parse in variants[1:]:
+        _, messages = run(pages, parser, parse)
+        strip_ids = lambda items: [{**item, 'id': None} for item in items]
+        status = "совпадает" if strip_ids(messages) == strip_ids(reference) else "ОТЛИЧАЕТСЯ"
+        missing_ids = sum(1 for item in messages if item['id'] is None)
+        print(f"{name}: результат {status}, сообщений без ID: {missing_ids}")
+
+    print(f"\n{args.pages} стр. x {args.posts} сообщений, лучшее из {args.repeat}:")
+    baseline = None
+    for name, parser, parse in variants:
+        best = min(run(pages, parser, parse)[0] for _ in range(args.repeat))
+        baseline = baseline or best
+        print(f"  {name:40s} {best * 1000:8.1f} мс  (x{baseline / best:.2f})")
+
+if __name__ == '__main__':
+    main()
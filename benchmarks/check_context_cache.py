@@ -0,0 +1,153 @@
+"""
+Проверка ContextCache и send_to_genai без сети на FakeCacheBackend.
+
+Запуск из корня репозитория:
+    python benchmarks/check_context_cache.py
+
+Проверяется повторное использование кэша, продление времени жизни,
+пересоздание при изменении add_info.txt, пропуск малой начальной части,
+запрет повторного создания после ошибки, а также то, что send_to_genai
+пересоздаёт кэш только если его нет на сервере, а при других ошибках
+(сеть, квота) оставляет его.
+"""
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+from context_cache import ContextCache, FakeCacheBackend
+
+MODEL = "models/gemini-1.5-pro-002"
+PREFIX = "Правила форума и описание бота. " * 50 + "\n\n"
+
+class FailingBackend(FakeCacheBackend):
+    """FakeCacheBackend, модель которого завершает первые запросы ошибками из errors"""
+    def __init__(self, errors=()):
+        super().__init__()
+        self.errors = list(errors)
+
+    def model_for(self, cached):
+        backend = self
+        model = super().model_for(cached)
+
+        class FailingModel:
+            def generate_content(self, contents, generation_config=None):
+                if backend.errors:
+                    raise backend.errors.pop(0)
+                return model.generate_content(contents, generation_config)
+
+        return FailingModel()
+
+class BrokenBackend(FakeCacheBackend):
+    """FakeCacheBackend, который не может создать кэш"""
+    def create(self, model_name, contents, ttl):
+        self.counter += 1
+        raise RuntimeError("Content is too small")
+
+def make_config():
+    """Конфигурация для send_to_genai с моделью, записывающей запросы без кэша"""
+    plain_requests = []
+
+    class PlainModel:
+        model_name = MODEL
+
+        def generate_content(self, contents, generation_config=None):
+            plain_requests.append(contents)
+            return types.SimpleNamespace(text="plain", usage_metadata=None)
+
+    config = types.SimpleNamespace(
+        api_keys=["key"], current_key_index=0, context_caching=True,
+        model=PlainModel(), generation_config=None)
+    return config, plain_requests
+
+def check_reuse():
+    backend = FakeCacheBackend()
+    cache = ContextCache(backend, min_tokens=100)
+    first = cache.model_for(PREFIX, MODEL)
+    second = cache.model_for(PREFIX, MODEL)
+    assert first is second and backend.counter == 1
+    first.generate_content(["тред"])
+    assert backend.requests == [[PREFIX, "тред"]]
+
+def check_refresh():
+    backend = FakeCacheBackend()
+    cache = ContextCache(backend, ttl=600, refresh_margin=60, min_tokens=100)
+    model = cache.model_for(PREFIX, MODEL)
+    entry = cache.entries[(MODEL, 0)]
+    entry['expires_at'] = time.time() + 10
+    backend.created[entry['cached']]['ttl'] = 0
+    assert cache.model_for(PREFIX, MODEL) is model and backend.counter == 1
+    assert backend.created[entry['cached']]['ttl'] == 600
+    assert entry['expires_at'] > time.time() + 500
+
+def check_prefix_change():
+    backend = FakeCacheBackend()
+    cache = ContextCache(backend, min_tokens=100)
+    cache.model_for(PREFIX, MODEL)
+    old = cache.entries[(MODEL, 0)]['cached']
+    cache.model_for(PREFIX + "Новое правило.\n\n", MODEL)
+    assert backend.counter == 2 and old not in backend.created and len(backend.created) == 1
+    # Для другого API ключа создаётся свой кэш
+    cache.model_for(PREFIX, MODEL, api_key_id=1)
+    assert backend.counter == 3 and len(backend.created) == 2
+    cache.clear()
+    assert not backend.created
+
+def check_small_prefix():
+    backend = FakeCacheBackend()
+    cache = ContextCache(backend)
+    assert cache.model_for("Короткий add_info\n\n", MODEL) is None
+    assert backend.counter == 0
+
+def check_create_failure():
+    backend = BrokenBackend()
+    cache = ContextCache(backend, min_tokens=100)
+    assert cache.model_for(PREFIX, MODEL) is None
+    assert cache.model_for(PREFIX, MODEL) is None
+    assert backend.counter == 1
+
+def check_send_expired():
+    backend = FakeCacheBackend()
+    bot.context_cache = ContextCache(backend, min_tokens=100)
+    config, plain_requests = make_config()
+    assert bot.send_to_genai(PREFIX + "тред 1", config, base_delay=0, prefix=PREFIX) == backend.response_text
+    backend.expire(bot.context_cache.entries[(MODEL, 0)]['cached'])
+    assert bot.send_to_genai(PREFIX + "тред 2", config, base_delay=0, prefix=PREFIX) == backend.response_text
+    assert backend.counter == 2 and not plain_requests
+    assert backend.requests == [[PREFIX, "тред 1"], [PREFIX, "тред 2"]]
+
+def check_send_network_error():
+    backend = FailingBackend([ConnectionError("Connection reset by peer")])
+    bot.context_cache = ContextCache(backend, min_tokens=100)
+    config, plain_requests = make_config()
+    assert bot.send_to_genai(PREFIX + "тред", config, base_delay=0, prefix=PREFIX) == backend.response_text
+    assert backend.counter == 1 and len(backend.created) == 1 and not plain_requests
+
+def check_send_disabled():
+    backend = FakeCacheBackend()
+    bot.context_cache = ContextCache(backend, min_tokens=100)
+    config, plain_requests = make_config()
+    config.context_caching = False
+    assert bot.send_to_genai(PREFIX + "тред", config, base_delay=0, prefix=PREFIX) == "plain"
+    assert backend.counter == 0 and plain_requests == [PREFIX + "тред"]
+
+CHECKS = [check_reuse, check_refresh, check_prefix_change, check_small_prefix, check_create_failure,
+          check_send_expired, check_send_network_error, check_send_disabled]
+
+if __name__ == '__main__':
+    context_cache = bot.context_cache
+    failed = 0
+    try:
+        for check in CHECKS:
+            try:
+                check()
+                print(f"OK    {check.__name__}")
+            except AssertionError:
+                failed += 1
+                print(f"FAIL  {check.__name__}")
+    finally:
+        bot.context_cache = context_cache
+    sys.exit(1 if failed else 0)
@@ -1,7 +1,6 @@
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
 import time
 import logging
 import re
@@ -21,11 +20,30 @@ from selenium_stealth import stealth
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from forum_poster import ForumPoster
-from memory_updater import update_memory
-import glob
+from selenium.common.exceptions import TimeoutException
+from forum_poster import ForumPoster, extract_reply_form
+from prompt_builder import PromptBuilder
+from asset_cache import AssetCache
+from memory_slicer import MemorySlicer
+from token_budget import TokenCounter, PromptBudget
+from context_cache import ContextCache
+from job_workspace import JobWorkspace
+from media_cache import MediaCache
+from upload_cache import UploadCache, file_sha256
+from downloader import StreamDownloader, DownloadResult, AUDIO_CONTENT_TYPES, IMAGE_CONTENT_TYPES, DEAD_LINK_STATUSES
+from browser_pool import BrowserPool
+from stream_cache import StreamUrlCache
+import post_extractor
+from post_extractor import make_soup, extract_posts, THREAD_PAGE_STRAINER, THREAD_LIST_STRAINER
+from conditional_http import ConditionalFetcher, accept_encoding
+from outbox import Outbox, OutboxSender
+from dedup_index import DedupIndex
+from sent_store import SentMessageStore
+from state_store import ThreadStateStore
 import sys
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Фильтры для логирования
 class WarningErrorFilter(logging.Filter):
@@ -71,6 +89,20 @@ class BotConfig:
         self.state_file = config_dict.get('STATE_FILE', 'last_id.json')
         self.api_keys = config_dict.get('API_KEYS', [])
         self.current_key_index = 0
+        self.fetch_workers = config_dict.get('fetch_workers', 4)
+        self.process_workers = config_dict.get('process_workers', 2)
+        self.workspace_dir = config_dict.get('workspace_dir')
+        self.media_workers = config_dict.get('media_workers', 4)
+        self.media_deadline = config_dict.get('media_deadline', 300)
+        self.async_fetch = config_dict.get('async_fetch', True)
+        self.async_connections = config_dict.get('async_connections', 100)
+        self.async_per_host = config_dict.get('async_per_host', 8)
+        self.reply_rate_per_minute = config_dict.get('reply_rate_per_minute', 2)
+        self.reply_burst = config_dict.get('reply_burst', 1)
+        # Отладочная копия запроса в thread_output.txt для просмотра в GUI
+        self.write_thread_output = config_dict.get('write_thread_output', True)
+        self.context_caching = config_dict.get('context_caching', False)
+        self.count_tokens_api = config_dict.get('count_tokens_api', True)
         
         # Инициализация Gemini
         if self.api_keys:
@@ -87,11 +119,63 @@ class BotConfig:
             self.model = None
             logger.warning("Не найдены API ключи для инициализации модели Gemini")
 
+def configure_runtime(config_dict, bot_config):
+    """
+    Настройка общих для всех тредов объектов модуля (кэши, очереди, хранилища,
+    сборка запроса) по конфигурации. Вызывается один раз при запуске бота,
+    после создания BotConfig.
+
+    Параметры:
+        config_dict (dict): Конфигурация бота (bot_config.json)
+        bot_config (BotConfig): Конфигурация с моделью Gemini
+    """
+    # Состояние тредов хранится в SQLite; STATE_FILE переносится в базу при первом запуске
+    thread_state.db_path = config_dict.get('STATE_DB', 'bot_state.db')
+    thread_state.legacy_path = bot_config.state_file
+    for host, limit in config_dict.get('media_host_limits', {}).items():
+        media_host_semaphores[host] = threading.BoundedSemaphore(limit)
+    media_cache.cache_dir = config_dict.get('media_cache_dir', media_cache.cache_dir)
+    media_cache.max_bytes = config_dict.get('media_cache_max_mb', 500) * 1024 * 1024
+    downloader.max_bytes = config_dict.get('max_download_mb', 50) * 1024 * 1024
+    smule_browser_pool.size = config_dict.get('smule_browsers', 1)
+    smule_browser_pool.max_pages = config_dict.get('smule_browser_max_pages', 20)
+    stream_cache.ttl = config_dict.get('stream_cache_ttl', stream_cache.ttl)
+    stream_cache.negative_ttl = config_dict.get('dead_link_ttl', stream_cache.negative_ttl)
+    post_extractor.partial_parsing = config_dict.get('partial_parsing', True)
+    page_fetcher.max_entries = config_dict.get('page_cache_entries', 256)
+    outbox.max_attempts = config_dict.get('reply_max_attempts', 5)
+    outbox.retention_days = config_dict.get('outbox_retention_days', 30)
+    asset_cache.check_interval = config_dict.get('asset_check_interval', 2)
+    memory_slicer.token_budget = config_dict.get('memory_token_budget', 4000)
+    memory_slicer.additional_items = config_dict.get('memory_additional_items', 20)
+    prompt_builder.slicer = memory_slicer if config_dict.get('memory_slicing', True) else None
+    prompt_budget.max_tokens = config_dict.get('prompt_token_budget', 200000)
+    context_cache.ttl = config_dict.get('context_cache_ttl', 3600)
+    context_cache.min_tokens = config_dict.get('context_cache_min_tokens', 32768)
+    sent_store.retention_days = config_dict.get('sent_retention_days', 90)
+    sent_store.max_entries = config_dict.get('sent_max_entries', 5000)
+    sent_store.global_window_days = config_dict.get('duplicate_window_days', 7)
+
+    # Точный подсчёт токенов текущей моделью (модель меняется при смене ключа)
+    prompt_budget.reserve_tokens = bot_config.generation_config.max_output_tokens if bot_config.generation_config else 2048
+    if bot_config.model and bot_config.count_tokens_api:
+        token_counter.exact = lambda part: bot_config.model.count_tokens([part]).total_tokens
+    else:
+        token_counter.exact = None
+
+    # Сохранённая сессия форума используется и при загрузке тредов, если включен scrape_logged_in
+    if bot_config.forum_url and bot_config.username:
+        poster = get_forum_poster({'forum_url': bot_config.forum_url, 'username': bot_config.username, 'password': bot_config.password})
+        if config_dict.get('scrape_logged_in', True):
+            share_forum_session(poster)
+        elif session.cookies is poster.session.cookies:
+            session.cookies = requests.cookies.RequestsCookieJar()
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
     'Accept-Language': 'en-US,en;q=0.9',
-    'Accept-Encoding': 'gzip, deflate, br',
+    'Accept-Encoding': accept_encoding(),
     'Connection': 'keep-alive',
     'Upgrade-Insecure-Requests': '1',
     'Sec-Fetch-Dest': 'document',
@@ -99,6 +183,12 @@ HEADERS = {
     'Sec-Fetch-Site': 'none',
     'Sec-Fetch-User': '?1',
 }
+
+# Заголовки для скачивания медиафайлов
+IMAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+AUDIO_HEADERS = dict(IMAGE_HEADERS, Referer='https://vocaroo.com/')
 def switch_api_key(bot_config, content=None):
     """Переключение на следующий API ключ"""
     bot_config.current_key_index = (bot_config.current_key_index + 1) % len(bot_config.api_keys)
@@ -113,9 +203,9 @@ def switch_api_key(bot_config, content=None):
             for part in content:
                 try:
                     if hasattr(part, 'display_name'):
-                        original_path = f"./{part.display_name}"
+                        original_path = upload_cache.source_path(part.name) or f"./{part.display_name}"
                         if os.path.exists(original_path):
-                            new_file = safe_upload_file(original_path)
+                            new_file = safe_upload_file(original_path, api_key=new_key)
                             if new_file:
                                 new_content.append(new_file)
                     else:
@@ -149,29 +239,60 @@ def create_session():
 
 session = create_session()
 
-def load_sent_messages(sent_messages_path="sent_messages.json"):
-    """Загрузка списка отправленных сообщений"""
-    if os.path.exists(sent_messages_path):
-        with open(sent_messages_path, 'r', encoding='utf-8') as f:
-            try:
-                sent_messages = json.load(f)
-                logger.debug("Список отправленных сообщений загружен.")
-                return sent_messages
-            except json.JSONDecodeError:
-                logger.warning("Файл отправленных сообщений поврежден. Инициализируется пустым списком.")
-                return []
-    logger.debug("Файл отправленных сообщений не найден. Инициализируется пустым списком.")
-    return []
-
-def save_sent_messages(sent_messages, sent_messages_path="sent_messages.json"):
-    """Сохранение списка отправленных сообщений"""
-    try:
-        with open(sent_messages_path, 'w', encoding='utf-8') as f:
-            json.dump(sent_messages, f, ensure_ascii=False, indent=4)
-        logger.debug("Список отправленных сообщений сохранен.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении отправленных сообщений: {e}")
-        logger.error(traceback.format_exc())
+# Условные запросы страниц форума и кэш результатов их разбора
+page_fetcher = ConditionalFetcher()
+
+# Кэш скачанных аудио и изображений между сообщениями и перезапусками
+media_cache = MediaCache()
+atexit.register(media_cache.flush)
+
+# Потоковое скачивание медиафайлов с ограничением размера
+downloader = StreamDownloader()
+
+# Кэш адресов аудиопотоков Smule/Vocaroo и недоступных ссылок
+stream_cache = StreamUrlCache()
+
+# Кэш загруженных в Gemini файлов по содержимому и API ключу
+upload_cache = UploadCache()
+
+# Ограничение одновременных загрузок медиафайлов с одного хоста для всех задач
+media_host_semaphores = {
+    'vocaroo': threading.BoundedSemaphore(2),
+    'smule': threading.BoundedSemaphore(1),
+    'musforums': threading.BoundedSemaphore(3),
+    'other': threading.BoundedSemaphore(2),
+}
+
+# Авторизованная сессия форума, общая для всех тредов (см. get_forum_poster)
+FORUM_SESSION_FILE = "forum_session.json"
+forum_poster = None
+forum_poster_key = None
+forum_poster_lock = threading.Lock()
+
+# Очередь исходящих ответов и поток их отправки (см. start_outbox_sender)
+outbox = Outbox()
+outbox_sender = None
+
+# Память бота (updated_memory.json, old_memory.json) и add_info.txt общие для
+# всех тредов; запрос к модели собирается в памяти (см. PromptBuilder)
+# Файлы запроса кэшируются в asset_cache; GUI сбрасывает кэш при сохранении файла
+asset_cache = AssetCache()
+# В запрос попадают только разделы памяти, относящиеся к треду (см. MemorySlicer)
+memory_slicer = MemorySlicer()
+# Запрос подгоняется под бюджет токенов (см. PromptBudget); токены считаются
+# через count_tokens модели с кэшем или оцениваются локально
+token_counter = TokenCounter()
+prompt_budget = PromptBudget(token_counter)
+prompt_builder = PromptBuilder("add_info.txt", "updated_memory.json", "old_memory.json", asset_cache, memory_slicer, prompt_budget)
+# Кэш контекста Gemini для add_info.txt в начале каждого запроса (см. send_to_genai)
+context_cache = ContextCache()
+# Журнал отправленных ответов и индекс MinHash/LSH по нему для is_duplicate.
+# При сжатии журнала из индекса удаляются подписи удалённых ответов
+sent_store = SentMessageStore("sent_messages.jsonl", legacy_path="sent_messages.json")
+dedup_index = DedupIndex("sent_messages.minhash.jsonl")
+sent_store.on_compact = dedup_index.prune
+# Состояние тредов (последнее сообщение, отпечаток активности, страницы, время ответа)
+thread_state = ThreadStateStore("bot_state.db")
 
 def is_message_valid(message):
     """Проверка корректности сообщения"""
@@ -184,70 +305,24 @@ def is_message_valid(message):
     return True
 
 def is_duplicate(message, sent_messages, threshold=0.8):
-    """Проверка сообщения на дубликат"""
-    for sent in sent_messages:
-        similarity = difflib.SequenceMatcher(None, message, sent).ratio()
+    """
+    Проверка сообщения на дубликат.
+
+    Похожие сообщения сначала выбираются индексом dedup_index (MinHash/LSH),
+    точное сравнение SequenceMatcher с порогом threshold выполняется только
+    для них, а не для всей истории.
+    """
+    scope = dedup_index.sync(sent_messages)
+    for sent in dedup_index.candidates(message, scope):
+        matcher = difflib.SequenceMatcher(None, message, sent)
+        if matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold:
+            continue
+        similarity = matcher.ratio()
         if similarity >= threshold:
             logger.debug(f"Сообщение является дубликатом с похожестью {similarity:.2f}.")
             return True
     return False
 
-def read_memory(memory_file_path=".\\updated_memory.json"):
-    """Чтение содержимого файла памяти"""
-    logger.debug(f"Попытка чтения файла памяти: {memory_file_path}")
-    try:
-        with open(memory_file_path, 'r', encoding='utf-8') as mem_file:
-            memory_content = mem_file.read()
-            logger.debug("Содержимое файла памяти успешно прочитано.")
-            return memory_content
-    except FileNotFoundError:
-        logger.error(f"Файл памяти не найден: {memory_file_path}")
-        return "Файл памяти не найден."
-    except Exception as e:
-        logger.error(f"Ошибка при чтении файла памяти {memory_file_path}: {e}")
-        logger.error(traceback.format_exc())
-        return "Ошибка при чтении файла памяти."
-
-def load_last_id(file_path):
-    """Загрузка последнего идентификатора сообщения"""
-    logger.debug(f"Попытка загрузить состояние из файла: {file_path}")
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-            try:
-                data = json.load(file)
-                if isinstance(data, dict):
-                    logger.debug("Состояние успешно загружено.")
-                    return data
-                else:
-                    logger.warning("Файл состояния имеет неверный формат. Инициализируется пустым состоянием.")
-                    return {}
-            except json.JSONDecodeError:
-                logger.warning("Файл состояния повреждён. Инициализируется без последних ID.")
-                return {}
-    logger.debug("Файл состояния не найден. Инициализация пустого состояния.")
-    return {}
-
-def save_last_id(file_path, last_id):
-    """Сохранение последнего идентификатора сообщений"""
-    logger.debug(f"Сохранение состояния в файл: {file_path}")
-    try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(last_id, file, ensure_ascii=False, indent=4)
-        logger.debug("Состояние успешно сохранено.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении состояния в файл {file_path}: {e}")
-        logger.error(traceback.format_exc())
-
-def extract_post_id(post_content):
-    """Извлечение ID сообщения из HTML"""
-    match = re.search(r'id="post-(\d+)"', post_content)
-    if match:
-        post_id = match.group(1)
-        logger.debug(f"Извлечён ID сообщения: {post_id}")
-        return post_id
-    logger.debug("ID сообщения не найден.")
-    return None
-
 def extract_thread_id(thread_url):
     """Извлечение ID треда из URL"""
     match = re.search(r'\.(\d+)/', thread_url)
@@ -258,13 +333,73 @@ def extract_thread_id(thread_url):
     logger.debug("ID треда не найден в URL.")
     return None
 
+def parse_thread_item(thread, forum_url):
+    """
+    Извлечение данных треда из блока structItem--thread списка тредов.
+    
+    Возвращает словарь с ключами 'url', 'thread_id', 'title', 'creator',
+    'replies', 'last_post_date', 'last_poster', 'page_count', 'fingerprint'
+    или None, если ссылка на тред не найдена.
+    """
+    title_div = thread.find('div', class_='structItem-title')
+    a_tag = title_div.find('a', href=True) if title_div else None
+    if not a_tag:
+        return None
+    thread_url = requests.compat.urljoin(forum_url, a_tag['href'])
+    
+    # Количество ответов - первая пара dt/dd в ячейке meta
+    replies = None
+    meta_cell = thread.find('div', class_='structItem-cell--meta')
+    if meta_cell:
+        replies_tag = meta_cell.find('dd')
+        replies = replies_tag.get_text(strip=True) if replies_tag else None
+    
+    # Дата и автор последнего сообщения
+    last_post_date = None
+    last_poster = None
+    latest_cell = thread.find('div', class_='structItem-cell--latest')
+    if latest_cell:
+        time_tag = latest_cell.find('time')
+        if time_tag:
+            last_post_date = time_tag.get('data-time') or time_tag.get('datetime')
+        poster_tag = latest_cell.find(class_='username')
+        last_poster = poster_tag.get_text(strip=True) if poster_tag else None
+    
+    # Количество страниц из быстрых ссылок structItem-pageJump
+    page_count = 1
+    page_jump = thread.find('span', class_='structItem-pageJump')
+    if page_jump:
+        pages = [int(a.get_text(strip=True)) for a in page_jump.find_all('a')
+                 if a.get_text(strip=True).isdigit()]
+        page_count = max(pages, default=1)
+    
+    fingerprint = None
+    if last_post_date:
+        fingerprint = f"{last_post_date}|{replies}|{last_poster}"
+    
+    return {
+        'url': thread_url,
+        'thread_id': extract_thread_id(thread_url),
+        'title': a_tag.get_text(strip=True),
+        'creator': thread.get('data-author'),
+        'replies': replies,
+        'last_post_date': last_post_date,
+        'last_poster': last_poster,
+        'page_count': page_count,
+        'fingerprint': fingerprint
+    }
+
 def list_threads(forum_url):
-    """Получение списка URL всех тредов на странице форума"""
+    """
+    Получение списка тредов на странице форума.
+    
+    Возвращает список словарей (см. parse_thread_item) с URL треда, датой
+    и автором последнего сообщения, количеством ответов и страниц.
+    """
     logger.info(f"Запрос списка тредов с форума: {forum_url}")
     try:
-        response = session.get(forum_url, headers=HEADERS, timeout=15)
-        response.raise_for_status()
-        logger.debug(f"Получен ответ от форума: {forum_url}")
+        threads, cached = page_fetcher.fetch(session, forum_url, lambda content: parse_thread_list(content, forum_url), HEADERS)
+        logger.debug(f"Получен ответ от форума: {forum_url}{' (не изменился)' if cached else ''}")
     except (requests.exceptions.SSLError, RemoteDisconnected) as e:
         logger.error(f"SSL ошибка или разрыв соединения при запросе к форуму {forum_url}: {e}")
         logger.error(traceback.format_exc())
@@ -274,206 +409,330 @@ def list_threads(forum_url):
         logger.error(traceback.format_exc())
         return []
     
-    soup = BeautifulSoup(response.content, 'html.parser')
+    if not threads:
+        logger.warning("Не удалось найти ни одного треда на странице форума.")
+    
+    return threads
+
+def parse_thread_list(content, forum_url):
+    """Разбор HTML страницы раздела в список тредов (см. parse_thread_item)"""
+    soup = make_soup(content, THREAD_LIST_STRAINER)
     
     threads = []
     thread_elements = soup.find_all('div', class_=re.compile(r'structItem--thread'))
     logger.debug(f"Найдено {len(thread_elements)} элементов тредов на странице.")
     for thread in thread_elements:
-        title_div = thread.find('div', class_='structItem-title')
-        if title_div:
-            a_tag = title_div.find('a', href=True)
-            if a_tag:
-                thread_url = requests.compat.urljoin(forum_url, a_tag['href'])
-                threads.append(thread_url)
-                logger.debug(f"Добавлен URL треда: {thread_url}")
+        thread_info = parse_thread_item(thread, forum_url)
+        if thread_info:
+            threads.append(thread_info)
+            logger.debug(f"Добавлен тред: {thread_info['url']} (последнее сообщение: {thread_info['last_post_date']}, ответов: {thread_info['replies']})")
+    return threads
+
+def create_smule_driver():
+    """Запуск headless Chrome с selenium_stealth для страниц Smule"""
+    options = Options()
+    options.add_argument('--headless=new')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--window-size=1920,1080')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--disable-blink-features=AutomationControlled')
+    options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    options.add_experimental_option('useAutomationExtension', False)
     
-    if not threads:
-        logger.warning("Не удалось найти ни одного треда на странице форума.")
+    # Получаем путь к папке с исполняемым файлом
+    if getattr(sys, 'frozen', False):
+        application_path = os.path.dirname(sys.executable)
+    else:
+        application_path = os.path.dirname(os.path.abspath(__file__))
+        
+    # Путь к файлам selenium_stealth
+    stealth_path = os.path.join(application_path, 'selenium_stealth')
     
-    return threads
+    driver = webdriver.Chrome(options=options)
+    try:
+        stealth(driver,
+            languages=["ru-RU", "ru"],
+            vendor="Google Inc.",
+            platform="Win32",
+            webgl_vendor="Intel Inc.",
+            renderer="Intel Iris OpenGL Engine",
+            fix_hairline=True,
+            js_path=stealth_path  # Используем локальный путь
+        )
+    except Exception:
+        driver.quit()
+        raise
+    return driver
+
+# Браузеры для Smule запускаются один раз и переиспользуются между ссылками
+smule_browser_pool = BrowserPool(create_smule_driver)
+atexit.register(smule_browser_pool.close)
+
+def unwrap_vk_redirect(url):
+    """Извлечение целевой ссылки из редиректа VK (vk.com/away.php?to=...)"""
+    if 'vk.com/away.php' not in url:
+        return url
+    parsed = urllib.parse.urlparse(url)
+    query_params = urllib.parse.parse_qs(parsed.query)
+    target = query_params.get('to', [None])[0]
+    if not target:
+        raise ValueError("Не удалось извлечь URL из VK редиректа")
+    return urllib.parse.unquote(target)
 
-def extract_audio_links(content):
-    """Извлечение аудиоссылок из HTML"""
-    soup = BeautifulSoup(content, 'html.parser')
-    audio_links = []
+def extract_smule_stream_url(content):
+    """Поиск ссылки на аудиопоток в HTML страницы Smule"""
+    match = re.search(r'twitter:player:stream" content="([^"]+)"', content)
+    if match:
+        audio_url = match.group(1).replace('amp;', '')
+        logger.info(f"Найден URL аудио через meta тег: {audio_url}")
+        return audio_url
+    match = re.search(r'"m4a":"([^"]+)"', content)
+    if match:
+        audio_url = match.group(1).replace('\\/', '/')
+        logger.info(f"Найден URL аудио через JSON: {audio_url}")
+        return audio_url
+    return None
+
+def resolve_smule_stream_http(url):
+    """
+    Поиск ссылки на аудиопоток Smule обычным HTTP-запросом, без браузера.
+    Если страница не существует, ссылка отмечается в stream_cache как недоступная.
+    """
+    try:
+        response = session.get(url, headers=HEADERS, timeout=15)
+        if response.status_code in DEAD_LINK_STATUSES:
+            stream_cache.mark_dead(url)
+            return None
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.debug(f"Не удалось загрузить страницу Smule без браузера {url}: {e}")
+        return None
+    return extract_smule_stream_url(response.text)
+
+def resolve_smule_stream_browser(driver, url, timeout=15):
+    """Поиск ссылки на аудиопоток Smule в браузере с ожиданием meta тега или audio элемента"""
+    logger.info(f"Загрузка страницы Smule: {url}")
+    driver.get(url)
+    
+    def stream_ready(d):
+        for meta in d.find_elements(By.CSS_SELECTOR, 'meta[name="twitter:player:stream"], meta[property="twitter:player:stream"]'):
+            content = meta.get_attribute('content')
+            if content:
+                return content
+        for audio in d.find_elements(By.TAG_NAME, 'audio'):
+            src = audio.get_attribute('src')
+            if src:
+                return src
+        return False
+    
+    try:
+        audio_url = WebDriverWait(driver, timeout).until(stream_ready)
+        logger.info(f"Найден URL аудио на странице: {audio_url}")
+        return audio_url
+    except TimeoutException:
+        logger.info("Meta тег и audio элемент не появились, поиск ссылки в исходном коде страницы")
+        return extract_smule_stream_url(driver.page_source)
+
+def save_smule_stream(http_session, share_url, page_url, audio_url, output_filename, cancel=None):
+    """Скачивание найденного аудиопотока Smule с сохранением в кэши. Возвращает DownloadResult"""
+    # Та же запись могла быть скачана по другой ссылке
+    if media_cache.copy_to(audio_url, output_filename):
+        media_cache.put(share_url, output_filename)
+        stream_cache.put(share_url, audio_url)
+        return DownloadResult(True)
     
-    for a_tag in soup.find_all('a', href=True):
-        href = a_tag['href']
-        if 'vocaroo.com' in href or 'voca.ro' in href or 'smule.com' in href:
-            audio_links.append(href)
+    download_headers = HEADERS.copy()
+    download_headers['Referer'] = page_url
+    result = downloader.download(http_session, audio_url, output_filename, download_headers, AUDIO_CONTENT_TYPES, timeout=30, cancel=cancel)
+    if not result:
+        return result
     
-    return audio_links
+    logger.info(f"Аудио со Smule успешно сохранено: {output_filename}")
+    media_cache.put(share_url, output_filename, extra_urls=(audio_url,))
+    stream_cache.put(share_url, audio_url)
+    return result
 
-def download_smule_audio(url, output_filename, max_retries=3, base_delay=5):
-    """Скачивание аудио со Smule через selenium"""
+def download_smule_audio(url, output_filename, max_retries=3, base_delay=5, cancel=None):
+    """
+    Скачивание аудио со Smule.
+    
+    Сначала используется адрес потока из stream_cache, затем ссылка на поток
+    ищется в HTML страницы обычным запросом, и только если это не удалось -
+    в браузере из пула smule_browser_pool. Недоступные ссылки запоминаются
+    в stream_cache и не проверяются повторно до истечения dead_link_ttl.
+    После установки события cancel новые попытки не выполняются.
+    """
+    if media_cache.copy_to(url, output_filename):
+        return True
+    if stream_cache.is_dead(url):
+        logger.info(f"Ссылка {url} ранее признана недоступной, скачивание пропущено")
+        return False
+    share_url = url
+    try:
+        url = unwrap_vk_redirect(url)
+    except ValueError as e:
+        logger.error(f"{e}: {share_url}")
+        return False
+    
+    cached_stream_url = stream_cache.get(share_url)
+    if cached_stream_url:
+        if save_smule_stream(session, share_url, url, cached_stream_url, output_filename, cancel):
+            return True
+        # Подписанный адрес потока мог устареть - разрешаем ссылку заново
+        stream_cache.invalidate(share_url)
+    
+    audio_url = resolve_smule_stream_http(url)
+    if stream_cache.is_dead(url):
+        return False
+    if audio_url and save_smule_stream(session, share_url, url, audio_url, output_filename, cancel):
+        return True
+    
+    pages_without_stream = 0
     for attempt in range(max_retries):
+        if cancel is not None and cancel.is_set():
+            logger.info(f"Скачивание аудио со Smule отменено: {url}")
+            return False
         try:
-            options = Options()
-            options.add_argument('--headless=new')
-            options.add_argument('--no-sandbox')
-            options.add_argument('--window-size=1920,1080')
-            options.add_argument('--disable-gpu')
-            options.add_argument('--disable-blink-features=AutomationControlled')
-            options.add_experimental_option("excludeSwitches", ["enable-automation"])
-            options.add_experimental_option('useAutomationExtension', False)
-            
-            # Получаем путь к папке с исполняемым файлом
-            if getattr(sys, 'frozen', False):
-                application_path = os.path.dirname(sys.executable)
-            else:
-                application_path = os.path.dirname(os.path.abspath(__file__))
-                
-            # Путь к файлам selenium_stealth
-            stealth_path = os.path.join(application_path, 'selenium_stealth')
+            logger.info(f"Попытка {attempt + 1}/{max_retries} скачать аудио со Smule через браузер: {url}")
+            with smule_browser_pool.driver() as driver:
+                audio_url = resolve_smule_stream_browser(driver, url)
+                cookies = driver.get_cookies()
             
-            logger.info(f"Попытка {attempt + 1}/{max_retries} скачать аудио со Smule: {url}")
-            driver = webdriver.Chrome(options=options)
+            if not audio_url:
+                pages_without_stream += 1
+                raise ValueError("Не удалось найти ссылку на аудио")
             
-            try:
-                stealth(driver,
-                    languages=["ru-RU", "ru"],
-                    vendor="Google Inc.",
-                    platform="Win32",
-                    webgl_vendor="Intel Inc.",
-                    renderer="Intel Iris OpenGL Engine",
-                    fix_hairline=True,
-                    js_path=stealth_path  # Используем локальный путь
-                )
-                
-                try:
-                    # Обработка VK редиректа
-                    if 'vk.com/away.php' in url:
-                        parsed = urllib.parse.urlparse(url)
-                        query_params = urllib.parse.parse_qs(parsed.query)
-                        url = query_params.get('to', [None])[0]
-                        if url:
-                            url = urllib.parse.unquote(url)
-                        else:
-                            raise ValueError("Не удалось извлечь URL из VK редиректа")
-
-                    logger.info(f"Загрузка страницы Smule: {url}")
-                    driver.get(url)
-                    time.sleep(5)
-                    
-                    content = driver.page_source
-                    audio_url = None
-                    
-                    # Поск ссылки на аудио
-                    try:
-                        audio_url = content.split('twitter:player:stream" content="')[1].split('">')[0].replace('amp;', '')
-                        logger.info(f"Найден URL аудио через meta тег: {audio_url}")
-                    except:
-                        logger.info("Поиск аудио через meta тег не удался, пробуем другие способы...")
-                    
-                    if not audio_url:
-                        match = re.search(r'"m4a":"([^"]+)"', content)
-                        if match:
-                            audio_url = match.group(1).replace('\\/', '/')
-                            logger.info(f"Найден URL аудио через JSON: {audio_url}")
-                    
-                    if not audio_url:
-                        try:
-                            audio_element = WebDriverWait(driver, 10).until(
-                                EC.presence_of_element_located((By.TAG_NAME, "audio"))
-                            )
-                            audio_url = audio_element.get_attribute('src')
-                            logger.info(f"Найден URL аудио через audio тег: {audio_url}")
-                        except:
-                            logger.info("Поиск аудио через audio тег не удался")
-
-                    if not audio_url:
-                        raise ValueError("Не удалось найти ссылку на аудио")
-
-                    # Скачивание файла
-                    cookies = driver.get_cookies()
-                    s = requests.Session()
-                    for cookie in cookies:
-                        s.cookies.set(cookie['name'], cookie['value'])
-                    
-                    download_headers = HEADERS.copy()
-                    download_headers['Referer'] = url
-                    s.headers.update(download_headers)
-                    
-                    audio_response = s.get(audio_url, timeout=30)
-                    audio_response.raise_for_status()
-                    
-                    with open(output_filename, 'wb') as file:
-                        file.write(audio_response.content)
-                    
-                    logger.info(f"Аудио со Smule успешно сохранено: {output_filename}")
-                    return True
-                    
-                finally:
-                    driver.quit()
-            except Exception as e:
-                logger.error(f"Ошибка при попытке {attempt + 1} скачивания аудио со Smule {url}: {str(e)}")
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    logger.info(f"Ожидание {delay} секунд перед следующей попыткой...")
-                    time.sleep(delay)
-                else:
-                    logger.error(f"Все попытки скачать аудио со Smule не удались: {url}")
-                    return False
+            s = requests.Session()
+            for cookie in cookies:
+                s.cookies.set(cookie['name'], cookie['value'])
+            result = save_smule_stream(s, share_url, url, audio_url, output_filename, cancel)
+            if result:
+                return True
+            if result.is_dead_link:
+                stream_cache.mark_dead(share_url)
+                return False
+            raise ValueError(f"Не удалось скачать аудио по ссылке {audio_url}")
         except Exception as e:
-            logger.error(f"Ошибка при попытке {attempt + 1}: {e}")
+            logger.error(f"Ошибка при попытке {attempt + 1} скачивания аудио со Smule {url}: {str(e)}")
             if attempt < max_retries - 1:
-                time.sleep(base_delay)
-            continue
-
-def download_audio(url, filename):
-    """Скачивание аудио по URL"""
-    if 'smule.com' in url:
-        return download_smule_audio(url, filename)
+                delay = base_delay * (2 ** attempt)
+                logger.info(f"Ожидание {delay} секунд перед следующей попыткой...")
+                if cancel is not None:
+                    cancel.wait(delay)
+                else:
+                    time.sleep(delay)
     
+    logger.error(f"Все попытки скачать аудио со Smule не удались: {url}")
+    # Страница открывалась, но ни в одной попытке на ней не было записи
+    if pages_without_stream == max_retries:
+        stream_cache.mark_dead(share_url)
+    return False
+
+def audio_stream_url(url):
+    """Адрес аудиофайла для ссылки: из stream_cache или по идентификатору записи Vocaroo"""
+    cached_stream_url = stream_cache.get(url)
+    if cached_stream_url:
+        return cached_stream_url
     # Обработка Vocaroo ссылок
-    if url.startswith("https://voca.ro/"):
-        audio_id = url.split("/")[-1]
-        url = f"https://media1.vocaroo.com/mp3/{audio_id}"
-    elif url.startswith("https://vocaroo.com/"):
+    if url.startswith("https://voca.ro/") or url.startswith("https://vocaroo.com/"):
         audio_id = url.split("/")[-1]
-        url = f"https://media1.vocaroo.com/mp3/{audio_id}"
+        return f"https://media1.vocaroo.com/mp3/{audio_id}"
+    return url
+
+def record_audio_download(share_url, url, filename, result):
+    """Обновление кэшей по результату скачивания аудио. Возвращает True при успехе"""
+    if not result:
+        if result.is_dead_link:
+            stream_cache.mark_dead(share_url)
+        return False
+    logger.info(f"Аудио успешно скачано: {filename}")
+    print(f"Аудио успешно скачано: {filename}", url)
+    media_cache.put(share_url, filename)
+    stream_cache.put(share_url, url)
+    return True
+
+def download_audio(url, filename, cancel=None):
+    """Скачивание аудио по URL (cancel - событие отмены скачивания, опционально)"""
+    if 'smule.com' in url:
+        return download_smule_audio(url, filename, cancel=cancel)
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
-        'Referer': 'https://vocaroo.com/'
-    }
-    try:
-        response = session.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        logger.info(f"Аудио успешно скачано: {filename}")
-        print(f"Аудио успешно скачано: {filename}", url)
+    if media_cache.copy_to(url, filename):
         return True
+    if stream_cache.is_dead(url):
+        logger.info(f"Ссылка {url} ранее признана недоступной, скачивание пропущено")
+        return False
+    share_url = url
+    
+    url = audio_stream_url(url)
+    try:
+        result = downloader.download(session, url, filename, AUDIO_HEADERS, AUDIO_CONTENT_TYPES, cancel=cancel)
+        return record_audio_download(share_url, url, filename, result)
     except Exception as e:
         logger.error(f"Ошибка при скачиании аудио {url}: {e}")
         return False
 
-def extract_image_links(content, base_url="https://musforums.ru"):
-    """Извлечение ссылок на изображения из HTML"""
-    soup = BeautifulSoup(content, 'html.parser')
-    image_links = []
+def extract_page_count(soup):
+    """Извлечение количества страниц треда из блока pageNav"""
+    page_nav = soup.find('ul', class_='pageNav-main')
+    if not page_nav:
+        return 1
+    pages = [int(a.get_text(strip=True)) for a in page_nav.find_all('a')
+             if a.get_text(strip=True).isdigit()]
+    return max(pages, default=1)
+
+def parse_thread_page(content):
+    """
+    Разбор HTML страницы треда.
     
-    supported_formats = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+    Возвращает словарь с ключами 'title', 'creator', 'page_count', 'messages'
+    (список сообщений, см. parse_posts) и 'reply_form' (форма ответа, если
+    страница загружена с авторизацией, см. forum_poster.extract_reply_form).
+    """
+    soup = make_soup(content, THREAD_PAGE_STRAINER)
     
-    for img_tag in soup.find_all('img', src=True):
-        src = img_tag['src']
-        if (not img_tag.get('class') or 'smilie' not in img_tag.get('class')) and \
-           any(src.lower().endswith(fmt) for fmt in supported_formats):
-            if src.startswith('/'):
-                src = f"{base_url}{src}"
-            image_links.append(src)
+    title_tag = soup.find('h1', class_='p-title-value')
+    title = title_tag.text.strip() if title_tag else "Без заголовка"
     
-    for a_tag in soup.find_all('a', href=True):
-        href = a_tag['href'].lower()
-        if any(href.endswith(fmt) for fmt in supported_formats):
-            if href.startswith('/'):
-                href = f"{base_url}{href}"
-            image_links.append(href)
+    description = soup.find('div', class_='p-description')
+    creator_tag = (description.find('a', class_='username') if description else None) or soup.find('a', class_='username')
+    creator = creator_tag.text.strip() if creator_tag else "Неизвестный"
     
-    return image_links
-def parse_thread(url, bot_config):
+    return {
+        'title': title,
+        'creator': creator,
+        'page_count': extract_page_count(soup),
+        'messages': parse_posts(soup),
+        'reply_form': extract_reply_form(soup)
+    }
+
+def fetch_thread_page(url, page):
+    """
+    Загрузка и разбор одной страницы треда (см. parse_thread_page).
+    Неизменившаяся страница не разбирается повторно. Возвращает None при ошибке
+    """
+    page_url = f"{url}page-{page}" if page > 1 else url
+    logger.debug(f"Обработка страницы {page}: {page_url}")
+    try:
+        thread_page, cached = page_fetcher.fetch(session, page_url, parse_thread_page, HEADERS)
+        logger.debug(f"Получен ответ от страницы {page}: {page_url}{' (не изменилась)' if cached else ''}")
+    except (requests.exceptions.SSLError, RemoteDisconnected) as e:
+        logger.error(f"SSL ошибка или разрыв соединения при запросе к странице {page_url}: {e}")
+        logger.error(traceback.format_exc())
+        return None
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Ошибка при запросе к странице {page_url}: {e}")
+        logger.error(traceback.format_exc())
+        return None
+    return thread_page
+
+def parse_posts(soup):
+    """Извлечение сообщений со страницы треда (см. post_extractor.extract_posts)"""
+    messages = extract_posts(soup)
+    for message in messages:
+        logger.debug(f"Добавлено сообщение от {message['author']} с ID {message['id']}")
+    return messages
+
+def parse_thread(url, bot_config, page_count=None, last_known_id=None):
     """
     Получает ссылку на тред и возвращает данные в формате словаря:
     {
@@ -481,142 +740,92 @@ def parse_thread(url, bot_config):
         'creator': str,
         'messages': list of dicts with keys 'id', 'author', 'content',
         'unique_audio_links': list of str,
-        'unique_image_links': list of str
+        'unique_image_links': list of str,
+        'page_count': int,
+        'reply_form': dict or None
     }
+    
+    Страницы читаются с конца треда: загружаются только последние страницы,
+    покрывающие message_limit сообщений.
+    
+    Args:
+        url: URL треда
+        bot_config: Конфигурация бота
+        page_count: Известное количество страниц (например, из списка тредов).
+            Если не указано, оно определяется по pageNav первой страницы
+        last_known_id: ID последнего обработанного сообщения. Если последнее
+            сообщение треда совпадает с ним, более ранние страницы не загружаются
     """
     logger.info(f"Парсинг треда: {url}")
-    messages = []
-    page = 1
+    walk = thread_walk(bot_config, page_count, last_known_id)
+    try:
+        page = next(walk)
+        while True:
+            page = walk.send(fetch_thread_page(url, page))
+    except StopIteration as stop:
+        return stop.value
+
+def thread_walk(bot_config, page_count=None, last_known_id=None):
+    """
+    Обход страниц треда с конца для parse_thread и async_scraper.parse_thread_async.
+
+    Генератор выдаёт номера страниц, которые нужно загрузить, и получает через
+    send результат fetch_thread_page (None при ошибке). Результат parse_thread
+    возвращается в StopIteration.value. Загрузку выполняет вызывающая сторона,
+    поэтому синхронный и асинхронный разбор обходят страницы одинаково.
+    """
+    page = page_count or 1
+    thread_page = yield page
+    if thread_page is None:
+        return None
+    
+    # Количество страниц могло измениться с момента получения page_count. Если
+    # страниц стало меньше (сообщения удалены или перенесены), форум перенаправляет
+    # page-N на последнюю страницу, и без перехода к ней она была бы прочитана дважды
+    actual_page_count = thread_page['page_count']
+    if actual_page_count != page:
+        logger.debug(f"Количество страниц треда изменилось: {page} -> {actual_page_count}")
+        page = actual_page_count
+        thread_page = yield page
+        if thread_page is None:
+            return None
+    page_count = page
+    last_page = thread_page
     
+    messages = []
+    pages_fetched = 0
     while True:
-        page_url = f"{url}page-{page}" if page > 1 else url
-        logger.debug(f"Обработка страницы {page}: {page_url}")
+        page_messages = thread_page['messages']
+        pages_fetched += 1
+        logger.debug(f"Найдено {len(page_messages)} сообщений на странице {page}.")
+        messages = page_messages + messages
         
-        try:
-            response = session.get(page_url, headers=HEADERS, timeout=15)
-            response.raise_for_status()
-            logger.debug(f"Получен ответ от страницы {page}: {page_url}")
-        except (requests.exceptions.SSLError, RemoteDisconnected) as e:
-            logger.error(f"SSL ошибка или разрыв соединения при запросе к странице {page_url}: {e}")
-            logger.error(traceback.format_exc())
+        if thread_walk_finished(messages, page, last_known_id, bot_config):
             break
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка при запросе к странице {page_url}: {e}")
-            logger.error(traceback.format_exc())
-            break
-
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        if page == 1:
-            # звлечение заголовка темы
-            title_tag = soup.find('h1', class_='p-title-value')
-            title = title_tag.text.strip() if title_tag else "Без заголовка"
-            logger.debug(f"Заголовок треда: {title}")
-
-            # Извлечение создателя темы
-            creator_tag = soup.find('a', class_='username')
-            creator = creator_tag.text.strip() if creator_tag else "Неизвестный"
-            logger.debug(f"Создатель треда: {creator}")
-
-        # Извлечение сообщений
-        posts = soup.find_all('div', class_='message-inner')
-        logger.debug(f"Найдено {len(posts)} сообщений на странице {page}.")
         
-        if not posts:
-            logger.debug(f"Сообщения не найдены на странице {page}. Завершение парсинга.")
+        page -= 1
+        thread_page = yield page
+        if thread_page is None:
             break
 
-        for post in posts:
-            user_tag = post.find('a', class_='username')
-            user = user_tag.text.strip() if user_tag else "Неизвестный пользователь"
-            
-            message_content = post.find('div', class_='message-content')
-            # Сохраняем ссылки отдельно, не добавляя их в текст
-            audio_links = extract_audio_links(str(message_content))
-            image_links = extract_image_links(str(message_content))
-            
-            if message_content:
-                # Удаляем ненужные элементы
-                for unwanted in message_content.find_all('div', class_='bbCodeBlock-expandLink'):
-                    unwanted.extract()
-                
-                # Обрабатываем смайлики
-                for img in message_content.find_all('img', class_='smilie'):
-                    alt_text = img.get('alt', '')
-                    if alt_text:
-                        img.replace_with(alt_text)
-                
-                # Обрабатываем цитаты
-                quotes = message_content.find_all('blockquote', class_='bbCodeBlock--quote')
-                for quote in quotes:
-                    # Получаем автора цитаты
-                    title_div = quote.find('div', class_='bbCodeBlock-title')
-                    author = title_div.get_text(strip=True) if title_div else None
-                    
-                    # Получаем содержимое цитаты
-                    content_div = quote.find('div', class_='bbCodeBlock-expandContent')
-                    if not content_div:
-                        content_div = quote.find('div', class_='bbCodeBlock-content')
-                    
-                    if content_div:
-                        # Рекурсивно обрабатываем смайлики внутри цитаты
-                        for img in content_div.find_all('img', class_='smilie'):
-                            alt_text = img.get('alt', '')
-                            if alt_text:
-                                img.replace_with(alt_text)
-                        
-                        content_text = content_div.get_text(strip=True)
-                        
-                        if author:
-                            quote.replace_with(f'[QUOTE={author}]{content_text}[/QUOTE]')
-                        else:
-                            quote.replace_with(f'[QUOTE]{content_text}[/QUOTE]')
-                
-                # Обрабатываем спойлеры
-                spoilers = message_content.find_all('div', class_='bbCodeSpoiler')
-                for spoiler in spoilers:
-                    title_span = spoiler.find('span', class_='bbCodeSpoiler-button-title')
-                    spoiler_title = title_span.get_text(strip=True) if title_span else ''
-                    content = spoiler.find('div', class_='bbCodeSpoiler-content')
-                    if content:
-                        content_text = content.get_text(strip=True)
-                        if spoiler_title:
-                            spoiler.replace_with(f'[SPOILER={spoiler_title}]{content_text}[/SPOILER]')
-                        else:
-                            spoiler.replace_with(f'[SPOILER]{content_text}[/SPOILER]')
-                
-
-                message = message_content.get_text(separator=' ', strip=True)
-                
-                # Добавляем информацию об аудио и изображениях в текст сообщения
-                if audio_links:
-                    message += "\n[Аудио от " + user + ": " + ", ".join(audio_links) + "]"
-                if image_links:
-                    message += "\n[Изображения от " + user + ": " + ", ".join(image_links) + "]"
-            else:
-                message = "Нет содержания."
-
-            # Извлечение ID сообщения
-            post_id = extract_post_id(str(post))
+    return build_thread_data(last_page, messages, page_count, pages_fetched, bot_config)
 
-            messages.append({
-                'id': post_id,
-                'author': user,
-                'content': message,
-                'audio_links': audio_links,  # Сохраняем ссылки в структуре сообщения
-                'image_links': image_links
-            })
-            logger.debug(f"Добавлено сообщение от {user} с ID {post_id}")
-
-        # Проверяем наличие следующей страницы
-        next_page = soup.find('a', class_='pageNav-jump--next')
-        if not next_page:
-            logger.debug(f"Следующая страница не найдена. Завершение парсинга на странице {page}.")
-            break
-
-        page += 1
+def thread_walk_finished(messages, page, last_known_id, bot_config):
+    """Нужно ли прекратить загрузку более ранних страниц треда (см. parse_thread)"""
+    if not messages:
+        logger.debug(f"Сообщения не найдены на странице {page}. Завершение парсинга.")
+        return True
+    if last_known_id and messages[-1]['id'] == last_known_id:
+        logger.debug(f"Последнее сообщение {last_known_id} уже обработано. Завершение парсинга на странице {page}.")
+        return True
+    return len(messages) >= bot_config.message_limit or page <= 1
 
-    logger.info(f"Тред '{title}' успешно спарсен. Всего страниц: {page}")
+def build_thread_data(last_page, messages, page_count, pages_fetched, bot_config):
+    """Сборка результата parse_thread из последней страницы треда и собранных сообщений"""
+    title = last_page['title']
+    creator = last_page['creator']
+    logger.debug(f"Заголовок треда: {title}, создатель: {creator}")
+    logger.info(f"Тред '{title}' успешно спарсен. Загружено страниц: {pages_fetched} из {page_count}")
     
     # Обрезаем сообщения до message_limit из конфигурации
     messages = messages[-bot_config.message_limit:]
@@ -636,61 +845,11 @@ def parse_thread(url, bot_config):
         'creator': creator,
         'messages': messages,
         'unique_audio_links': list(unique_audio_links),
-        'unique_image_links': list(unique_image_links)
+        'unique_image_links': list(unique_image_links),
+        'page_count': page_count,
+        'reply_form': last_page.get('reply_form')
     }
 
-def write_thread_to_file(thread_data, file_path="thread_output.txt", memory_file_path=".\\updated_memory.json"):
-    """
-    Записывает данные треда в указанный файл в формате Markdown, добавляя содержимое памяти в начале.
-    
-    Формат файла:
-    # Memory:
-    (содержимое файла updated_memory.json)
-    
-    # Title:
-    **Заголовок треда**
-    
-    # Creator:
-    *Создатель треда*
-    
-    # Messages:
-    **Автор:** Сообщение
-    ...
-    """
-    logger.info(f"Запись треда '{thread_data['title']}' в файл: {file_path}")
-    
-    # Чтение содержимого памяти
-    memory_content = read_memory(memory_file_path)
-    
-    try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            # Запись секции Memory
-            file.write("# Memory:\n")
-            file.write(f"{memory_content}\n\n")
-            
-            # Запись заголовка
-            file.write("# Title:\n")
-            file.write(f"**{thread_data['title']}**\n\n")
-            
-            # Запись создателя
-            file.write("# Creator:\n")
-            file.write(f"*{thread_data['creator']}*\n\n")
-            
-            # Запись сообщений
-            file.write("# Messages:\n")
-            for i, message in enumerate(thread_data['messages']):
-                author = message['author']
-                content = message['content']
-                # Добавляем метку [LAST MESSAGE] если это последнее сообщение
-                if i == len(thread_data['messages']) - 1:
-                    file.write(f"**{author}:** {content} [LAST MESSAGE]\n\n")
-                else:
-                    file.write(f"**{author}:** {content}\n\n")
-        logger.info(f"Тред '{thread_data['title']}' успешно записан в файл.")
-    except Exception as e:
-        logger.error(f"Ошибка при записи в файл {file_path}: {e}")
-        logger.error(traceback.format_exc())
-
 def send_to_openai(content):
     """
     Отправляет запрос к OpenAI API с переданным содержимым.
@@ -717,8 +876,29 @@ def send_to_openai(content):
         logger.error(traceback.format_exc())
         return None
 
-def send_to_genai(content, bot_config, max_retries=3, base_delay=5):
-    """Отправка запроса к Gemini API с использованием конфигурации"""
+def cached_request(content, prefix, bot_config):
+    """
+    Модель с кэшем контекста для начальной части запроса prefix и оставшаяся часть запроса.
+
+    Возвращает:
+        tuple: (модель, запрос без prefix) или (None, content), если кэш не используется
+    """
+    text = content[0] if isinstance(content, list) and content else content
+    if not prefix or not bot_config.context_caching or not isinstance(text, str) or not text.startswith(prefix):
+        return None, content
+    model = context_cache.model_for(prefix, bot_config.model.model_name, bot_config.current_key_index)
+    if model is None:
+        return None, content
+    rest = text[len(prefix):]
+    return model, ([rest] + content[1:] if isinstance(content, list) else rest)
+
+def send_to_genai(content, bot_config, max_retries=3, base_delay=5, prefix=None):
+    """
+    Отправка запроса к Gemini API с использованием конфигурации.
+
+    prefix - неизменная начальная часть запроса (prompt_builder.static_prefix()).
+    Если включен context_caching, она берётся из кэша контекста и повторно не отправляется.
+    """
     if isinstance(content, list):
         logger.info(f"Отправка списка в GenAI. Длина списка: {len(content)} элементов")
     else:
@@ -728,11 +908,21 @@ def send_to_genai(content, bot_config, max_retries=3, base_delay=5):
     
     for attempt in range(max_retries * len(bot_config.api_keys)):
         try:
-            response = bot_config.model.generate_content(
-                contents=current_content, 
-                generation_config=bot_config.generation_config
-            )
+            cached_model, request = cached_request(current_content, prefix, bot_config)
+            try:
+                response = (cached_model or bot_config.model).generate_content(
+                    contents=request, 
+                    generation_config=bot_config.generation_config
+                )
+            except Exception as e:
+                if cached_model is not None:
+                    context_cache.discard_if_missing(e, bot_config.model.model_name, bot_config.current_key_index)
+                raise
             logger.info("Важное: Получен ответ от Google Generative AI.")
+            usage = getattr(response, 'usage_metadata', None)
+            if usage:
+                # Фактический размер запроса для сравнения с оценкой PromptBudget
+                logger.info(f"Токены: запрос {usage.prompt_token_count}, ответ {usage.candidates_token_count}")
             return response.text
             
         except Exception as e:
@@ -752,13 +942,67 @@ def send_to_genai(content, bot_config, max_retries=3, base_delay=5):
                 logger.error("Все попытки и ключи исчерпаны.")
                 return None
 
-def handle_new_message(thread_id, genai_request=None, genai_model=None, forum_config=None):
+def get_forum_poster(forum_config):
+    """
+    Общий для всех тредов ForumPoster. Создаётся заново только при изменении
+    адреса форума или учётных данных; cookie сессии хранятся в FORUM_SESSION_FILE.
+    """
+    global forum_poster, forum_poster_key
+    key = (forum_config['forum_url'], forum_config['username'], forum_config['password'])
+    with forum_poster_lock:
+        if forum_poster is None or forum_poster_key != key:
+            forum_poster = ForumPoster(*key, cookie_path=FORUM_SESSION_FILE)
+            forum_poster_key = key
+        return forum_poster
+
+def share_forum_session(poster):
+    """
+    Загрузка страниц тредов с cookie авторизованной сессии poster (настройка
+    scrape_logged_in): форма ответа и её токен получаются вместе с сообщениями,
+    и ForumPoster не загружает тред повторно перед ответом.
+    """
+    session.cookies = poster.session.cookies
+    logger.info("Важное: Страницы тредов загружаются с авторизацией на форуме (scrape_logged_in)")
+
+def send_outbox_item(item):
+    """Отправка ответа из очереди через общий ForumPoster"""
+    if forum_poster is None:
+        logger.error("Не заданы данные для авторизации на форуме, ответ не отправлен")
+        return False
+    return forum_poster.reply_to_thread(item['thread_id'], item['message'], item['reply_form'])
+
+def record_sent_message(item):
+    """Добавление отправленного ответа в журнал sent_store и время ответа в thread_state"""
+    sent_store.append(item['thread_id'], item['message'])
+    thread_state.update(item['thread_id'], last_reply_at=time.time())
+
+def start_outbox_sender(bot_config):
+    """
+    Запуск потока отправки ответов из очереди с частотой из bot_config.
+    Вызывается при запуске бота; после stop_outbox_sender создаётся новый поток.
+    """
+    global outbox_sender
+    if outbox_sender is None:
+        outbox_sender = OutboxSender(outbox, send_outbox_item, record_sent_message,
+                                     bot_config.reply_rate_per_minute, bot_config.reply_burst)
+    outbox_sender.start()
+
+def stop_outbox_sender():
+    """Остановка потока отправки; неотправленные ответы остаются в очереди"""
+    global outbox_sender
+    if outbox_sender is not None:
+        outbox_sender.stop()
+        outbox_sender = None
+
+def handle_new_message(thread_id, thread_data, genai_request=None, genai_model=None, forum_config=None):
     """
-    Обрабатывает новое сообщение: читает необходимые файлы, отправляет запрос в выбранный API,
-    обновляет память и логирует изменения.
+    Обрабатывает новое сообщение: собирает запрос из треда, add_info.txt и памяти бота,
+    отправляет его в выбранный API, ставит ответ в очередь отправки и обновляет память.
     
     Args:
         thread_id: ID треда
+        thread_data: Результат parse_thread. Из него берутся сообщения, форма
+            ответа и ID последнего сообщения (ключ идемпотентности в очереди отправки)
         genai_request: Запрос для Gemini API (опционально)
         genai_model: Модель Gemini (опционально)
         forum_config: Словарь с настройками форума (опционально)
@@ -772,37 +1016,19 @@ def handle_new_message(thread_id, genai_request=None, genai_model=None, forum_co
     
     logger.info("Обнаружено новое сообщение. Начало обработки.")
     # time.sleep(20)
-    # Загрузка списка отправленных сообщений
-    sent_messages = load_sent_messages()
-    # Чтение содержимого add_info.txt
-    try:
-        with open('add_info.txt', 'r', encoding='utf-8') as f:
-            add_info = f.read()
-        logger.debug("Содержимое add_info.txt успешно прочитано.")
-    except Exception as e:
-        logger.error(f"Ошибка при чтении add_info.txt: {e}")
-        logger.error(traceback.format_exc())
-        add_info = ""
-    
-    # Чтение содержимого thread_output.txt
-    try:
-        with open('thread_output.txt', 'r', encoding='utf-8') as f:
-            thread_output = f.read()
-        logger.debug("Содержимое thread_output.txt успешно прочитано.")
-    except Exception as e:
-        logger.error(f"Ошибка при чтении thread_output.txt: {e}")
-        logger.error(traceback.format_exc())
-        thread_output = ""
-    
-    # Объединение содержимого
-    combined_content = f"{add_info}\n\n{thread_output}"
-    logger.debug("Содержимое add_info.txt и thread_output.txt объединено.")
+    # Недавние ответы в этом и других тредах (см. SentMessageStore.relevant)
+    sent_messages = sent_store.relevant(thread_id)
+    # Объединение add_info.txt и треда с памятью бота в пределах бюджета токенов
+    combined_content, thread_output = prompt_builder.build(thread_data, genai_request or [])
+    # Запрос собирается в памяти; файл нужен только для просмотра в GUI
+    if genai_model is not None and genai_model.write_thread_output:
+        publish_thread_output(thread_output)
     if genai_request:
         # Используем переданную модель
-        genai_response = send_to_genai([combined_content] + genai_request, genai_model)
+        genai_response = send_to_genai([combined_content] + genai_request, genai_model, prefix=prompt_builder.static_prefix())
     else:
         # Используем переданную модель
-        genai_response = send_to_genai(combined_content, genai_model)
+        genai_response = send_to_genai(combined_content, genai_model, prefix=prompt_builder.static_prefix())
     response_content = genai_response
     if response_content:
         # Проверяем, является ли ответ допустимым JSON
@@ -818,52 +1044,20 @@ def handle_new_message(thread_id, genai_request=None, genai_model=None, forum_co
         reply_message = openai_data.get("message")
         
         if reply_message and is_message_valid(reply_message):
-            if not is_duplicate(reply_message, sent_messages):
-                # Отправка сообщения на форум
-                poster = ForumPoster(forum_config['forum_url'], 
-                                   forum_config['username'], 
-                                   forum_config['password'])
-                if poster.login():
-                    success = poster.reply_to_thread(thread_id, reply_message)
-                    if success:
-                        logger.info("Важное: Сообщение успешно отправлено на форум.")
-                        sent_messages.append(reply_message)
-                        save_sent_messages(sent_messages)
-                        # Увеличиваем счетчик сообщений, если необходимо
-                    else:
-                        logger.error("Не удалось отправить сообщение на форум.")
-                    # time.sleep(30)
-                else:
-                    logger.error("Авторизация не удалась. Сообщение не было отправлено.")
+            # Ответы, ещё ожидающие отправки, тоже учитываются при проверке на дубликаты
+            if not is_duplicate(reply_message, sent_messages + outbox.pending_messages()):
+                # Отправка выполняется потоком outbox_sender, ожидать форум не нужно
+                get_forum_poster(forum_config)
+                outbox.enqueue(thread_id, thread_data['messages'][-1]['id'], reply_message, thread_data.get('reply_form'))
             else:
                 logger.info("Важное: Сообщение дубликат. Отправка не выполнена.")
         else:
             print(openai_data)
             logger.info("Важное: Сообщение отсутствует или не прошло проверку корректности.")
         
-        # Сохранение ответа в new_memory.json
+        # Обновление памяти ответом модели
         if "need_comment" in openai_data:
-            try:
-                with open('new_memory.json', 'w', encoding='utf-8') as f:
-                    json.dump(openai_data, f, ensure_ascii=False, indent=2)
-                logger.info("Ответ от модели сохранён в new_memory.json.")
-            except Exception as e:
-                logger.error(f"Ошибка при сохранении new_memory.json: {e}")
-                logger.error(traceback.format_exc())
-            
-            # Копирование updated_memory.json в old_memory.json
-            try:
-                if os.path.exists('updated_memory.json'):
-                    os.replace('updated_memory.json', 'old_memory.json')
-                    logger.debug("Файл updated_memory.json скопирован в old_memory.json.")
-                else:
-                    logger.warning("Файл updated_memory.json не найден для копирования.")
-            except Exception as e:
-                logger.error(f"Ошибка при копировани�� айла памяти: {e}")
-                logger.error(traceback.format_exc())
-            
-            # Обновление памяти с помощью функции из json_pool.py
-            message = update_memory('old_memory.json', 'new_memory.json', 'updated_memory.json')
+            message = prompt_builder.update_memory(openai_data)
             if message:
                 logger.info(f"Сообщение для отправки: {message}")
                 print(f"Сообщение для отправки: {message}")
@@ -871,35 +1065,57 @@ def handle_new_message(thread_id, genai_request=None, genai_model=None, forum_co
             # Логирование обновлений памяти отдельно
             memory_logger = logging.getLogger('memory')
             memory_logger.addHandler(memory_file_handler)
-            memory_logger.info(f"Updated Memory:\n{read_memory('updated_memory.json')}")
+            memory_logger.info(f"Updated Memory:\n{prompt_builder.memory_text()}")
             memory_logger.removeHandler(memory_file_handler)
     else:
         logger.warning("Не удалось получить ответ от модели.")
 
-def download_image(url, filename):
+def record_image_download(url, filename):
+    logger.info(f"Изображение успешно скачано: {filename}")
+    print(f"Изображение успешно скачано: {filename}", url)
+    media_cache.put(url, filename)
+
+def download_image(url, filename, cancel=None):
     """
     Скачивает изображение по указанному URL и сохраняет его под заданным именем.
+    cancel - событие отмены скачивания (опционально).
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
+    if media_cache.copy_to(url, filename):
+        return True
+    
     try:
-        response = session.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        logger.info(f"Изображение успешно скачано: {filename}")
-        print(f"Изображение успешно скачано: {filename}", url)
+        if not downloader.download(session, url, filename, IMAGE_HEADERS, IMAGE_CONTENT_TYPES, cancel=cancel):
+            return False
+        record_image_download(url, filename)
         return True
     except Exception as e:
         logger.error(f"Ошибка при скачивании изображения {url}: {e}")
         return False
 
-def safe_upload_file(file_path, max_retries=3, delay=2):
-    """Безопасная загрузка файла с повторными попытками"""
+def safe_upload_file(file_path, max_retries=3, delay=2, api_key=None):
+    """
+    Безопасная загрузка файла с повторными попытками.
+    
+    Если файл с тем же содержимым уже загружен с этим API ключом и срок его
+    хранения не истёк, возвращается существующий объект файла без загрузки.
+    """
+    try:
+        digest = file_sha256(file_path)
+    except OSError as e:
+        logger.error(f"Не удалось прочитать файл {file_path}: {e}")
+        return None
+    
+    cached_file = upload_cache.get(digest, api_key, genai.get_file)
+    if cached_file is not None:
+        upload_cache.remember_source(cached_file.name, file_path)
+        logger.info(f"Файл {file_path} уже загружен как {cached_file.name}, повторная загрузка не требуется")
+        return cached_file
+    
     for attempt in range(max_retries):
         try:
-            return genai.upload_file(file_path)
+            uploaded_file = genai.upload_file(file_path)
+            upload_cache.put(digest, api_key, uploaded_file, file_path)
+            return uploaded_file
         except Exception as e:
             logger.error(f"Попытка {attempt + 1}/{max_retries} загрузки файла {file_path} не удалась: {e}")
             if attempt < max_retries - 1:
@@ -908,143 +1124,202 @@ def safe_upload_file(file_path, max_retries=3, delay=2):
                 logger.error(f"Не удалось загрузить файл {file_path} после {max_retries} попыток")
                 return None
 
-def cleanup_temp_files(file_patterns=None):
-    """Очистка временных файлов по заданным шаблонам"""
-    if file_patterns is None:
-        file_patterns = ['audio_*.mp3', 'image_*.*']
+def is_thread_unchanged(thread_info):
+    """Проверка, совпадает ли отпечаток активности треда из списка с сохранённым в thread_state"""
+    fingerprint = thread_info.get('fingerprint')
+    state = thread_state.get(thread_info.get('thread_id'))
+    if not fingerprint or not state or state['handled_at'] is None:
+        return False
+    return state['fingerprint'] == fingerprint
+
+def known_page_count(thread_id, thread_info=None):
+    """Количество страниц треда из списка тредов или из сохранённого состояния"""
+    if thread_info and thread_info.get('page_count'):
+        return thread_info['page_count']
+    state = thread_state.get(thread_id) if thread_id else None
+    return state['page_count'] if state else None
+
+def detect_new_message(thread_url, last_ids, bot_config, thread_info=None):
+    """
+    Загрузка треда и проверка наличия нового сообщения. Состояние last_ids не изменяется.
     
-    logger.debug("Начало очистки временных файлов")
+    Возвращает словарь с ключами 'thread_id', 'thread_data', 'latest_id' и
+    'is_new' (требуется ли ответ) или None, если тред не удалось разобрать.
+    """
+    logger.info(f"Проверка новых сообщений для треда: {thread_url}")
+    thread_id = extract_thread_id(thread_url)
+    page_count = known_page_count(thread_id, thread_info)
+    thread_data = parse_thread(thread_url, bot_config, page_count, last_ids.get(thread_id))
+    return classify_thread_data(thread_url, thread_id, thread_data, last_ids)
+
+def classify_thread_data(thread_url, thread_id, thread_data, last_ids):
+    """Проверка разобранного треда на новое сообщение (см. detect_new_message)"""
+    if not thread_data:
+        logger.warning(f"Важное: Не удалось получить данные треда {thread_url}. Возможно, он недоступен.")
+        return None
+
+    messages = thread_data['messages']
+    if not messages:
+        logger.warning(f"Важное: Сообщения в треде {thread_url} не найдены.")
+        return None
+
+    if not thread_id:
+        logger.warning(f"Важное: Не удалось извлечь идентификатор треда из URL: {thread_url}")
+        return None
+
+    latest_message = messages[-1]
+    latest_id = latest_message['id']
+    is_new = False
+
+    if thread_id in last_ids:
+        if latest_id and latest_id != last_ids[thread_id]:
+            if latest_message['author'] != "AI_Vocal_Bot":
+                print(f"**Новое сообщение в треде '{thread_data['title']}' от {latest_message['author']}:**\n{latest_message['content']}\n")
+                logger.info(f"Найдено новое сообщение в треде '{thread_data['title']}' от {latest_message['author']}")
+                is_new = True
+    else:
+        print(f"**Новый тред '{thread_data['title']}' от {thread_data['creator']}:**\n{latest_message['content']}\n")
+        logger.info(f"Обнаружен новый тред '{thread_data['title']}' от {thread_data['creator']}")
+        is_new = True
+
+    return {
+        'thread_id': thread_id,
+        'thread_data': thread_data,
+        'latest_id': latest_id,
+        'is_new': is_new
+    }
+
+def apply_detection(detection, thread_info=None):
+    """
+    Сохранение результата detect_new_message в thread_state (сразу фиксируется в базе).
+
+    Для нового сообщения сохраняется только количество страниц: ID сообщения
+    и отпечаток активности сохраняются после постановки ответа в очередь
+    (см. mark_thread_handled), поэтому после аварийного завершения сообщение
+    обрабатывается заново, а очередь отправки не допускает второго ответа.
+    """
+    fields = {'page_count': detection['thread_data']['page_count']}
+    if not detection['is_new'] and thread_info and thread_info.get('fingerprint'):
+        fields['fingerprint'] = thread_info['fingerprint']
+    thread_state.update(detection['thread_id'], **fields)
+
+def mark_thread_handled(detection, thread_info=None):
+    """Сохранение в thread_state обработанного нового сообщения (см. apply_detection)"""
+    fields = {'last_post_id': detection['latest_id'], 'handled_at': time.time()}
+    if thread_info and thread_info.get('fingerprint'):
+        fields['fingerprint'] = thread_info['fingerprint']
+    thread_state.update(detection['thread_id'], **fields)
+
+def publish_thread_output(thread_output, file_path="thread_output.txt"):
+    """Запись отладочной копии thread_output.txt в рабочий каталог для просмотра в GUI"""
     try:
-        for pattern in file_patterns:
-            for file_path in glob.glob(pattern):
-                try:
-                    os.remove(file_path)
-                    logger.debug(f"Удален временный файл: {file_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении файла {file_path}: {e}")
-        logger.info("Очистка временных файлов завершена")
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(thread_output)
+        os.replace(tmp_path, file_path)
     except Exception as e:
-        logger.error(f"Ошибка при очистке временных файлов: {e}")
+        logger.error(f"Ошибка при записи {file_path}: {e}")
+
+def media_host(url):
+    """Группа хоста медиафайла для ограничения одновременных загрузок"""
+    if 'vocaroo.com' in url or 'voca.ro' in url:
+        return 'vocaroo'
+    if 'smule.com' in url:
+        return 'smule'
+    if 'musforums.ru' in url:
+        return 'musforums'
+    return 'other'
+
+def acquire_host_slot(semaphore, cancel, poll_interval=0.5):
+    """Ожидание свободного места в ограничении хоста. Возвращает False, если задача отменена"""
+    while not semaphore.acquire(timeout=poll_interval):
+        if cancel.is_set():
+            return False
+    return True
 
-def check_new_messages(thread_url, last_ids, bot_config):
-    """Проверка новых сообщений с использованием конфигурации"""
+def prepare_media_item(link, filename, media_id, download, api_key, cancel):
+    """
+    Скачивание и загрузка в Gemini одного медиафайла. Возвращает [media_id, файл] или None.
+    После установки события cancel задача завершается при первой возможности.
+    """
+    semaphore = media_host_semaphores.get(media_host(link), media_host_semaphores['other'])
+    if not acquire_host_slot(semaphore, cancel):
+        return None
+    try:
+        if cancel.is_set() or not download(link, filename, cancel):
+            return None
+    finally:
+        semaphore.release()
+    if cancel.is_set():
+        return None
+    uploaded_file = safe_upload_file(filename, api_key=api_key)
+    if uploaded_file is None:
+        logger.warning(f"Пропуск файла {filename} из-за ошибки загрузки")
+        return None
+    return [media_id, uploaded_file]
+
+def prepare_media(thread_data, workspace, bot_config):
+    """
+    Параллельное скачивание и загрузка в Gemini медиафайлов треда.
+    
+    Возвращает список [media_id, файл, media_id, файл, ...] в том же порядке,
+    что и последовательная обработка: сначала аудио, затем изображения.
+    Файлы, не подготовленные за bot_config.media_deadline секунд, пропускаются:
+    их задачи отменяются, и функция дожидается их завершения, чтобы рабочий
+    каталог удалялся только после того, как в него никто не пишет.
+    """
+    api_key = bot_config.api_keys[bot_config.current_key_index] if bot_config.api_keys else None
+    jobs = []
+    for i, audio_link in enumerate(thread_data['unique_audio_links']):
+        jobs.append((audio_link, workspace.file(f'audio_{i+1}.mp3'), f'audio_{i+1}.mp3: {audio_link}', download_audio))
+    for i, image_link in enumerate(thread_data['unique_image_links']):
+        jobs.append((image_link, workspace.file(f'image_{i+1}.{image_link.split(".")[-1]}'), f'image_{i+1}: {image_link}', download_image))
+    if not jobs:
+        return []
+    
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=bot_config.media_workers, thread_name_prefix='media')
     try:
-        logger.info(f"Проверка новых сообщений для треда: {thread_url}")
-        thread_data = parse_thread(thread_url, bot_config)
+        futures = [executor.submit(prepare_media_item, *job, api_key, cancel) for job in jobs]
+        done, not_done = wait(futures, timeout=bot_config.media_deadline)
+        if not_done:
+            logger.warning(f"Важное: {len(not_done)} из {len(jobs)} медиафайлов не подготовлены за {bot_config.media_deadline} сек. и будут пропущены")
         
-        if not thread_data:
-            logger.warning(f"Важное: Не удалось получить данные треда {thread_url}. Возможно, он недоступен.")
-            return last_ids
-
-        messages = thread_data['messages']
-        if not messages:
-            logger.warning(f"Важное: Сообщения в треде {thread_url} не найдены.")
-            return last_ids
-
-        thread_id = extract_thread_id(thread_url)
-        if not thread_id:
-            logger.warning(f"Важное: Не удалось извлечь идентификатор треда из URL: {thread_url}")
-            return last_ids
-
-        latest_message = messages[-1]
-        latest_id = latest_message['id']
-
-        if thread_id in last_ids:
-            if latest_id and latest_id != last_ids[thread_id]:
-                if latest_message['author'] != "AI_Vocal_Bot":
-                    print(f"**Новое сообщение в треде '{thread_data['title']}' от {latest_message['author']}:**\n{latest_message['content']}\n")
-                    logger.info(f"Найдено новое сообщение в треде '{thread_data['title']}' от {latest_message['author']}")
-                    
-                    last_ids[thread_id] = latest_id
-                    write_thread_to_file(thread_data, "thread_output.txt", ".\\updated_memory.json")
-                    
-                    media_files = []
-                    media_ids = []
-                    
-                    try:
-                        for i, audio_link in enumerate(thread_data['unique_audio_links']):
-                            audio_filename = f'audio_{i+1}.mp3'
-                            if download_audio(audio_link, audio_filename):
-                                media_files.append(audio_filename)
-                                media_ids.append(f'audio_{i+1}.mp3: {audio_link}')
-                        
-                        for i, image_link in enumerate(thread_data['unique_image_links']):
-                            image_filename = f'image_{i+1}.{image_link.split(".")[-1]}'
-                            if download_image(image_link, image_filename):
-                                media_files.append(image_filename)
-                                media_ids.append(f'image_{i+1}: {image_link}')
-                        
-                        genai_request = []
-                        for i, media_file in enumerate(media_files):
-                            uploaded_file = safe_upload_file(media_file)
-                            if uploaded_file is not None:
-                                genai_request.extend([media_ids[i], uploaded_file])
-                            else:
-                                logger.warning(f"Пропуск файла {media_file} из-за ошибки загрузки")
-                        
-                        if genai_request:
-                            handle_new_message(thread_id, genai_request, bot_config, {
-                                'forum_url': bot_config.forum_url,
-                                'username': bot_config.username,
-                                'password': bot_config.password
-                            })
-                        else:
-                            handle_new_message(thread_id, None, bot_config, {
-                                'forum_url': bot_config.forum_url,
-                                'username': bot_config.username,
-                                'password': bot_config.password
-                            })
-                    finally:
-                        # Очистка временных файлов после обработки
-                        cleanup_temp_files()
-        else:
-            print(f"**Новый тред '{thread_data['title']}' от {thread_data['creator']}:**\n{latest_message['content']}\n")
-            logger.info(f"Обнаружен новый тред '{thread_data['title']}' от {thread_data['creator']}")
-            
-            last_ids[thread_id] = latest_id
-            write_thread_to_file(thread_data, "thread_output.txt", ".\\updated_memory.json")
-            
-            media_files = []
-            media_ids = []
-            
+        genai_request = []
+        for future in futures:
+            if future not in done:
+                continue
             try:
-                for i, audio_link in enumerate(thread_data['unique_audio_links']):
-                    audio_filename = f'audio_{i+1}.mp3'
-                    if download_audio(audio_link, audio_filename):
-                        media_files.append(audio_filename)
-                        media_ids.append(f'audio_{i+1}.mp3: {audio_link}')
-                
-                for i, image_link in enumerate(thread_data['unique_image_links']):
-                    image_filename = f'image_{i+1}.{image_link.split(".")[-1]}'
-                    if download_image(image_link, image_filename):
-                        media_files.append(image_filename)
-                        media_ids.append(f'image_{i+1}: {image_link}')
-                
-                genai_request = []
-                for i, media_file in enumerate(media_files):
-                    uploaded_file = safe_upload_file(media_file)
-                    if uploaded_file is not None:
-                        genai_request.extend([media_ids[i], uploaded_file])
-                    else:
-                        logger.warning(f"Пропуск файла {media_file} из-за ошибки загрузки")
-                
-                if genai_request:
-                    handle_new_message(thread_id, genai_request, bot_config, {
-                        'forum_url': bot_config.forum_url,
-                        'username': bot_config.username,
-                        'password': bot_config.password
-                    })
-                else:
-                    handle_new_message(thread_id, None, bot_config, {
-                        'forum_url': bot_config.forum_url,
-                        'username': bot_config.username,
-                        'password': bot_config.password
-                    })
-            finally:
-                # Очистка временных файлов после обработки
-                cleanup_temp_files()
-    except Exception as e:
-        logger.error(f"Ошибка при проверке новых сообщений: {e}")
-        cleanup_temp_files()  # Очистка в случае ошибки
-    
-    return last_ids
\ No newline at end of file
+                item = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке медиафайла: {e}")
+                continue
+            if item:
+                genai_request.extend(item)
+        return genai_request
+    finally:
+        cancel.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def process_new_message(thread_id, thread_data, bot_config):
+    """
+    Подготовка медиафайлов, запрос к модели и постановка ответа в очередь для нового сообщения.
+
+    Возвращает:
+        bool: True, если сообщение обработано (ответ поставлен в очередь или не требуется)
+    """
+    # Все файлы задачи создаются в отдельном каталоге и удаляются вместе с ним
+    with JobWorkspace(f"thread_{thread_id}", bot_config.workspace_dir) as workspace:
+        try:
+            genai_request = prepare_media(thread_data, workspace, bot_config)
+            # Ответ ставится в очередь; отправляет его поток, запущенный start_outbox_sender
+            handle_new_message(thread_id, thread_data, genai_request or None, bot_config, {
+                'forum_url': bot_config.forum_url,
+                'username': bot_config.username,
+                'password': bot_config.password
+            })
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обработке нового сообщения в треде {thread_id}: {e}")
+            logger.error(traceback.format_exc())
+            return False
@@ -5,7 +5,7 @@ from google.generativeai import GenerationConfig
 from PyQt6.QtWidgets import *
 from PyQt6.QtCore import *
 from PyQt6.QtGui import *
-from bot import BotConfig
+from bot import BotConfig, configure_runtime
 # Настройка логирования
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -27,7 +27,8 @@ logger.addHandler(file_handler)
 import sys
 import json
 import logging
-from bot import check_new_messages, list_threads, load_last_id, save_last_id
+from bot import list_threads, start_outbox_sender, stop_outbox_sender, asset_cache
+from thread_scheduler import ThreadScheduler
 import os
 from functools import partial
 
@@ -100,6 +101,7 @@ class BotWorker(QThread):
         self.running = True
         self.paused = False
         self.bot_config = BotConfig(config)  # Создаем объект конфигурации бота
+        configure_runtime(config, self.bot_config)  # Настройка кэшей, очередей и хранилищ бота
         
     def pause(self):
         """Приостановка/возобновление работы бота"""
@@ -110,8 +112,11 @@ class BotWorker(QThread):
         return self.paused
         
     def run(self):
+        scheduler = None
         try:
-            last_ids = load_last_id(self.config['STATE_FILE'])
+            # Состояние тредов сохраняется в bot.thread_state сразу после проверки каждого треда
+            scheduler = ThreadScheduler(self.bot_config)
+            start_outbox_sender(self.bot_config)
             
             while self.running:
                 if not self.paused:
@@ -119,19 +124,12 @@ class BotWorker(QThread):
                         threads = list_threads(self.config['forum_url'])
                         if threads:
                             self.status_updated.emit(f"Проверка {len(threads)} тредов...")
-                            for thread_url in threads:
-                                if not self.running or self.paused:
-                                    break
-                                # Передаем объект конфигурации бота
-                                last_ids = check_new_messages(
-                                    thread_url, 
-                                    last_ids, 
-                                    self.bot_config
-                                )
+                            # Треды без новой активности по данным списка не открываются,
+                            # остальные проверяются параллельно
+                            checked = scheduler.run_cycle(threads, lambda: not self.running or self.paused)
+                            for thread_url in checked:
                                 self.message_received.emit(f"Проверен тред: {thread_url}")
                         
-                        save_last_id(self.config['STATE_FILE'], last_ids)
-                        
                     except Exception as e:
                         logger.error(f"Ошибка: {str(e)}", exc_info=True)
                         self.message_received.emit(f"Ошибка: {str(e)}")
@@ -145,6 +143,9 @@ class BotWorker(QThread):
             logger.error(f"Критическая ошибка в потоке бота: {str(e)}", exc_info=True)
             self.message_received.emit(f"Критическая ошибка: {str(e)}")
         finally:
+            if scheduler:
+                scheduler.shutdown()
+            stop_outbox_sender()
             logger.info("Поток бота завершен")
 
     def stop(self):
@@ -414,6 +415,7 @@ class JsonTreeWidget(QTreeWidget):
             try:
                 with open('updated_memory.json', 'w', encoding='utf-8') as f:
                     json.dump(base_memory, f, ensure_ascii=False, indent=2)
+                asset_cache.invalidate('updated_memory.json')
                 QMessageBox.information(self, "Успех", "Память успешно сброшена к базовому состоянию")
             except Exception as e:
                 QMessageBox.critical(self, "Ошибка", f"Ошибка при сохранении файла: {str(e)}")
@@ -684,6 +686,8 @@ class BotGUI(QMainWindow):
             
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(content)
+            # Бот сразу использует новое содержимое файла
+            asset_cache.invalidate(file_path)
             QMessageBox.information(self, "Успех", f"Файл {file_path} успешно сохранен")
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Ошибка при сохранении файла: {str(e)}")
@@ -820,6 +824,7 @@ class BotGUI(QMainWindow):
             formatted_content = json.dumps(content, ensure_ascii=False, indent=2)
             with open('updated_memory.json', 'w', encoding='utf-8') as f:
                 f.write(formatted_content)
+            asset_cache.invalidate('updated_memory.json')
             QMessageBox.information(self, "Успех", "Файл updated_memory.json успешно сохранен")
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Ошибка при сохранении файла: {str(e)}")
@@ -834,6 +839,9 @@ class BotGUI(QMainWindow):
             'check_interval': 5,
             'STATE_FILE': "last_id.json",
             'API_KEYS': [],
+            'fetch_workers': 4,
+            'process_workers': 2,
+            'async_fetch': True,
         }
         
         try:
@@ -864,8 +872,10 @@ class BotGUI(QMainWindow):
 
     def save_settings(self):
         """Сохранение настроек при изменении любого поля"""
-        # Создаем копию конфига без объекта модели
-        config_to_save = {
+        # Создаем копию конфига без объекта модели, сохраняя дополнительные параметры
+        config_to_save = {k: v for k, v in self.config.items()
+                          if not isinstance(v, (GenerationConfig, genai.GenerativeModel))}
+        config_to_save.update({
             'forum_url': self.forum_url_edit.text(),
             'username': self.username_edit.text(),
             'password': self.password_edit.text(),
@@ -880,7 +890,7 @@ class BotGUI(QMainWindow):
                 "top_k": int(self.top_k_spin.value()),
                 "max_output_tokens": int(self.max_tokens_spin.value())
             }
-        }
+        })
         
         # Обновляем текущий конфиг, исключая объекты, которые нельзя сериализовать
         self.config.update({k: v for k, v in config_to_save.items() 
@@ -0,0 +1,116 @@
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class BrowserPool:
+    """
+    Пул долгоживущих браузеров Selenium.
+
+    Браузеры создаются по мере необходимости (не больше size), проверяются перед
+    выдачей и пересоздаются после max_pages загруженных страниц или после ошибки.
+    """
+    def __init__(self, driver_factory, size=1, max_pages=20, acquire_timeout=300):
+        """
+        Параметры:
+            driver_factory (callable): Создание нового экземпляра webdriver
+            size (int): Максимальное количество браузеров
+            max_pages (int): Количество страниц, после которого браузер пересоздаётся
+            acquire_timeout (int): Время ожидания свободного браузера в секундах
+        """
+        self.driver_factory = driver_factory
+        self.size = size
+        self.max_pages = max_pages
+        self.acquire_timeout = acquire_timeout
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.page_counts = {}
+
+    @contextmanager
+    def driver(self):
+        """Выдача браузера на время блока with. При исключении в блоке браузер закрывается"""
+        driver = self._acquire()
+        try:
+            yield driver
+        except Exception:
+            self._discard(driver)
+            raise
+        else:
+            self._release(driver)
+
+    def close(self):
+        """Закрытие всех свободных браузеров"""
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(driver)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            driver = self._take_idle_or_create()
+            if driver is None:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Нет свободного браузера в пуле")
+                continue
+
+            if self._is_healthy(driver):
+                self.page_counts[id(driver)] = self.page_counts.get(id(driver), 0) + 1
+                return driver
+            logger.warning("Браузер из пула не отвечает и будет пересоздан")
+            self._discard(driver)
+
+    def _take_idle_or_create(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            # Ждём освобождения браузера, периодически проверяя возможность создать новый
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                return None
+        try:
+            driver = self.driver_factory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+        self.page_counts[id(driver)] = 0
+        logger.info("Запущен новый браузер для пула")
+        return driver
+
+    def _release(self, driver):
+        if self.page_counts.get(id(driver), 0) >= self.max_pages:
+            logger.info(f"Браузер обработал {self.max_pages} страниц и будет пересоздан")
+            self._discard(driver)
+        else:
+            self.idle.put(driver)
+
+    def _discard(self, driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.debug(f"Ошибка при закрытии браузера: {e}")
+        self.page_counts.pop(id(driver), None)
+        with self.lock:
+            self.created -= 1
+
+    @staticmethod
+    def _is_healthy(driver):
+        try:
+            driver.execute_script("return 1")
+            return True
+        except Exception:
+            return False
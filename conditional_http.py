@@ -0,0 +1,125 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def accept_encoding():
+    """
+    Значение Accept-Encoding, которое сессия действительно может распаковать.
+
+    gzip и deflate urllib3 распаковывает всегда, br - только если установлен
+    пакет brotli или brotlicffi. Без него сжатый br ответ пришёл бы как есть.
+    """
+    encodings = ['gzip', 'deflate']
+    for module_name in ('brotli', 'brotlicffi'):
+        try:
+            __import__(module_name)
+        except ImportError:
+            continue
+        encodings.append('br')
+        break
+    return ', '.join(encodings)
+
+class ConditionalFetcher:
+    """
+    Условные GET-запросы с кэшем результатов разбора.
+
+    Для каждого URL запоминаются ETag/Last-Modified и результат функции
+    разбора. Следующий запрос отправляется с If-None-Match/If-Modified-Since;
+    при ответе 304 (или при том же валидаторе в ответе 200) возвращается
+    сохранённый результат, и страница повторно не разбирается.
+    Результаты из кэша общие для всех вызывающих и не должны изменяться.
+    """
+    def __init__(self, max_entries=256):
+        """
+        Параметры:
+            max_entries (int): Количество URL, для которых хранятся результаты
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+
+    def fetch(self, http_session, url, parse, headers=None, timeout=15):
+        """
+        Загрузка и разбор страницы.
+
+        Параметры:
+            http_session (requests.Session): Сессия для запроса
+            url (str): Адрес страницы
+            parse (callable): Разбор тела ответа (bytes) в результат
+            headers (dict): Заголовки запроса
+            timeout (int): Таймаут запроса в секундах
+
+        Возвращает:
+            tuple: (результат разбора, True если результат взят из кэша)
+
+        Ошибки запроса (requests.exceptions.RequestException) передаются вызывающему.
+        """
+        entry, request_headers = self.prepare(url, headers)
+        response = http_session.get(url, headers=request_headers, timeout=timeout)
+        hit, result = self.cached_result(url, entry, response.status_code, response.headers)
+        if hit:
+            return result, True
+        response.raise_for_status()
+
+        result = parse(response.content)
+        self.store(url, response.headers, result)
+        return result, False
+
+    def prepare(self, url, headers=None):
+        """
+        Сохранённая запись для url и заголовки запроса с валидаторами.
+
+        Возвращает:
+            tuple: (запись или None, dict заголовков)
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        request_headers = dict(headers or {})
+        if entry:
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        return entry, request_headers
+
+    def cached_result(self, url, entry, status_code, response_headers):
+        """
+        Проверка ответа: не изменилась ли страница.
+
+        Возвращает:
+            tuple: (True, сохранённый результат) или (False, None), если страницу нужно разобрать
+        """
+        if not entry:
+            return False, None
+        if status_code == 304:
+            logger.debug(f"Страница не изменилась (304): {url}")
+            return True, self._hit(url, entry)
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if status_code == 200 and (etag or last_modified) and (etag, last_modified) == (entry['etag'], entry['last_modified']):
+            logger.debug(f"Валидатор страницы не изменился, разбор пропущен: {url}")
+            return True, self._hit(url, entry)
+        return False, None
+
+    def store(self, url, response_headers, result):
+        """Сохранение результата разбора под валидаторами ответа"""
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        with self.lock:
+            if etag or last_modified:
+                self.entries[url] = {'etag': etag, 'last_modified': last_modified, 'result': result}
+                self.entries.move_to_end(url)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.pop(url, None)
+
+    def _hit(self, url, entry):
+        with self.lock:
+            self.hits += 1
+            if url in self.entries:
+                self.entries.move_to_end(url)
+        return entry['result']
@@ -0,0 +1,214 @@
+import time
+import hashlib
+import logging
+import datetime
+import threading
+
+from memory_slicer import approx_tokens
+
+logger = logging.getLogger(__name__)
+
+class GeminiCacheBackend:
+    """Кэш контекста Gemini (google.generativeai.caching.CachedContent)"""
+    def create(self, model_name, contents, ttl):
+        """
+        Создание кэша.
+
+        Возвращает:
+            Объект кэша (передаётся в refresh, delete и model_for)
+        """
+        from google.generativeai import caching
+        return caching.CachedContent.create(
+            model=model_name,
+            display_name="vocal-bot-prefix",
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl)
+        )
+
+    def refresh(self, cached, ttl):
+        cached.update(ttl=datetime.timedelta(seconds=ttl))
+
+    def delete(self, cached):
+        cached.delete()
+
+    def model_for(self, cached):
+        """Модель, отправляющая запросы с содержимым кэша в начале"""
+        import google.generativeai as genai
+        return genai.GenerativeModel.from_cached_content(cached_content=cached)
+
+    def is_missing(self, error):
+        """Ошибка запроса означает, что кэша больше нет на сервере (истёк или удалён)"""
+        from google.api_core import exceptions
+        if isinstance(error, exceptions.NotFound):
+            return True
+        message = str(error).lower()
+        return 'cachedcontent' in message and 'not found' in message
+
+class FakeCacheBackend:
+    """
+    Локальная замена GeminiCacheBackend для проверки без сети.
+
+    Кэши хранятся в словаре created; model_for возвращает модель, которая
+    записывает в requests полный запрос (содержимое кэша и переданная часть)
+    и отвечает response_text. expire() имитирует истечение кэша на сервере:
+    запрос к модели этого кэша завершается KeyError.
+    """
+    def __init__(self, response_text='```json\n{"need_comment": false}\n```'):
+        self.response_text = response_text
+        self.created = {}
+        self.requests = []
+        self.counter = 0
+
+    def create(self, model_name, contents, ttl):
+        self.counter += 1
+        name = f"cachedContents/fake-{self.counter}"
+        self.created[name] = {'model': model_name, 'contents': contents, 'ttl': ttl}
+        return name
+
+    def refresh(self, cached, ttl):
+        if cached not in self.created:
+            raise KeyError(f"Кэш {cached} не найден")
+        self.created[cached]['ttl'] = ttl
+
+    def delete(self, cached):
+        self.created.pop(cached, None)
+
+    def expire(self, cached):
+        self.created.pop(cached, None)
+
+    def is_missing(self, error):
+        return isinstance(error, KeyError)
+
+    def model_for(self, cached):
+        backend = self
+
+        class FakeResponse:
+            text = backend.response_text
+            usage_metadata = None
+
+        class FakeModel:
+            def generate_content(self, contents, generation_config=None):
+                if cached not in backend.created:
+                    raise KeyError(f"Кэш {cached} не найден")
+                prefix = backend.created[cached]['contents']
+                backend.requests.append(list(prefix) + (contents if isinstance(contents, list) else [contents]))
+                return FakeResponse()
+
+        return FakeModel()
+
+class ContextCache:
+    """
+    Повторное использование кэша контекста Gemini для неизменной начальной
+    части запроса (add_info.txt).
+
+    Кэш создаётся для пары (модель, API ключ) и ключа - SHA-256 начальной
+    части, поэтому изменение add_info.txt или смена модели приводит к созданию
+    нового кэша, а прежний удаляется. Время жизни продлевается, когда до
+    истечения остаётся меньше refresh_margin секунд. Если начальная часть
+    меньше min_tokens (минимальный размер кэша у модели) или кэш не удалось
+    создать, возвращается None и запрос отправляется целиком.
+
+    Размер начальной части оценивается локально, без запроса count_tokens:
+    если оценка ошиблась, сервер отклонит создание кэша и повторная попытка
+    для той же начальной части будет не раньше чем через ttl.
+    """
+    def __init__(self, backend=None, ttl=3600, refresh_margin=300, min_tokens=32768, count_tokens=approx_tokens):
+        """
+        Параметры:
+            backend: GeminiCacheBackend или FakeCacheBackend
+            ttl (int): Время жизни кэша в секундах
+            refresh_margin (int): За сколько секунд до истечения продлевать кэш
+            min_tokens (int): Минимальный размер начальной части в токенах
+                (у gemini-1.5-pro-002 кэш меньше 32768 токенов не создаётся)
+            count_tokens (callable): Оценка количества токенов текста
+        """
+        self.backend = backend or GeminiCacheBackend()
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.count_tokens = count_tokens
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.failed = {}
+
+    def model_for(self, prefix, model_name, api_key_id=0):
+        """
+        Модель с кэшированной начальной частью запроса.
+
+        Параметры:
+            prefix (str): Неизменная начальная часть запроса
+            model_name (str): Имя модели (например, models/gemini-1.5-pro-002)
+            api_key_id: Идентификатор API ключа (кэш доступен только своему проекту)
+
+        Возвращает:
+            Модель или None, если кэш не используется
+        """
+        if self.count_tokens(prefix) < self.min_tokens:
+            return None
+        slot = (model_name, api_key_id)
+        key = hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self.lock:
+            if self.failed.get((slot, key), 0) > now:
+                return None
+            entry = self.entries.get(slot)
+            if entry and entry['key'] == key:
+                if entry['expires_at'] - now > self.refresh_margin:
+                    return entry['model']
+                try:
+                    self.backend.refresh(entry['cached'], self.ttl)
+                    entry['expires_at'] = now + self.ttl
+                    logger.debug(f"Время жизни кэша контекста продлено для {model_name}")
+                    return entry['model']
+                except Exception as e:
+                    logger.warning(f"Не удалось продлить кэш контекста, он будет создан заново: {e}")
+
+            if entry:
+                self._delete(entry)
+                del self.entries[slot]
+            try:
+                cached = self.backend.create(model_name, [prefix], self.ttl)
+                model = self.backend.model_for(cached)
+            except Exception as e:
+                logger.warning(f"Не удалось создать кэш контекста для {model_name}, запрос отправляется целиком: {e}")
+                # Повторная попытка для той же начальной части - не раньше чем через ttl
+                self.failed[(slot, key)] = now + self.ttl
+                return None
+            self.entries[slot] = {'key': key, 'cached': cached, 'model': model, 'expires_at': now + self.ttl}
+            logger.info(f"Создан кэш контекста для {model_name}")
+            return model
+
+    def discard(self, model_name, api_key_id=0):
+        """Удаление кэша для пары (модель, API ключ)"""
+        with self.lock:
+            entry = self.entries.pop((model_name, api_key_id), None)
+        if entry:
+            self._delete(entry)
+
+    def discard_if_missing(self, error, model_name, api_key_id=0):
+        """
+        Удаление кэша, если запрос с ним завершился ошибкой из-за того, что кэша
+        уже нет на сервере. Другие ошибки (квота, сеть) кэш не затрагивают.
+
+        Возвращает:
+            bool: True, если кэш удалён и будет создан заново при следующем запросе
+        """
+        if not self.backend.is_missing(error):
+            return False
+        logger.warning(f"Кэш контекста для {model_name} не найден на сервере и будет создан заново")
+        self.discard(model_name, api_key_id)
+        return True
+
+    def _delete(self, entry):
+        try:
+            self.backend.delete(entry['cached'])
+        except Exception as e:
+            logger.debug(f"Не удалось удалить кэш контекста: {e}")
+
+    def clear(self):
+        """Удаление всех созданных кэшей"""
+        with self.lock:
+            for entry in self.entries.values():
+                self._delete(entry)
+            self.entries.clear()
+            self.failed.clear()
@@ -0,0 +1,194 @@
+import os
+import re
+import json
+import random
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Пустая ячейка подписи (текст короче num_perm n-грамм)
+EMPTY = -1
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def shingles(text, size=5):
+    """Множество символьных n-грамм текста (регистр и пробелы нормализуются)"""
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+class DedupIndex:
+    """
+    Индекс MinHash/LSH для поиска похожих отправленных сообщений.
+
+    Для каждого текста хранится подпись MinHash из num_perm значений; подпись
+    делится на bands полос, и тексты, совпавшие хотя бы в одной полосе,
+    считаются кандидатами. При 32 полосах по 3 значения кандидатом становится
+    текст с долей общих 5-грамм 0.4 с вероятностью ~88%, 0.5 - ~99%, а тексты
+    с долей ниже 0.1 почти никогда. Точная проверка SequenceMatcher выполняется
+    только для кандидатов.
+
+    Подписи дописываются в файл JSON Lines (по SHA-1 текста), корзины строятся в памяти.
+    """
+    def __init__(self, index_path="sent_messages.minhash.jsonl", num_perm=96, bands=32, seed=1):
+        """
+        Параметры:
+            index_path (str): Файл для сохранения подписей
+            num_perm (int): Количество хеш-функций MinHash
+            bands (int): Количество полос LSH (num_perm должен делиться на bands)
+            seed (int): Зерно для параметров хеш-функций (должно быть постоянным)
+        """
+        self.index_path = index_path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.salt = random.Random(seed).getrandbits(64).to_bytes(8, 'little')
+        self.lock = threading.Lock()
+        self.signatures = None
+        self.texts = {}
+        self.buckets = {}
+
+    def signature(self, text):
+        """
+        Подпись MinHash текста (one permutation hashing): каждая n-грамма
+        хешируется один раз, хеш выбирает ячейку подписи, в ячейке остаётся
+        минимальное значение. Пустые ячейки заполняются значением следующей
+        непустой ячейки, чтобы короткие тексты тоже сравнивались по всем полосам.
+        """
+        signature = [EMPTY] * self.num_perm
+        for shingle in shingles(text):
+            value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8, salt=self.salt).digest(), 'little')
+            cell, value = value % self.num_perm, value // self.num_perm
+            if signature[cell] == EMPTY or value < signature[cell]:
+                signature[cell] = value
+        filled = list(signature)
+        for cell in range(self.num_perm):
+            offset = 1
+            while filled[cell] == EMPTY:
+                source = signature[(cell + offset) % self.num_perm]
+                if source != EMPTY:
+                    # Смещение добавляется, чтобы заполненные ячейки разных текстов не совпадали случайно
+                    filled[cell] = source + offset
+                offset += 1
+        return filled
+
+    def _band_keys(self, signature):
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def _load(self):
+        """Чтение подписей из файла: первая строка - параметры индекса, далее [SHA-1 текста, подпись]"""
+        if self.signatures is not None:
+            return
+        self.signatures = {}
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                header = json.loads(f.readline() or '{}')
+                if header.get('num_perm') != self.num_perm or header.get('bands') != self.bands:
+                    logger.info("Параметры индекса дубликатов изменились, индекс будет пересоздан")
+                    self._rewrite()
+                    return
+                for line in f:
+                    try:
+                        digest, signature = json.loads(line)
+                    except (json.JSONDecodeError, ValueError):
+                        # Недописанная строка после аварийного завершения
+                        continue
+                    self.signatures[digest] = signature
+        except (json.JSONDecodeError, OSError, AttributeError) as e:
+            logger.warning(f"Индекс дубликатов поврежден и будет пересоздан: {e}")
+            self.signatures = {}
+            self._rewrite()
+
+    def _rewrite(self):
+        """Запись всех подписей в новый файл индекса"""
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'num_perm': self.num_perm, 'bands': self.bands}) + '\n')
+                for digest, signature in self.signatures.items():
+                    f.write(json.dumps([digest, signature]) + '\n')
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить индекс дубликатов: {e}")
+
+    def _append(self, entries):
+        """Дозапись новых подписей в конец файла индекса"""
+        if not os.path.exists(self.index_path):
+            self._rewrite()
+            return
+        try:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                for digest, signature in entries:
+                    f.write(json.dumps([digest, signature]) + '\n')
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить индекс дубликатов: {e}")
+
+    def _add(self, digest, text, signature):
+        self.texts[digest] = text
+        for key in self._band_keys(signature):
+            self.buckets.setdefault(key, set()).add(digest)
+
+    def sync(self, messages):
+        """
+        Добавление в индекс текстов, которых в нём ещё нет. Подписи новых
+        текстов вычисляются и дописываются в файл.
+
+        Возвращает:
+            set: SHA-1 всех текстов messages (область поиска для candidates)
+        """
+        with self.lock:
+            self._load()
+            digests = {text_digest(text): text for text in messages}
+            new_entries = []
+            for digest, text in digests.items():
+                if digest in self.texts:
+                    continue
+                signature = self.signatures.get(digest)
+                if signature is None:
+                    signature = self.signature(text)
+                    self.signatures[digest] = signature
+                    new_entries.append((digest, signature))
+                self._add(digest, text, signature)
+            if new_entries:
+                self._append(new_entries)
+            return set(digests)
+
+    def prune(self, messages):
+        """Удаление из индекса и его файла всех текстов, кроме messages (после очистки истории)"""
+        keep = {text_digest(text) for text in messages}
+        with self.lock:
+            self._load()
+            self.signatures = {digest: signature for digest, signature in self.signatures.items() if digest in keep}
+            removed = set(self.texts) - keep
+            for digest in removed:
+                del self.texts[digest]
+            if removed:
+                for key in list(self.buckets):
+                    self.buckets[key] -= removed
+                    if not self.buckets[key]:
+                        del self.buckets[key]
+            self._rewrite()
+
+    def candidates(self, text, scope=None):
+        """
+        Тексты из индекса, совпадающие с text хотя бы в одной полосе LSH.
+
+        Параметры:
+            text (str): Проверяемый текст
+            scope (set): SHA-1 текстов, среди которых выполняется поиск (см. sync).
+                None - все тексты индекса
+        """
+        signature = self.signature(text)
+        with self.lock:
+            found = set()
+            for key in self._band_keys(signature):
+                found |= self.buckets.get(key, set())
+            if scope is not None:
+                found &= scope
+            return [self.texts[digest] for digest in found]
@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+AUDIO_CONTENT_TYPES = ('audio/', 'video/mp4', 'application/octet-stream', 'binary/octet-stream')
+IMAGE_CONTENT_TYPES = ('image/', 'application/octet-stream', 'binary/octet-stream')
+
+# Ответы, после которых ссылку можно считать недействительной
+DEAD_LINK_STATUSES = (404, 410)
+
+class DownloadResult:
+    """Результат скачивания. Приводится к bool: True при успехе"""
+    def __init__(self, ok, status_code=None, size=0):
+        self.ok = ok
+        self.status_code = status_code
+        self.size = size
+
+    @property
+    def is_dead_link(self):
+        return self.status_code in DEAD_LINK_STATUSES
+
+    def __bool__(self):
+        return self.ok
+
+class StreamDownloader:
+    """
+    Потоковое скачивание файлов с ограничением размера.
+
+    Тело ответа пишется на диск частями во временный файл *.part, который
+    переименовывается после успешного завершения. При обрыве соединения
+    повторная попытка продолжает скачивание с места остановки (заголовок Range).
+    Скачивание прерывается между частями, если установлено событие cancel.
+    """
+    def __init__(self, max_bytes=50 * 1024 * 1024, chunk_size=64 * 1024, max_retries=3):
+        """
+        Параметры:
+            max_bytes (int): Максимальный размер файла
+            chunk_size (int): Размер части при записи
+            max_retries (int): Количество попыток при обрыве соединения
+        """
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+
+    def download(self, http_session, url, filename, headers=None, allowed_types=None, timeout=15, cancel=None):
+        """
+        Скачивание url в filename.
+
+        Параметры:
+            http_session (requests.Session): Сессия для запроса
+            url (str): Адрес файла
+            filename (str): Путь для сохранения
+            headers (dict): Заголовки запроса
+            allowed_types (tuple): Допустимые префиксы Content-Type. None - без проверки
+            timeout (int): Таймаут соединения и чтения в секундах
+            cancel (threading.Event): Отмена скачивания (опционально)
+
+        Возвращает:
+            DownloadResult: Истинен при успешном скачивании; содержит код
+                HTTP-ответа, если сервер вернул ошибку
+        """
+        part_path = f"{filename}.part"
+        started = time.monotonic()
+        downloaded = 0
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+        for attempt in range(self.max_retries):
+            if cancel is not None and cancel.is_set():
+                break
+            request_headers = dict(headers or {})
+            if downloaded:
+                request_headers['Range'] = f"bytes={downloaded}-"
+            try:
+                with http_session.get(url, headers=request_headers, timeout=timeout, stream=True) as response:
+                    if response.status_code >= 400:
+                        logger.error(f"Ошибка при скачивании {url}: HTTP {response.status_code}")
+                        return DownloadResult(False, response.status_code)
+
+                    content_type = response.headers.get('Content-Type', '').lower()
+                    if allowed_types and content_type and not content_type.startswith(allowed_types):
+                        logger.error(f"Недопустимый тип содержимого {content_type} для {url}")
+                        return DownloadResult(False, response.status_code)
+
+                    content_length = response.headers.get('Content-Length')
+                    resumed = downloaded and response.status_code == 206
+                    expected_size = int(content_length) + (downloaded if resumed else 0) if content_length and content_length.isdigit() else None
+                    if expected_size and expected_size > self.max_bytes:
+                        logger.error(f"Файл {url} слишком большой: {expected_size} байт (максимум {self.max_bytes})")
+                        return DownloadResult(False, response.status_code)
+
+                    if not resumed:
+                        # Сервер не поддерживает Range - начинаем заново
+                        downloaded = 0
+                    with open(part_path, 'ab' if resumed else 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            if not chunk:
+                                continue
+                            if cancel is not None and cancel.is_set():
+                                logger.info(f"Скачивание {url} отменено")
+                                break
+                            downloaded += len(chunk)
+                            if downloaded > self.max_bytes:
+                                logger.error(f"Файл {url} превысил максимальный размер {self.max_bytes} байт")
+                                file.close()
+                                os.remove(part_path)
+                                return DownloadResult(False, response.status_code)
+                            file.write(chunk)
+                if cancel is not None and cancel.is_set():
+                    break
+
+                os.replace(part_path, filename)
+                elapsed = max(time.monotonic() - started, 1e-6)
+                logger.info(f"Скачано {downloaded} байт за {elapsed:.2f} сек. ({downloaded / elapsed / 1024:.1f} КБ/с): {url}")
+                return DownloadResult(True, response.status_code, downloaded)
+
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                logger.warning(f"Обрыв скачивания {url} на {downloaded} байт (попытка {attempt + 1}/{self.max_retries}): {e}")
+            except Exception as e:
+                logger.error(f"Ошибка при скачивании {url}: {e}")
+                break
+
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return DownloadResult(False)
@@ -0,0 +1,43 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def load_entries(path, description="Кэш"):
+    """
+    Записи кэша из JSON-файла.
+
+    Параметры:
+        path (str): Файл кэша
+        description (str): Название кэша для журнала
+
+    Возвращает:
+        dict: Записи или пустой словарь, если файла нет или он повреждён
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return data
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"{description} поврежден и будет пересоздан: {e}")
+    return {}
+
+def save_entries(path, entries):
+    """
+    Атомарное сохранение записей кэша, срок действия которых (expires_at) не истёк.
+
+    Возвращает:
+        dict: Сохранённые записи
+    """
+    now = time.time()
+    entries = {key: entry for key, entry in entries.items() if entry['expires_at'] > now}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return entries
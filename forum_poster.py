@@ -1,8 +1,12 @@
+import os
+import json
+import threading
 import requests
 from bs4 import BeautifulSoup
 import logging
 import traceback
 import time
+import asyncio
 from urllib.parse import urlparse
 
 # Настройка логирования
@@ -16,8 +20,38 @@ console_handler.setLevel(logging.DEBUG)
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# Признак авторизованной страницы XenForo
+LOGGED_IN_MARKER = 'data-logged-in="true"'
+
+# Результат отправки формы с устаревшим или чужим _xfToken
+TOKEN_REJECTED = object()
+
+def extract_reply_form(soup):
+    """
+    Форма ответа (add-reply) со страницы темы.
+    
+    Возвращает:
+        dict | None: {'action': str, 'fields': dict} - адрес формы и значения её полей
+            (включая _xfToken), или None, если формы нет (например, страница
+            загружена без авторизации)
+    """
+    reply_form = soup.find('form', {'action': lambda x: x and '/add-reply' in x})
+    if not reply_form:
+        return None
+    
+    fields = {}
+    for input_field in reply_form.find_all(['input', 'textarea', 'select']):
+        name = input_field.get('name')
+        if not name:
+            continue
+        value = input_field.get('value', '')
+        if input_field.name == 'textarea':
+            value = input_field.text
+        fields[name] = value
+    return {'action': reply_form.get('action'), 'fields': fields}
+
 class ForumPoster:
-    def __init__(self, forum_url, username, password):
+    def __init__(self, forum_url, username, password, cookie_path=None):
         """
         Инициализация класса для публикации сообщений на форуме.
         
@@ -25,6 +59,9 @@ class ForumPoster:
             forum_url (str): URL форума (например, "https://musforums.ru/")
             username (str): Имя пользователя для авторизации
             password (str): Пароль пользователя
+            cookie_path (str): Файл для сохранения cookie сессии между запусками.
+                Если указан, повторная авторизация выполняется только после
+                истечения сессии
         """
         # Убеждаемся, что forum_url содержит схему и заканчивается на /
         if not forum_url.startswith(('http://', 'https://')):
@@ -54,6 +91,67 @@ class ForumPoster:
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         self.session.headers.update(self.headers)
+        
+        # Один экземпляр используется всеми тредами: запросы выполняются по очереди
+        self.lock = threading.RLock()
+        self.cookie_path = cookie_path
+        self.logged_in = self.load_cookies()
+
+    def load_cookies(self):
+        """
+        Загрузка cookie сессии из cookie_path.
+        
+        Возвращает:
+            bool: True, если cookie загружены (сессия считается активной до первой проверки)
+        """
+        if not self.cookie_path or not os.path.exists(self.cookie_path):
+            return False
+        try:
+            with open(self.cookie_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('forum_url') != self.forum_url or data.get('username') != self.username:
+                logger.info("Сохранённая сессия относится к другому форуму или пользователю")
+                return False
+            for cookie in data.get('cookies', []):
+                self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''),
+                                         path=cookie.get('path', '/'), expires=cookie.get('expires'),
+                                         secure=cookie.get('secure', False))
+            logger.info("Загружена сохранённая сессия форума")
+            return bool(data.get('cookies'))
+        except (json.JSONDecodeError, OSError, KeyError, AttributeError) as e:
+            logger.warning(f"Не удалось загрузить сохранённую сессию: {e}")
+            return False
+
+    def save_cookies(self):
+        """Сохранение cookie сессии в cookie_path"""
+        if not self.cookie_path:
+            return
+        cookies = [
+            {'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain,
+             'path': cookie.path, 'expires': cookie.expires, 'secure': cookie.secure}
+            for cookie in self.session.cookies
+        ]
+        try:
+            tmp_path = f"{self.cookie_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'forum_url': self.forum_url, 'username': self.username, 'cookies': cookies}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cookie_path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить сессию форума: {e}")
+
+    def ensure_logged_in(self):
+        """Авторизация, если активной сессии нет"""
+        with self.lock:
+            return self.logged_in or self.login()
+
+    @staticmethod
+    def is_login_required(response):
+        """Ответ показывает, что сессия истекла: нет признака авторизации или редирект на вход"""
+        if LOGGED_IN_MARKER in response.text:
+            return False
+        return (response.status_code in (401, 403)
+                or 'data-logged-in="false"' in response.text
+                or 'login' in urlparse(response.url).path + urlparse(response.url).query)
 
     def login(self):
         """
@@ -63,6 +161,7 @@ class ForumPoster:
             bool: True при успешной авторизации, False при ошибке
         """
         logger.info("Попытка авторизации на форуме")
+        self.logged_in = False
         try:
             response = self.session.get(self.login_url, timeout=15)
             response.raise_for_status()
@@ -86,8 +185,10 @@ class ForumPoster:
             post_response = self.session.post(self.login_url, data=login_data, timeout=15, allow_redirects=True)
             post_response.raise_for_status()
 
-            if "data-logged-in=\"true\"" in post_response.text:
+            if LOGGED_IN_MARKER in post_response.text:
                 logger.info("Авторизация успешна")
+                self.logged_in = True
+                self.save_cookies()
                 return True
             else:
                 logger.error("Ошибка авторизации")
@@ -143,56 +244,114 @@ class ForumPoster:
             logger.error(traceback.format_exc())
             return False
 
-    def reply_to_thread(self, thread_id, message):
+    def reply_to_thread(self, thread_id, message, form_state=None):
         """
-        Ответ в существующей теме.
+        Ответ в существующей теме. Используется текущая сессия; авторизация
+        выполняется, только если сессии нет или форум сообщил о её истечении.
         
         Параметры:
             thread_id (int): ID темы
             message (str): Текст ответа
+            form_state (dict): Форма ответа, уже полученная при разборе темы
+                (см. extract_reply_form). Страница темы загружается повторно,
+                только если формы нет или форум отклонил её токен
             
         Возвращает:
             bool: True при успешной отправке, False при ошибке
         """
         logger.info(f"Отправка ответа в тему {thread_id}")
-        try:
-            thread_url = requests.compat.urljoin(self.forum_url, f'index.php?threads/{thread_id}/')
-            response = self.session.get(thread_url, headers=self.headers, timeout=15)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            reply_form = soup.find('form', {'action': lambda x: x and '/add-reply' in x})
-            if not reply_form:
-                logger.error("Форма ответа не найдена")
+        with self.lock:
+            if not self.ensure_logged_in():
+                logger.error("Авторизация не удалась. Сообщение не было отправлено.")
                 return False
-            
-            action = reply_form.get('action')
-            reply_url = requests.compat.urljoin(self.forum_url, action)
-            
-            form_inputs = reply_form.find_all(['input', 'textarea', 'select'])
-            form_data = {}
-            for input_field in form_inputs:
-                name = input_field.get('name')
-                if not name:
-                    continue
-                value = input_field.get('value', '')
-                if input_field.name == 'textarea':
-                    value = input_field.text
-                form_data[name] = value
-            
-            form_data['message'] = message
-            form_data['subscribe'] = '1'
-            
-            time.sleep(2)
-            
-            post_response = self.session.post(reply_url, data=form_data, headers=self.headers, timeout=15)
-            post_response.raise_for_status()
-            return True
+            try:
+                if form_state:
+                    result = self._submit_reply(form_state, message)
+                    if result is TOKEN_REJECTED:
+                        logger.info("Форум отклонил токен сохранённой формы, загрузка страницы темы")
+                        result = self._post_reply(thread_id, message)
+                else:
+                    result = self._post_reply(thread_id, message)
+                if result is None:
+                    logger.info("Сессия форума истекла, повторная авторизация")
+                    if not self.login():
+                        logger.error("Авторизация не удалась. Сообщение не было отправлено.")
+                        return False
+                    result = self._post_reply(thread_id, message)
+                if result is True:
+                    # Форум обновляет cookie сессии при запросах
+                    self.save_cookies()
+                return result is True
 
-        except requests.exceptions.HTTPError as http_err:
-            logger.error(f"HTTP ошибка: {http_err}")
+            except requests.exceptions.HTTPError as http_err:
+                logger.error(f"HTTP ошибка: {http_err}")
+                return False
+            except Exception as e:
+                logger.error(f"Ошибка при отправке ответа: {e}")
+                logger.error(traceback.format_exc())
+                return False
+
+    def _post_reply(self, thread_id, message):
+        """
+        Загрузка страницы темы и отправка ответа через её форму add-reply.
+        
+        Возвращает:
+            bool | None: Результат отправки или None, если требуется авторизация
+        """
+        thread_url = requests.compat.urljoin(self.forum_url, f'index.php?threads/{thread_id}/')
+        response = self.session.get(thread_url, headers=self.headers, timeout=15)
+        response.raise_for_status()
+        if LOGGED_IN_MARKER not in response.text:
+            self.logged_in = False
+            return None
+        
+        form_state = extract_reply_form(BeautifulSoup(response.content, 'html.parser'))
+        if not form_state:
+            logger.error("Форма ответа не найдена")
             return False
-        except Exception as e:
-            logger.error(f"Ошибка при отправке ответа: {e}")
-            logger.error(traceback.format_exc())
+        
+        time.sleep(2)
+        
+        result = self._submit_reply(form_state, message)
+        if result is TOKEN_REJECTED:
+            logger.error("Форум отклонил токен формы ответа")
             return False
+        return result
+
+    def _submit_reply(self, form_state, message):
+        """
+        Отправка формы ответа.
+        
+        Возвращает:
+            True при успехе, None если требуется авторизация, TOKEN_REJECTED
+            если форум отклонил _xfToken
+        """
+        form_data = dict(form_state['fields'])
+        form_data['message'] = message
+        form_data['subscribe'] = '1'
+        
+        reply_url = requests.compat.urljoin(self.forum_url, form_state['action'])
+        post_response = self.session.post(reply_url, data=form_data, headers=self.headers, timeout=15)
+        if self.is_login_required(post_response):
+            self.logged_in = False
+            return None
+        if post_response.status_code in (400, 403):
+            return TOKEN_REJECTED
+        post_response.raise_for_status()
+        return True
+
+    # Асинхронные варианты для async_scraper. Публикация выполняется редко
+    # (один запрос на ответ), поэтому используется та же сессия requests
+    # с авторизационными cookie в отдельном потоке
+
+    async def login_async(self):
+        """Асинхронный вариант login"""
+        return await asyncio.to_thread(self.login)
+
+    async def create_thread_async(self, title, message, forum_id):
+        """Асинхронный вариант create_thread"""
+        return await asyncio.to_thread(self.create_thread, title, message, forum_id)
+
+    async def reply_to_thread_async(self, thread_id, message, form_state=None):
+        """Асинхронный вариант reply_to_thread"""
+        return await asyncio.to_thread(self.reply_to_thread, thread_id, message, form_state)
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+class JobWorkspace:
+    """
+    Отдельный временный каталог для файлов одной задачи обработки треда
+    (медиафайлы).
+
+    Используется как контекстный менеджер: каталог удаляется при выходе,
+    поэтому очистка одной задачи не затрагивает файлы других.
+    """
+    def __init__(self, job_name="job", base_dir=None):
+        """
+        Параметры:
+            job_name (str): Префикс имени каталога (например, "thread_123")
+            base_dir (str): Родительский каталог. По умолчанию - системный каталог временных файлов
+        """
+        if base_dir:
+            os.makedirs(base_dir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f"{job_name}_", dir=base_dir)
+        logger.debug(f"Создан рабочий каталог задачи: {self.path}")
+
+    def file(self, name):
+        """Путь к файлу внутри рабочего каталога"""
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        """Удаление рабочего каталога со всем содержимым"""
+        shutil.rmtree(self.path, ignore_errors=True)
+        logger.debug(f"Удален рабочий каталог задачи: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cleanup()
+        return False
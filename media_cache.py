@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+VOCAROO_ID_PATTERN = re.compile(r'^(?:https?://)?(?:www\.)?(?:voca\.ro|vocaroo\.com|media\d*\.vocaroo\.com/mp3)/([A-Za-z0-9]+)', re.IGNORECASE)
+
+def normalize_media_url(url):
+    """
+    Приведение ссылки на медиафайл к ключу кэша.
+
+    Все формы ссылок Vocaroo (voca.ro, vocaroo.com, media1.vocaroo.com/mp3)
+    сводятся к идентификатору записи, редиректы VK раскрываются, у остальных
+    ссылок отбрасываются параметры запроса Smule и якорь.
+    """
+    if 'vk.com/away.php' in url:
+        query_params = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        target = query_params.get('to', [None])[0]
+        if target:
+            url = urllib.parse.unquote(target)
+
+    match = VOCAROO_ID_PATTERN.match(url)
+    if match:
+        return f"vocaroo:{match.group(1)}"
+
+    parsed = urllib.parse.urlparse(url.strip())
+    netloc = parsed.netloc.lower()
+    query = parsed.query
+    # Ссылки Smule и адреса потоков содержат подписи и метки в параметрах
+    if 'smule.com' in netloc:
+        query = ''
+    return urllib.parse.urlunparse((parsed.scheme.lower(), netloc, parsed.path.rstrip('/'), '', query, ''))
+
+class MediaCache:
+    """
+    Постоянный кэш скачанных аудио и изображений.
+
+    Файлы хранятся по SHA-256 содержимого (одинаковые файлы по разным ссылкам
+    хранятся один раз), индекс ключ ссылки -> файл сохраняется в index.json.
+    При превышении max_bytes удаляются давно не использованные записи.
+    Индекс записывается при добавлении файла; время обращения при попадании
+    в кэш обновляется только в памяти и сохраняется вместе со следующей
+    записью индекса или при вызове flush.
+    """
+    def __init__(self, cache_dir="media_cache", max_bytes=500 * 1024 * 1024):
+        """
+        Параметры:
+            cache_dir (str): Каталог кэша
+            max_bytes (int): Максимальный суммарный размер файлов кэша
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = None
+        self.dirty = False
+
+    @property
+    def index_path(self):
+        # Каталог может быть изменен настройкой media_cache_dir после создания объекта
+        return os.path.join(self.cache_dir, 'index.json')
+
+    def _load_index(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self.index = data
+            except (json.JSONDecodeError, OSError) as e:
+                logger.warning(f"Индекс кэша медиафайлов поврежден, кэш будет пересоздан: {e}")
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def flush(self):
+        """Сохранение изменений индекса, накопленных при обращениях к кэшу"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                self._save_index()
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить индекс кэша медиафайлов: {e}")
+
+    def _file_path(self, entry):
+        return os.path.join(self.cache_dir, entry['file'])
+
+    def get(self, url):
+        """Путь к закэшированному файлу для ссылки или None"""
+        key = normalize_media_url(url)
+        with self.lock:
+            self._load_index()
+            entry = self.index.get(key)
+            if not entry:
+                return None
+            path = self._file_path(entry)
+            if not os.path.exists(path):
+                del self.index[key]
+                self.dirty = True
+                return None
+            entry['last_access'] = time.time()
+            self.dirty = True
+            return path
+
+    def copy_to(self, url, target_path):
+        """
+        Копирование закэшированного файла по ссылке в target_path.
+
+        Возвращает:
+            bool: True, если файл найден в кэше
+        """
+        path = self.get(url)
+        if not path:
+            return False
+        try:
+            try:
+                os.link(path, target_path)
+            except OSError:
+                shutil.copyfile(path, target_path)
+            logger.info(f"Файл взят из кэша: {url} -> {target_path}")
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось скопировать файл из кэша {path}: {e}")
+            return False
+
+    def put(self, url, source_path, extra_urls=()):
+        """
+        Добавление скачанного файла в кэш под ключом ссылки (и дополнительных ссылок,
+        например разрешённого адреса потока).
+        """
+        try:
+            sha256 = hashlib.sha256()
+            with open(source_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            extension = os.path.splitext(source_path)[1].lower()
+            file_name = f"{digest}{extension}"
+            size = os.path.getsize(source_path)
+
+            with self.lock:
+                self._load_index()
+                os.makedirs(self.cache_dir, exist_ok=True)
+                cached_path = os.path.join(self.cache_dir, file_name)
+                if not os.path.exists(cached_path):
+                    shutil.copyfile(source_path, cached_path)
+                now = time.time()
+                for key_url in (url, *extra_urls):
+                    self.index[normalize_media_url(key_url)] = {
+                        'file': file_name,
+                        'sha256': digest,
+                        'size': size,
+                        'last_access': now,
+                        'url': key_url
+                    }
+                self._evict()
+                self._save_index()
+            logger.debug(f"Файл {source_path} добавлен в кэш как {file_name}")
+        except OSError as e:
+            logger.warning(f"Не удалось добавить файл {source_path} в кэш: {e}")
+
+    def _evict(self):
+        """Удаление давно не использованных файлов до укладывания в max_bytes"""
+        files = {}
+        for key, entry in self.index.items():
+            info = files.setdefault(entry['file'], {'size': entry['size'], 'last_access': 0, 'keys': []})
+            info['last_access'] = max(info['last_access'], entry['last_access'])
+            info['keys'].append(key)
+
+        total = sum(info['size'] for info in files.values())
+        for file_name, info in sorted(files.items(), key=lambda item: item[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            for key in info['keys']:
+                del self.index[key]
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except OSError:
+                pass
+            total -= info['size']
+            logger.debug(f"Файл {file_name} удален из кэша медиафайлов")
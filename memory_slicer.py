@@ -0,0 +1,196 @@
+import re
+import json
+import logging
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Разделы памяти, которые всегда попадают в запрос (statistics - чтобы модель
+# могла увеличивать счётчики, не сбрасывая их)
+CORE_SECTIONS = ('personality', 'self', 'version', 'statistics')
+# Ключи forum_members, которые не являются участниками форума
+MEMBER_CONTAINER_KEYS = ('users',)
+ADDITIONAL_INFORMATION_KEY = 'additional_information'
+
+URL_PATTERN = re.compile(r'https?://[^\s\[\]<>"\']+')
+
+def approx_tokens(text, chars_per_token=3):
+    """Грубая оценка количества токенов текста (для русского текста ~3 символа на токен)"""
+    return len(text) // chars_per_token + 1
+
+def normalize_link(url):
+    """Ссылка без схемы, www и завершающего слэша; voca.ro и vocaroo.com считаются одним хостом"""
+    parsed = urllib.parse.urlsplit(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if host == 'voca.ro':
+        host = 'vocaroo.com'
+    return f"{host}{parsed.path.rstrip('/')}"
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, indent=2)
+
+class MemoryIndex:
+    """
+    Индекс памяти бота: ник участника и ссылка на запись -> путь к записи
+    участника в памяти.
+
+    Участники хранятся как в forum_members.users.<ник>, так и в
+    forum_members.<ник>; для ника запоминаются все найденные пути.
+    """
+    def __init__(self, memory):
+        self.memory = memory
+        self.users = {}
+        self.links = {}
+        self.additional_information = []
+        members = memory.get('forum_members')
+        if isinstance(members, dict):
+            for container in (members.get(key) for key in MEMBER_CONTAINER_KEYS):
+                if isinstance(container, dict):
+                    prefix = ('forum_members', MEMBER_CONTAINER_KEYS[0])
+                    for name, data in container.items():
+                        self._add_user(name, prefix + (name,), data)
+            for name, data in members.items():
+                if name not in MEMBER_CONTAINER_KEYS and isinstance(data, dict):
+                    self._add_user(name, ('forum_members', name), data)
+        self._collect_additional_information(memory, ())
+
+    def _add_user(self, name, path, data):
+        self.users.setdefault(name.casefold(), []).append(path)
+        for recording in data.get('recordings', []) if isinstance(data.get('recordings'), list) else []:
+            if isinstance(recording, dict) and isinstance(recording.get('link'), str) and recording['link']:
+                paths = self.links.setdefault(normalize_link(recording['link']), [])
+                if path not in paths:
+                    paths.append(path)
+
+    def _collect_additional_information(self, value, path):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == ADDITIONAL_INFORMATION_KEY and isinstance(item, list):
+                    self.additional_information.append(path + (key,))
+                else:
+                    self._collect_additional_information(item, path + (key,))
+
+    def get(self, path):
+        value = self.memory
+        for key in path:
+            value = value[key]
+        return value
+
+class MemorySlicer:
+    """
+    Выбор из памяти бота разделов, относящихся к текущему треду.
+
+    В запрос попадают (в порядке приоритета): личность бота и статистика,
+    участники, написавшие сообщения треда (начиная с автора последнего),
+    участники, ссылки на записи которых есть в треде, и последние элементы
+    additional_information. Разделы добавляются, пока не исчерпан бюджет токенов.
+
+    Структура памяти сохраняется, а записи участников попадают в запрос
+    только целиком: merge_memory заменяет списки (записи, комментарии)
+    значением из memory_update, поэтому сокращённая запись стёрла бы данные
+    при обновлении. Запись, которая не помещается в бюджет, не включается
+    и при обновлении не изменяется. Сокращается только additional_information:
+    при объединении она дополняется, а не заменяется.
+    """
+    def __init__(self, token_budget=4000, additional_items=20, count_tokens=approx_tokens):
+        """
+        Параметры:
+            token_budget (int): Максимальный размер памяти в запросе в токенах
+            additional_items (int): Количество последних элементов additional_information
+            count_tokens (callable): Оценка количества токенов текста
+        """
+        self.token_budget = token_budget
+        self.additional_items = additional_items
+        self.count_tokens = count_tokens
+
+    def thread_authors(self, thread_data):
+        """Ники участников треда: автор последнего сообщения первым, создатель треда последним"""
+        authors = []
+        for message in reversed(thread_data['messages']):
+            if message['author'] not in authors:
+                authors.append(message['author'])
+        if thread_data.get('creator') and thread_data['creator'] not in authors:
+            authors.append(thread_data['creator'])
+        return authors
+
+    def thread_links(self, thread_data):
+        links = list(thread_data.get('unique_audio_links', []))
+        for message in thread_data['messages']:
+            links.extend(URL_PATTERN.findall(message['content']))
+        return list(dict.fromkeys(normalize_link(link) for link in links))
+
+    def select(self, index, thread_data):
+        """
+        Пути разделов памяти в порядке приоритета.
+
+        Возвращает:
+            list: Пары (путь, обязательный раздел)
+        """
+        selected = [((section,), True) for section in CORE_SECTIONS if section in index.memory]
+        for author in self.thread_authors(thread_data):
+            selected.extend((path, False) for path in index.users.get(author.casefold(), []))
+        for link in self.thread_links(thread_data):
+            selected.extend((path, False) for path in index.links.get(link, []))
+        selected.extend((path, False) for path in index.additional_information)
+        return selected
+
+    def slice(self, index, thread_data, token_budget=None):
+        """
+        Часть памяти для треда.
+
+        Параметры:
+            index (MemoryIndex): Индекс текущей версии памяти
+            thread_data (dict): Результат parse_thread
+            token_budget (int): Бюджет вместо self.token_budget (опционально)
+
+        Возвращает:
+            dict: Память с выбранными разделами
+        """
+        token_budget = self.token_budget if token_budget is None else token_budget
+        result = {}
+        used = set()
+        remaining = token_budget
+        for path, required in self.select(index, thread_data):
+            if path in used or any(path[:i] in used for i in range(1, len(path))):
+                continue
+            value = index.get(path)
+            if path[-1] == ADDITIONAL_INFORMATION_KEY:
+                value = value[-self.additional_items:]
+            cost = self.count_tokens(dumps(value))
+            if cost > remaining and not required:
+                value = self.trim(value, remaining) if path[-1] == ADDITIONAL_INFORMATION_KEY else None
+                if value is None:
+                    logger.debug(f"Раздел памяти {'.'.join(map(str, path))} не помещается в бюджет")
+                    continue
+                cost = self.count_tokens(dumps(value))
+            self.place(result, path, value)
+            used.add(path)
+            remaining -= cost
+        logger.info(f"Память для запроса: {len(used)} разделов, ~{token_budget - remaining} токенов из {token_budget}")
+        return result
+
+    def trim(self, items, budget):
+        """
+        Сокращение списка additional_information до бюджета с отбрасыванием
+        самых старых (первых) элементов.
+
+        Возвращает:
+            list: Последние элементы или None, если не помещается ни один
+        """
+        if budget <= 0:
+            return None
+        kept = []
+        for item in reversed(items):
+            if self.count_tokens(dumps([item] + kept)) > budget:
+                break
+            kept.insert(0, item)
+        return kept or None
+
+    def place(self, result, path, value):
+        """Запись значения в result по пути path"""
+        target = result
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
@@ -0,0 +1,282 @@
+import json
+import hashlib
+import time
+import random
+import sqlite3
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate токенов в секунду, не больше capacity подряд.
+    """
+    def __init__(self, rate, capacity=1):
+        """
+        Параметры:
+            rate (float): Скорость пополнения в токенах в секунду
+            capacity (int): Максимальное количество накопленных токенов
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        """Время до появления токена в секундах (0 - токен есть)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        with self.lock:
+            self.tokens -= 1
+
+class Outbox:
+    """
+    Постоянная очередь исходящих ответов в SQLite.
+
+    Ответ ставится в очередь с ключом идемпотентности thread_id:post_id, поэтому
+    на одно сообщение форума в тред уходит не больше одного ответа, даже если
+    оно было обработано повторно. Очередь переживает перезапуск бота.
+    Отправленные и окончательно не отправленные ответы хранятся retention_days
+    дней, затем удаляются (при запуске и не чаще раза в prune_interval секунд).
+    """
+    def __init__(self, db_path="outbox.db", max_attempts=5, base_delay=30, max_delay=1800, retention_days=30, prune_interval=3600):
+        """
+        Параметры:
+            db_path (str): Файл базы данных очереди
+            max_attempts (int): Количество попыток отправки до отметки failed
+            base_delay (int): Задержка перед первой повторной попыткой в секундах
+            max_delay (int): Максимальная задержка между попытками в секундах
+            retention_days (float): Срок хранения завершённых ответов в днях
+            prune_interval (int): Минимальный интервал между удалениями в секундах
+        """
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.pruned_at = None
+        self.lock = threading.Lock()
+        self.initialized = False
+        self.wakeup = threading.Event()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        if not self.initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    thread_id TEXT NOT NULL,
+                    post_id TEXT,
+                    message TEXT NOT NULL,
+                    reply_form TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            # Ответы, отправка которых прервалась вместе с программой, отправляются заново
+            connection.execute("UPDATE outbox SET status = ? WHERE status = ?", (PENDING, SENDING))
+            connection.commit()
+            self.initialized = True
+        if self.pruned_at is None or time.monotonic() - self.pruned_at >= self.prune_interval:
+            self._prune(connection)
+        return connection
+
+    def _prune(self, connection):
+        """Удаление отправленных и неотправленных окончательно ответов старше retention_days"""
+        self.pruned_at = time.monotonic()
+        cutoff = time.time() - self.retention_days * 86400
+        # Для завершённых ответов next_attempt_at - время последней попытки
+        with connection:
+            cursor = connection.execute("DELETE FROM outbox WHERE status IN (?, ?) AND next_attempt_at < ?", (SENT, FAILED, cutoff))
+        if cursor.rowcount:
+            logger.info(f"Из очереди отправки удалено завершённых ответов: {cursor.rowcount}")
+
+    def enqueue(self, thread_id, post_id, message, reply_form=None):
+        """
+        Постановка ответа в очередь.
+
+        Параметры:
+            thread_id: ID треда
+            post_id: ID сообщения, на которое отвечает бот. Если неизвестен,
+                ключ строится по тексту ответа
+            message (str): Текст ответа
+            reply_form (dict): Форма ответа из parse_thread (опционально)
+
+        Возвращает:
+            bool: False, если ответ на это сообщение уже есть в очереди
+        """
+        key = f"{thread_id}:{post_id or hashlib.sha256(message.encode('utf-8')).hexdigest()[:16]}"
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    cursor = connection.execute(
+                        "INSERT OR IGNORE INTO outbox (idempotency_key, thread_id, post_id, message, reply_form, status, next_attempt_at, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, str(thread_id), post_id, message, json.dumps(reply_form, ensure_ascii=False) if reply_form else None, PENDING, now, now))
+            finally:
+                connection.close()
+        if cursor.rowcount == 0:
+            logger.info(f"Ответ {key} уже есть в очереди отправки")
+            return False
+        logger.info(f"Ответ {key} поставлен в очередь отправки")
+        self.wakeup.set()
+        return True
+
+    def pending_messages(self):
+        """Тексты ответов, ожидающих отправки (для проверки на дубликаты)"""
+        with self.lock:
+            connection = self._connect()
+            try:
+                rows = connection.execute("SELECT message FROM outbox WHERE status IN (?, ?)", (PENDING, SENDING)).fetchall()
+            finally:
+                connection.close()
+        return [row['message'] for row in rows]
+
+    def claim_next(self):
+        """
+        Следующий ответ, время отправки которого наступило, с отметкой sending.
+
+        Возвращает:
+            tuple: (dict ответа или None, секунд до следующего ответа или None)
+        """
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    row = connection.execute(
+                        "SELECT * FROM outbox WHERE status = ? ORDER BY next_attempt_at, id LIMIT 1", (PENDING,)).fetchone()
+                    if row is None:
+                        return None, None
+                    if row['next_attempt_at'] > now:
+                        return None, row['next_attempt_at'] - now
+                    connection.execute("UPDATE outbox SET status = ?, attempts = attempts + 1 WHERE id = ?", (SENDING, row['id']))
+            finally:
+                connection.close()
+        item = dict(row)
+        item['attempts'] += 1
+        item['reply_form'] = json.loads(item['reply_form']) if item['reply_form'] else None
+        return item, None
+
+    def mark_sent(self, item):
+        self._update(item['id'], SENT, time.time(), None)
+
+    def mark_failed(self, item, error):
+        """Планирование повторной попытки с экспоненциальной задержкой и разбросом"""
+        if item['attempts'] >= self.max_attempts:
+            logger.error(f"Важное: Ответ {item['idempotency_key']} не отправлен после {item['attempts']} попыток: {error}")
+            self._update(item['id'], FAILED, time.time(), error)
+            return
+        delay = min(self.max_delay, self.base_delay * 2 ** (item['attempts'] - 1)) * random.uniform(0.5, 1.5)
+        logger.warning(f"Ответ {item['idempotency_key']} не отправлен ({error}), повтор через {delay:.0f} сек.")
+        self._update(item['id'], PENDING, time.time() + delay, error)
+
+    def _update(self, item_id, status, next_attempt_at, error):
+        with self.lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                       (status, next_attempt_at, error, item_id))
+            finally:
+                connection.close()
+
+class OutboxSender:
+    """
+    Поток, отправляющий ответы из Outbox с ограничением частоты TokenBucket.
+
+    send(item) выполняет отправку и возвращает True при успехе; on_sent(item)
+    вызывается после успешной отправки. Остановленный поток повторно не
+    запускается: для возобновления отправки создаётся новый OutboxSender.
+    """
+    def __init__(self, outbox, send, on_sent=None, rate_per_minute=2, burst=1):
+        """
+        Параметры:
+            outbox (Outbox): Очередь ответов
+            send (callable): Отправка ответа, возвращает bool
+            on_sent (callable): Действия после успешной отправки (опционально)
+            rate_per_minute (float): Максимальная частота отправки
+            burst (int): Количество ответов, которые можно отправить подряд
+        """
+        self.outbox = outbox
+        self.send = send
+        self.on_sent = on_sent
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.stop_event = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        if self.stopped:
+            logger.warning("Отправка ответов остановлена и не будет запущена повторно")
+            return
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self.thread.start()
+        logger.info("Запущена отправка ответов из очереди")
+
+    def stop(self, timeout=10):
+        self.stopped = True
+        self.stop_event.set()
+        self.outbox.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _sleep(self, seconds):
+        """Ожидание, прерываемое остановкой или новым ответом в очереди"""
+        self.outbox.wakeup.wait(seconds)
+        self.outbox.wakeup.clear()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            wait = self.bucket.wait_time()
+            if wait:
+                self.stop_event.wait(wait)
+                continue
+            try:
+                item, wait = self.outbox.claim_next()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка чтения очереди отправки: {e}")
+                self._sleep(30)
+                continue
+            if item is None:
+                self._sleep(min(wait, 60) if wait is not None else 60)
+                continue
+
+            self.bucket.take()
+            try:
+                success = self.send(item)
+                error = None if success else "отправка не удалась"
+            except Exception as e:
+                logger.error(traceback.format_exc())
+                success, error = False, str(e)
+            if success:
+                self.outbox.mark_sent(item)
+                logger.info(f"Важное: Ответ {item['idempotency_key']} отправлен на форум.")
+                if self.on_sent:
+                    self.on_sent(item)
+            else:
+                self.outbox.mark_failed(item, error)
@@ -0,0 +1,222 @@
+import re
+import logging
+from bs4 import BeautifulSoup, SoupStrainer, NavigableString, CData
+
+logger = logging.getLogger(__name__)
+
+# lxml разбирает страницы в несколько раз быстрее встроенного html.parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+DEFAULT_BASE_URL = "https://musforums.ru"
+AUDIO_HOSTS = ('vocaroo.com', 'voca.ro', 'smule.com')
+IMAGE_FORMATS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+POST_ID_PATTERN = re.compile(r'^(?:js-)?post-(\d+)$')
+# Строки, которые BeautifulSoup учитывает в get_text (без комментариев, скриптов и т.п.)
+TEXT_STRING_TYPES = (NavigableString, CData)
+
+# Частичный разбор: дерево строится только для нужных блоков страницы,
+# шапка, боковые виджеты и скрипты пропускаются
+partial_parsing = True
+
+# Страница треда: заголовок, автор темы, навигация по страницам, сообщения
+# (article сохраняется целиком, в его атрибутах хранится ID сообщения)
+# и форма быстрого ответа
+THREAD_PAGE_STRAINER = SoupStrainer(class_=re.compile(r'(?:^|\s)(?:p-title-value|p-description|pageNav-main|message--post|js-quickReply)(?:\s|$)'))
+# Список тредов раздела
+THREAD_LIST_STRAINER = SoupStrainer('div', class_=re.compile(r'(?:^|\s)structItem--thread(?:\s|$)'))
+
+def make_soup(markup, strainer=None):
+    """
+    Разбор HTML самым быстрым из доступных парсеров.
+
+    Параметры:
+        markup (bytes | str): HTML страницы
+        strainer (SoupStrainer): Блоки, которые нужно разобрать. Учитывается,
+            если включен partial_parsing
+    """
+    if strainer is not None and partial_parsing:
+        return BeautifulSoup(markup, HTML_PARSER, parse_only=strainer)
+    return BeautifulSoup(markup, HTML_PARSER)
+
+def has_class(tag, class_name):
+    return class_name in (tag.get('class') or ())
+
+def find_post_id(post):
+    """
+    ID сообщения для блока div.message-inner.
+
+    XenForo хранит ID в атрибутах data-content="post-N" / id="js-post-N"
+    родительского article, а якорь id="post-N" стоит рядом с message-inner,
+    поэтому проверяются сам блок, его родители и соседние элементы.
+    """
+    for node in (post, *post.parents):
+        if node.name is None:
+            break
+        for attr in ('data-content', 'id'):
+            match = POST_ID_PATTERN.match(node.get(attr) or '')
+            if match:
+                return match.group(1)
+        if node.name == 'article':
+            break
+
+    anchor = post.find(id=POST_ID_PATTERN) or post.find_previous_sibling(id=POST_ID_PATTERN)
+    if anchor:
+        return POST_ID_PATTERN.match(anchor['id']).group(1)
+    return None
+
+class PostWalker:
+    """
+    Однопроходный разбор содержимого сообщения.
+
+    Каждый узел div.message-content посещается один раз: по пути собирается
+    текст (смайлики заменяются на alt, цитаты и спойлеры - на [QUOTE]/[SPOILER],
+    блоки «Нажмите для раскрытия» пропускаются), ссылки на аудио и изображения.
+    """
+    def __init__(self, base_url=DEFAULT_BASE_URL):
+        self.base_url = base_url
+        self.audio_links = []
+        self.images = []
+        self.image_anchors = []
+        # Узлы, текст которых собирается в отдельный список (содержимое цитат и спойлеров)
+        self.targets = {}
+
+    @property
+    def image_links(self):
+        return self.images + self.image_anchors
+
+    def text(self, content):
+        parts = []
+        self._walk(content, parts, quotes=True, spoilers=True)
+        return ' '.join(parts)
+
+    def _collect_links(self, tag):
+        if tag.name == 'a':
+            href = tag.get('href')
+            if href is None:
+                return
+            if any(host in href for host in AUDIO_HOSTS):
+                self.audio_links.append(href)
+            href = href.lower()
+            if href.endswith(IMAGE_FORMATS):
+                self.image_anchors.append(f"{self.base_url}{href}" if href.startswith('/') else href)
+        elif tag.name == 'img':
+            src = tag.get('src')
+            if src is not None and not has_class(tag, 'smilie') and src.lower().endswith(IMAGE_FORMATS):
+                self.images.append(f"{self.base_url}{src}" if src.startswith('/') else src)
+
+    def _walk(self, node, parts, quotes, spoilers):
+        """
+        Обход потомков node. parts - список для текста или None, если
+        в этой части дерева нужны только ссылки.
+        """
+        for child in node.children:
+            if isinstance(child, NavigableString):
+                if parts is not None and type(child) in TEXT_STRING_TYPES:
+                    text = child.strip()
+                    if text:
+                        parts.append(text)
+                continue
+
+            self._collect_links(child)
+
+            target = self.targets.pop(id(child), None)
+            if target is not None:
+                self._walk(child, *target)
+                continue
+            if parts is None:
+                self._walk(child, None, False, False)
+                continue
+
+            if child.name == 'img' and has_class(child, 'smilie'):
+                alt = child.get('alt', '').strip()
+                if alt:
+                    parts.append(alt)
+                continue
+            if child.name == 'div' and has_class(child, 'bbCodeBlock-expandLink'):
+                self._walk(child, None, False, False)
+                continue
+            if quotes and child.name == 'blockquote' and has_class(child, 'bbCodeBlock--quote'):
+                marker = self._quote(child)
+                if marker is not None:
+                    parts.append(marker)
+                    continue
+            if spoilers and child.name == 'div' and has_class(child, 'bbCodeSpoiler'):
+                marker = self._spoiler(child)
+                if marker is not None:
+                    parts.append(marker)
+                    continue
+            self._walk(child, parts, quotes, spoilers)
+
+    def _block_text(self, block, content, quotes):
+        """Текст content внутри block; остальная часть block обходится только ради ссылок"""
+        inner = []
+        self.targets[id(content)] = (inner, quotes, False)
+        self._walk(block, None, False, False)
+        self.targets.pop(id(content), None)
+        return ''.join(inner)
+
+    def _quote(self, quote):
+        content = quote.find('div', class_='bbCodeBlock-expandContent') or quote.find('div', class_='bbCodeBlock-content')
+        if not content:
+            return None
+        title = quote.find('div', class_='bbCodeBlock-title')
+        author = title.get_text(strip=True) if title else None
+        text = self._block_text(quote, content, quotes=False)
+        return f'[QUOTE={author}]{text}[/QUOTE]' if author else f'[QUOTE]{text}[/QUOTE]'
+
+    def _spoiler(self, spoiler):
+        content = spoiler.find('div', class_='bbCodeSpoiler-content')
+        if not content:
+            return None
+        title_span = spoiler.find('span', class_='bbCodeSpoiler-button-title')
+        title = title_span.get_text(strip=True) if title_span else ''
+        text = self._block_text(spoiler, content, quotes=True)
+        return f'[SPOILER={title}]{text}[/SPOILER]' if title else f'[SPOILER]{text}[/SPOILER]'
+
+def extract_post(post, base_url=DEFAULT_BASE_URL):
+    """
+    Извлечение сообщения из блока div.message-inner за один обход.
+
+    Возвращает:
+        dict: {'id', 'author', 'content', 'audio_links', 'image_links'}
+    """
+    user_tag = post.find('a', class_='username')
+    user = user_tag.text.strip() if user_tag else "Неизвестный пользователь"
+
+    message_content = post.find('div', class_='message-content')
+    walker = PostWalker(base_url)
+    if message_content:
+        message = walker.text(message_content)
+        # Ссылки добавляются в конец текста, чтобы модель знала, чьи это файлы
+        if walker.audio_links:
+            message += "\n[Аудио от " + user + ": " + ", ".join(walker.audio_links) + "]"
+        if walker.image_links:
+            message += "\n[Изображения от " + user + ": " + ", ".join(walker.image_links) + "]"
+    else:
+        message = "Нет содержания."
+
+    return {
+        'id': find_post_id(post),
+        'author': user,
+        'content': message,
+        'audio_links': walker.audio_links,
+        'image_links': walker.image_links
+    }
+
+def extract_posts(soup, base_url=DEFAULT_BASE_URL):
+    """
+    Извлечение всех сообщений со страницы треда.
+
+    Сообщения берутся только из блоков message--post: на странице, загруженной
+    с авторизацией, форма быстрого ответа (message--quickReply) содержит
+    собственный div.message-inner, который сообщением не является.
+    """
+    posts = []
+    for article in soup.find_all(class_='message--post'):
+        post = article.find('div', class_='message-inner') or article
+        posts.append(extract_post(post, base_url))
+    return posts
@@ -0,0 +1,174 @@
+import os
+import json
+import shutil
+import logging
+import threading
+
+from memory_updater import merge_memory
+from asset_cache import AssetCache
+from memory_slicer import MemoryIndex, dumps
+from token_budget import format_breakdown
+
+logger = logging.getLogger(__name__)
+
+def format_message(message, last=False):
+    """Сообщение треда в запросе; последнее отмечается меткой [LAST MESSAGE]"""
+    suffix = " [LAST MESSAGE]" if last else ""
+    return f"**{message['author']}:** {message['content']}{suffix}\n\n"
+
+def format_thread(thread_data, memory_content):
+    """
+    Текст треда в формате Markdown с памятью бота в начале (прежнее
+    содержимое thread_output.txt).
+
+    Формат:
+    # Memory:
+    (память бота)
+
+    # Title:
+    **Заголовок треда**
+
+    # Creator:
+    *Создатель треда*
+
+    # Messages:
+    **Автор:** Сообщение
+    ...
+    """
+    parts = [
+        f"# Memory:\n{memory_content}\n\n",
+        f"# Title:\n**{thread_data['title']}**\n\n",
+        f"# Creator:\n*{thread_data['creator']}*\n\n",
+        "# Messages:\n",
+    ]
+    messages = thread_data['messages']
+    for i, message in enumerate(messages):
+        parts.append(format_message(message, i == len(messages) - 1))
+    return ''.join(parts)
+
+class PromptBuilder:
+    """
+    Сборка запроса к модели в памяти.
+
+    add_info.txt и updated_memory.json берутся из AssetCache и перечитываются
+    только при изменении файла (например, после сохранения в GUI). Память
+    обновляется в памяти процесса (merge_memory) и сохраняется в файл
+    атомарно, поэтому несколько тредов могут обрабатываться одновременно.
+    """
+    def __init__(self, add_info_path="add_info.txt", memory_path="updated_memory.json", backup_path="old_memory.json", assets=None, slicer=None, budget=None):
+        """
+        Параметры:
+            add_info_path (str): Файл с инструкциями для модели
+            memory_path (str): Файл памяти бота
+            backup_path (str): Копия памяти до последнего обновления
+            assets (AssetCache): Кэш файлов. По умолчанию создаётся собственный
+            slicer (MemorySlicer): Выбор разделов памяти для треда. None - в запрос
+                попадает вся память
+            budget (PromptBudget): Подгонка запроса под бюджет токенов (опционально)
+        """
+        self.add_info_path = add_info_path
+        self.memory_path = memory_path
+        self.backup_path = backup_path
+        self.assets = assets or AssetCache()
+        self.slicer = slicer
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    def add_info(self):
+        """Содержимое add_info.txt ("" если файл не читается)"""
+        add_info = self.assets.get(self.add_info_path)
+        if add_info is None:
+            logger.error(f"Не удалось прочитать {self.add_info_path}")
+            return ""
+        return add_info
+
+    def memory_text(self):
+        """Текст памяти в том виде, в котором он вставляется в запрос"""
+        memory_content = self.assets.get(self.memory_path)
+        if memory_content is None:
+            logger.error(f"Файл памяти не найден: {self.memory_path}")
+            return "Файл памяти не найден."
+        return memory_content
+
+    def static_prefix(self):
+        """Неизменная для всех тредов начальная часть запроса (см. ContextCache)"""
+        return f"{self.add_info()}\n\n"
+
+    def memory_index(self):
+        """MemoryIndex текущей версии памяти (строится один раз на версию файла) или None"""
+        def build_index(text):
+            try:
+                return MemoryIndex(json.loads(text))
+            except (json.JSONDecodeError, AttributeError) as e:
+                logger.error(f"Файл памяти {self.memory_path} содержит некорректный JSON: {e}")
+                return None
+        return self.assets.derived(self.memory_path, 'memory_index', build_index)
+
+    def thread_memory(self, thread_data, token_budget=None):
+        """Память для запроса по треду: разделы, выбранные slicer (в пределах token_budget), или вся память"""
+        if self.slicer is None:
+            return self.memory_text()
+        index = self.memory_index()
+        if index is None:
+            return self.memory_text()
+        return dumps(self.slicer.slice(index, thread_data, token_budget))
+
+    def thread_output(self, thread_data):
+        """Тред с памятью бота (содержимое thread_output.txt)"""
+        return format_thread(thread_data, self.thread_memory(thread_data))
+
+    def build(self, thread_data, media_parts=()):
+        """
+        Текстовая часть запроса к модели. Если задан budget, старые сообщения
+        и память сокращаются так, чтобы запрос вместе с media_parts поместился
+        в бюджет токенов, а размеры частей запроса записываются в журнал.
+
+        Параметры:
+            thread_data (dict): Результат parse_thread
+            media_parts (list): Медиачасть запроса из prepare_media
+
+        Возвращает:
+            tuple: (запрос: add_info и thread_output, thread_output для просмотра в GUI)
+        """
+        prefix = self.static_prefix()
+        add_info = prefix[:-2]
+        if self.budget is None:
+            thread_output = self.thread_output(thread_data)
+        else:
+            memory_budget = self.slicer.token_budget if self.slicer else None
+            last = thread_data['messages'][-1] if thread_data['messages'] else None
+            thread_data, memory, breakdown = self.budget.fit(
+                add_info, thread_data, media_parts, self.thread_memory, memory_budget,
+                lambda message: format_message(message, message is last))
+            logger.info(f"Размер запроса: {format_breakdown(breakdown)}")
+            thread_output = format_thread(thread_data, memory)
+        return f"{prefix}{thread_output}", thread_output
+
+    def update_memory(self, new_data):
+        """
+        Объединение памяти с ответом модели и сохранение в memory_path
+        (предыдущая версия сохраняется в backup_path).
+
+        Возвращает:
+            str: Сообщение из ответа модели или None
+        """
+        with self.lock:
+            try:
+                memory = json.loads(self.assets.get(self.memory_path) or '{}')
+            except json.JSONDecodeError as e:
+                logger.error(f"Файл памяти {self.memory_path} содержит некорректный JSON: {e}")
+                memory = {}
+            memory, message = merge_memory(memory, new_data)
+            tmp_path = f"{self.memory_path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(memory, f, ensure_ascii=False, indent=2)
+                # Файл памяти не удаляется до замены: задачи, читающие его
+                # одновременно, получают предыдущую или новую версию
+                if os.path.exists(self.memory_path):
+                    shutil.copy2(self.memory_path, self.backup_path)
+                os.replace(tmp_path, self.memory_path)
+            except OSError as e:
+                logger.error(f"Ошибка при сохранении памяти в {self.memory_path}: {e}")
+            self.assets.invalidate(self.memory_path)
+            return message
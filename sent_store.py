@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+
+class SentMessageStore:
+    """
+    Журнал отправленных ответов в формате JSON Lines.
+
+    Каждый ответ дописывается в конец файла одной строкой
+    {"ts": время, "thread_id": ID треда, "message": текст}, файл целиком не
+    перезаписывается. При запуске файл читается с конца до первой записи старше
+    retention_days, поэтому загрузка зависит только от объёма недавней истории.
+    Когда в файле накапливается больше устаревших строк, чем актуальных,
+    он сжимается: остаются только записи за retention_days (не больше max_entries).
+    """
+    def __init__(self, path="sent_messages.jsonl", legacy_path="sent_messages.json",
+                 retention_days=90, max_entries=5000, global_window_days=7):
+        """
+        Параметры:
+            path (str): Файл журнала
+            legacy_path (str): Старый sent_messages.json, переносится в журнал при первом запуске
+            retention_days (int): Сколько дней хранятся отправленные ответы
+            max_entries (int): Максимальное количество хранимых ответов
+            global_window_days (int): За сколько дней ответы в других тредах
+                учитываются при проверке на дубликаты
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.retention_days = retention_days
+        self.max_entries = max_entries
+        self.global_window_days = global_window_days
+        self.lock = threading.Lock()
+        self.entries = None
+        self.file_lines = 0
+        self.on_compact = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self._migrate_legacy()
+        self.entries = deque()
+        self.file_lines = 0
+        if not os.path.exists(self.path):
+            return
+        cutoff = time.time() - self.retention_days * DAY
+        expired = False
+        try:
+            for line in self._read_backwards():
+                self.file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная строка после аварийного завершения
+                    continue
+                if entry.get('ts', 0) < cutoff or len(self.entries) >= self.max_entries:
+                    # Дальше в файле только более старые записи
+                    expired = True
+                    break
+                self.entries.appendleft(entry)
+        except OSError as e:
+            logger.error(f"Ошибка при чтении журнала отправленных сообщений: {e}")
+        logger.debug(f"Загружено отправленных сообщений: {len(self.entries)}")
+        if expired:
+            self._compact()
+        else:
+            self._terminate_last_line()
+
+    def _terminate_last_line(self):
+        """Завершение недописанной последней строки, чтобы следующая запись начиналась с новой строки"""
+        try:
+            with open(self.path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        except OSError as e:
+            logger.error(f"Ошибка при чтении журнала отправленных сообщений: {e}")
+
+    def _read_backwards(self, chunk_size=65536):
+        """Строки файла журнала от последней к первой"""
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                read_size = min(chunk_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b'\n')
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line.decode('utf-8', errors='replace')
+            if remainder.strip():
+                yield remainder.decode('utf-8', errors='replace')
+
+    def _migrate_legacy(self):
+        """Перенос списка из sent_messages.json в журнал (время отправки - время изменения файла)"""
+        if os.path.exists(self.path) or not self.legacy_path or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+            timestamp = os.path.getmtime(self.legacy_path)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Не удалось перенести {self.legacy_path}: {e}")
+            return
+        self._write([{'ts': timestamp, 'thread_id': None, 'message': message}
+                     for message in messages[-self.max_entries:] if message])
+        os.replace(self.legacy_path, f"{self.legacy_path}.bak")
+        logger.info(f"Важное: {len(messages)} отправленных сообщений перенесено из {self.legacy_path} в {self.path}")
+
+    def _write(self, entries):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def append(self, thread_id, message):
+        """Запись отправленного ответа в конец журнала"""
+        entry = {'ts': time.time(), 'thread_id': str(thread_id) if thread_id is not None else None, 'message': message}
+        with self.lock:
+            self._load()
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.error(f"Ошибка при сохранении отправленного сообщения: {e}")
+            self.entries.append(entry)
+            self.file_lines += 1
+            self._expire()
+            if self.file_lines > 2 * max(len(self.entries), 100):
+                self._compact()
+
+    def _expire(self):
+        cutoff = time.time() - self.retention_days * DAY
+        while self.entries and (self.entries[0]['ts'] < cutoff or len(self.entries) > self.max_entries):
+            self.entries.popleft()
+
+    def _compact(self):
+        """Перезапись журнала только с актуальными записями"""
+        try:
+            self._write(self.entries)
+        except OSError as e:
+            logger.error(f"Ошибка при сжатии журнала отправленных сообщений: {e}")
+            return
+        logger.info(f"Журнал отправленных сообщений сжат, осталось записей: {len(self.entries)}")
+        self.file_lines = len(self.entries)
+        if self.on_compact:
+            self.on_compact([entry['message'] for entry in self.entries])
+
+    def compact(self):
+        with self.lock:
+            self._load()
+            self._expire()
+            self._compact()
+
+    def relevant(self, thread_id=None):
+        """
+        Ответы, с которыми сравнивается новый ответ в треде thread_id: все
+        хранимые ответы в этом треде и ответы в остальных тредах за
+        global_window_days.
+
+        Возвращает:
+            list: Тексты ответов
+        """
+        thread_id = str(thread_id) if thread_id is not None else None
+        with self.lock:
+            self._load()
+            self._expire()
+            cutoff = time.time() - self.global_window_days * DAY
+            return [entry['message'] for entry in self.entries
+                    if entry['ts'] >= cutoff or (thread_id is not None and entry['thread_id'] == thread_id)]
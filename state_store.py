@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Поля состояния треда, которые можно изменять через update
+STATE_FIELDS = ('last_post_id', 'fingerprint', 'page_count', 'last_reply_at', 'handled_at')
+
+class ThreadStateStore:
+    """
+    Состояние тредов в SQLite (WAL).
+
+    Для каждого треда хранится ID последнего обработанного сообщения и время
+    его обработки, отпечаток активности из списка тредов, количество страниц
+    и время последнего ответа бота. Каждое изменение сразу фиксируется отдельной
+    транзакцией, поэтому после аварийного завершения теряется не больше
+    состояния одного треда. Чтение выполняется из копии в памяти.
+    """
+    def __init__(self, db_path="bot_state.db", legacy_path=None):
+        """
+        Параметры:
+            db_path (str): Файл базы данных состояния
+            legacy_path (str): Старый last_id.json, переносится в базу при первом запуске
+        """
+        self.db_path = db_path
+        self.legacy_path = legacy_path
+        self.lock = threading.Lock()
+        self.states = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _load(self):
+        if self.states is not None:
+            return
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS thread_state (
+                    thread_id TEXT PRIMARY KEY,
+                    last_post_id TEXT,
+                    fingerprint TEXT,
+                    page_count INTEGER,
+                    last_reply_at REAL,
+                    handled_at REAL,
+                    updated_at REAL NOT NULL
+                )""")
+            columns = {row['name'] for row in connection.execute("PRAGMA table_info(thread_state)")}
+            if 'handled_at' not in columns:
+                # База без handled_at: тред считался обработанным, если сохранён ID сообщения
+                connection.execute("ALTER TABLE thread_state ADD COLUMN handled_at REAL")
+                connection.execute("UPDATE thread_state SET handled_at = updated_at WHERE last_post_id IS NOT NULL")
+            connection.commit()
+            rows = connection.execute("SELECT * FROM thread_state").fetchall()
+            self.states = {row['thread_id']: {field: row[field] for field in STATE_FIELDS} for row in rows}
+            if not self.states:
+                self._migrate_legacy(connection)
+        finally:
+            connection.close()
+        logger.debug(f"Загружено состояние тредов: {len(self.states)}")
+
+    def _migrate_legacy(self, connection):
+        """Перенос last_id.json (ID последних сообщений и '_fingerprints') в базу"""
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Не удалось перенести состояние из {self.legacy_path}: {e}")
+            return
+        if not isinstance(data, dict):
+            logger.warning(f"Файл состояния {self.legacy_path} имеет неверный формат и не перенесён")
+            return
+        fingerprints = data.pop('_fingerprints', {})
+        now = time.time()
+        for thread_id, last_post_id in data.items():
+            self.states[thread_id] = {'last_post_id': last_post_id, 'fingerprint': fingerprints.get(thread_id),
+                                      'page_count': None, 'last_reply_at': None, 'handled_at': now}
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO thread_state (thread_id, last_post_id, fingerprint, handled_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(thread_id, state['last_post_id'], state['fingerprint'], now, now) for thread_id, state in self.states.items()])
+        os.replace(self.legacy_path, f"{self.legacy_path}.bak")
+        logger.info(f"Важное: Состояние {len(self.states)} тредов перенесено из {self.legacy_path} в {self.db_path}")
+
+    def get(self, thread_id):
+        """
+        Состояние треда.
+
+        Возвращает:
+            dict: Поля STATE_FIELDS или None, если тред ещё не обрабатывался
+        """
+        with self.lock:
+            self._load()
+            state = self.states.get(str(thread_id))
+            return dict(state) if state else None
+
+    def last_ids(self):
+        """
+        ID последних обработанных сообщений по тредам (формат прежнего last_id.json).
+
+        Возвращает:
+            dict: {thread_id: last_post_id} для обработанных тредов. ID может быть
+                None, если его не удалось извлечь со страницы: такой тред, как и
+                в last_id.json, считается известным
+        """
+        with self.lock:
+            self._load()
+            return {thread_id: state['last_post_id'] for thread_id, state in self.states.items()
+                    if state['handled_at'] is not None}
+
+    def update(self, thread_id, **fields):
+        """
+        Изменение и немедленное сохранение состояния треда.
+
+        Параметры:
+            thread_id: ID треда
+            **fields: Новые значения полей из STATE_FIELDS
+        """
+        unknown = set(fields) - set(STATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля состояния треда: {', '.join(sorted(unknown))}")
+        thread_id = str(thread_id)
+        with self.lock:
+            self._load()
+            state = self.states.get(thread_id) or dict.fromkeys(STATE_FIELDS)
+            state = dict(state, **fields)
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute(
+                        "INSERT INTO thread_state (thread_id, last_post_id, fingerprint, page_count, last_reply_at, handled_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (thread_id) DO UPDATE SET "
+                        "last_post_id = excluded.last_post_id, fingerprint = excluded.fingerprint, page_count = excluded.page_count, "
+                        "last_reply_at = excluded.last_reply_at, handled_at = excluded.handled_at, updated_at = excluded.updated_at",
+                        (thread_id, state['last_post_id'], state['fingerprint'], state['page_count'], state['last_reply_at'],
+                         state['handled_at'], time.time()))
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при сохранении состояния треда {thread_id}: {e}")
+                return
+            finally:
+                connection.close()
+            self.states[thread_id] = state
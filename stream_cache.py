@@ -0,0 +1,85 @@
+import time
+import logging
+import threading
+
+from media_cache import normalize_media_url
+from expiring_json import load_entries, save_entries
+
+logger = logging.getLogger(__name__)
+
+class StreamUrlCache:
+    """
+    Постоянный кэш разрешённых адресов аудиопотоков.
+
+    Хранит соответствие ссылки (Smule, Vocaroo) и адреса потока в течение ttl
+    секунд, а ссылки, признанные недоступными, - в течение negative_ttl секунд,
+    чтобы не повторять для них разрешение и скачивание в каждом цикле.
+    """
+    def __init__(self, cache_path="stream_cache.json", ttl=6 * 3600, negative_ttl=24 * 3600):
+        """
+        Параметры:
+            cache_path (str): Файл для сохранения кэша
+            ttl (int): Время жизни найденного адреса потока в секундах
+            negative_ttl (int): Время, в течение которого ссылка считается недоступной
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = load_entries(self.cache_path, "Кэш адресов потоков")
+
+    def _save(self):
+        self.entries = save_entries(self.cache_path, self.entries)
+
+    def _entry(self, url):
+        self._load()
+        entry = self.entries.get(normalize_media_url(url))
+        if entry and entry['expires_at'] > time.time():
+            return entry
+        return None
+
+    def get(self, url):
+        """Адрес потока для ссылки или None"""
+        with self.lock:
+            entry = self._entry(url)
+            return entry['stream_url'] if entry and not entry['dead'] else None
+
+    def is_dead(self, url):
+        """Признана ли ссылка недоступной"""
+        with self.lock:
+            entry = self._entry(url)
+            return bool(entry and entry['dead'])
+
+    def put(self, url, stream_url):
+        """Сохранение найденного адреса потока"""
+        with self.lock:
+            self._load()
+            self.entries[normalize_media_url(url)] = {
+                'stream_url': stream_url,
+                'dead': False,
+                'expires_at': time.time() + self.ttl
+            }
+            self._save()
+
+    def mark_dead(self, url):
+        """Отметка ссылки как недоступной на negative_ttl секунд"""
+        logger.info(f"Ссылка {url} отмечена как недоступная на {self.negative_ttl} сек.")
+        with self.lock:
+            self._load()
+            self.entries[normalize_media_url(url)] = {
+                'stream_url': None,
+                'dead': True,
+                'expires_at': time.time() + self.negative_ttl
+            }
+            self._save()
+
+    def invalidate(self, url):
+        """Удаление записи (например, если адрес потока перестал работать)"""
+        with self.lock:
+            self._load()
+            if self.entries.pop(normalize_media_url(url), None):
+                self._save()
@@ -0,0 +1,146 @@
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from bot import detect_new_message, apply_detection, mark_thread_handled, process_new_message, is_thread_unchanged, thread_state
+from async_scraper import ASYNC_AVAILABLE, AsyncScraper
+
+logger = logging.getLogger(__name__)
+
+class ThreadScheduler:
+    """
+    Параллельная проверка тредов.
+
+    Загрузка и разбор тредов выполняются в пуле fetch_workers потоков, обработка
+    новых сообщений (медиа, запрос к модели, отправка ответа) - в отдельном,
+    меньшем пуле process_workers. Для каждого треда одновременно выполняется
+    не более одной задачи: пока ответ в тред готовится, тред не проверяется повторно.
+
+    Если включен async_fetch и установлен aiohttp, все треды цикла загружаются
+    одновременно в одном цикле событий (см. async_scraper.AsyncScraper, цикл
+    событий и HTTP-сессия живут до shutdown), а пул fetch_workers не используется.
+
+    Результат проверки каждого треда сразу сохраняется в bot.thread_state,
+    новое сообщение отмечается обработанным после постановки ответа в очередь.
+    """
+    def __init__(self, bot_config):
+        """
+        Параметры:
+            bot_config (BotConfig): Конфигурация бота (fetch_workers, process_workers)
+        """
+        self.bot_config = bot_config
+        self.fetch_pool = ThreadPoolExecutor(max_workers=bot_config.fetch_workers, thread_name_prefix='fetch')
+        self.process_pool = ThreadPoolExecutor(max_workers=bot_config.process_workers, thread_name_prefix='process')
+        self.active_lock = threading.Lock()
+        self.active_threads = set()
+        self.async_scraper = None
+        if bot_config.async_fetch and ASYNC_AVAILABLE:
+            self.async_scraper = AsyncScraper(bot_config.async_connections, bot_config.async_per_host)
+
+    def run_cycle(self, threads, should_stop=None):
+        """
+        Проверка тредов из list_threads. Возвращает после завершения этапа
+        загрузки; обработка найденных сообщений продолжается в фоне.
+
+        Параметры:
+            threads (list): Записи тредов из list_threads
+            should_stop (callable): Возвращает True, если новые задачи запускать не нужно
+
+        Возвращает:
+            list: URL проверенных тредов
+        """
+        if self.async_scraper is not None:
+            return self._run_async_cycle(threads, should_stop)
+
+        futures = []
+        for thread in threads:
+            if is_thread_unchanged(thread):
+                continue
+            if not self._acquire(thread['thread_id']):
+                logger.debug(f"Тред {thread['url']} ещё обрабатывается, пропуск")
+                continue
+            futures.append(self.fetch_pool.submit(self._check_thread, thread, should_stop))
+        wait(futures)
+        return [future.result() for future in futures if future.result()]
+
+    def _run_async_cycle(self, threads, should_stop):
+        if should_stop and should_stop():
+            return []
+        acquired = []
+        for thread in threads:
+            if is_thread_unchanged(thread):
+                continue
+            if not self._acquire(thread['thread_id']):
+                logger.debug(f"Тред {thread['url']} ещё обрабатывается, пропуск")
+                continue
+            acquired.append(thread)
+        if not acquired:
+            return []
+
+        checked = []
+        try:
+            results = self.async_scraper.detect_new_messages(acquired, thread_state.last_ids(), self.bot_config, should_stop)
+        except Exception as e:
+            logger.error(f"Ошибка при асинхронной проверке тредов: {e}")
+            logger.error(traceback.format_exc())
+            results = []
+        handed_off = set()
+        for thread, detection in results:
+            checked.append(thread['url'])
+            if not detection:
+                continue
+            apply_detection(detection, thread)
+            if detection['is_new']:
+                self.process_pool.submit(self._process, detection, thread)
+                handed_off.add(thread['thread_id'])
+        for thread in acquired:
+            if thread['thread_id'] not in handed_off:
+                self._release(thread['thread_id'])
+        return checked
+
+    def shutdown(self, wait_for_jobs=False):
+        """Остановка пулов и асинхронной загрузки. Задачи, ещё не начатые, отменяются"""
+        self.fetch_pool.shutdown(wait=wait_for_jobs, cancel_futures=True)
+        self.process_pool.shutdown(wait=wait_for_jobs, cancel_futures=True)
+        if self.async_scraper is not None:
+            self.async_scraper.close()
+
+    def _acquire(self, thread_id):
+        with self.active_lock:
+            if thread_id in self.active_threads:
+                return False
+            self.active_threads.add(thread_id)
+            return True
+
+    def _release(self, thread_id):
+        with self.active_lock:
+            self.active_threads.discard(thread_id)
+
+    def _check_thread(self, thread, should_stop):
+        thread_id = thread['thread_id']
+        handed_off = False
+        try:
+            if should_stop and should_stop():
+                return None
+            detection = detect_new_message(thread['url'], thread_state.last_ids(), self.bot_config, thread)
+            if detection:
+                apply_detection(detection, thread)
+                if detection['is_new']:
+                    self.process_pool.submit(self._process, detection, thread)
+                    handed_off = True
+            return thread['url']
+        except Exception as e:
+            logger.error(f"Ошибка при проверке треда {thread['url']}: {e}")
+            logger.error(traceback.format_exc())
+            return None
+        finally:
+            if not handed_off:
+                self._release(thread_id)
+
+    def _process(self, detection, thread):
+        try:
+            if process_new_message(detection['thread_id'], detection['thread_data'], self.bot_config):
+                mark_thread_handled(detection, thread)
+        finally:
+            self._release(detection['thread_id'])
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from memory_slicer import approx_tokens
+
+logger = logging.getLogger(__name__)
+
+# Оценка для медиафайлов без count_tokens: изображение - 258 токенов,
+# аудио - 32 токена в секунду (~16 КБ mp3 128 кбит/с в секунду)
+IMAGE_TOKENS = 258
+AUDIO_TOKENS_PER_BYTE = 32 / 16000
+
+def estimate_part_tokens(part):
+    """Локальная оценка размера части запроса (строка или загруженный файл Gemini)"""
+    if isinstance(part, str):
+        return approx_tokens(part)
+    mime_type = getattr(part, 'mime_type', '') or ''
+    if mime_type.startswith('image/'):
+        return IMAGE_TOKENS
+    return int((getattr(part, 'size_bytes', 0) or 0) * AUDIO_TOKENS_PER_BYTE) + 1
+
+class TokenCounter:
+    """
+    Подсчёт токенов частей запроса с кэшем.
+
+    Если задана функция exact (например, model.count_tokens), она вызывается
+    один раз для каждого медиафайла и для текстов длиннее exact_min_chars
+    (add_info, память); результат кэшируется по SHA-1 текста или имени файла.
+    Короткие тексты и части, для которых exact недоступна или вернула
+    ошибку, оцениваются локально.
+    """
+    def __init__(self, exact=None, exact_min_chars=2000, max_entries=4096):
+        """
+        Параметры:
+            exact (callable): Точный подсчёт: exact(часть) -> int (опционально)
+            exact_min_chars (int): Минимальная длина текста для точного подсчёта
+            max_entries (int): Размер кэша
+        """
+        self.exact = exact
+        self.exact_min_chars = exact_min_chars
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    def count(self, part):
+        """Количество токенов части запроса"""
+        if isinstance(part, str):
+            if self.exact is None or len(part) < self.exact_min_chars:
+                return approx_tokens(part)
+            key = 'text:' + hashlib.sha1(part.encode('utf-8')).hexdigest()
+        else:
+            if self.exact is None or not getattr(part, 'name', None):
+                return estimate_part_tokens(part)
+            key = 'file:' + part.name
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        try:
+            tokens = self.exact(part)
+        except Exception as e:
+            logger.warning(f"Не удалось подсчитать токены через API, используется оценка: {e}")
+            return estimate_part_tokens(part)
+        with self.lock:
+            self.cache[key] = tokens
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return tokens
+
+class PromptBudget:
+    """
+    Подгонка запроса к модели под бюджет токенов.
+
+    add_info, заголовок треда и медиафайлы не сокращаются. Если запрос не
+    помещается в max_tokens - reserve_tokens, сначала отбрасываются самые
+    старые сообщения треда (последнее остаётся всегда), затем уменьшается
+    бюджет памяти, и MemorySlicer отбрасывает разделы с наименьшим приоритетом.
+    """
+    def __init__(self, counter, max_tokens=100000, reserve_tokens=2048):
+        """
+        Параметры:
+            counter (TokenCounter): Подсчёт токенов
+            max_tokens (int): Максимальный размер запроса вместе с ответом
+            reserve_tokens (int): Токены, оставляемые для ответа модели
+        """
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.reserve_tokens = reserve_tokens
+
+    def fit(self, add_info, thread_data, media_parts, memory_for, memory_budget=None, format_message=str):
+        """
+        Сокращение треда и памяти под бюджет.
+
+        Параметры:
+            add_info (str): Инструкции для модели
+            thread_data (dict): Результат parse_thread
+            media_parts (list): Медиачасть запроса (подписи и файлы)
+            memory_for (callable): memory_for(thread_data, token_budget) -> текст памяти
+            memory_budget (int): Бюджет памяти по умолчанию (None - память не сокращается)
+            format_message (callable): Текст сообщения в том виде, в котором он попадает в запрос
+
+        Возвращает:
+            tuple: (сокращённый thread_data, текст памяти, dict размеров частей запроса)
+        """
+        available = self.max_tokens - self.reserve_tokens
+        add_info_tokens = self.counter.count(add_info)
+        media_tokens = sum(self.counter.count(part) for part in media_parts)
+        header_tokens = self.counter.count(f"{thread_data['title']} {thread_data['creator']}")
+        messages = list(thread_data['messages'])
+        message_tokens = [self.counter.count(format_message(message)) for message in messages]
+        memory_tokens = self.counter.count(memory_for(thread_data, memory_budget))
+
+        def total():
+            return add_info_tokens + media_tokens + header_tokens + sum(message_tokens) + memory_tokens
+
+        dropped = 0
+        while total() > available and len(messages) > 1:
+            messages.pop(0)
+            message_tokens.pop(0)
+            dropped += 1
+        if dropped:
+            thread_data = dict(thread_data, messages=messages)
+            logger.warning(f"Важное: Запрос не помещается в бюджет {available} токенов, отброшено старых сообщений: {dropped}")
+
+        memory = memory_for(thread_data, memory_budget)
+        memory_tokens = self.counter.count(memory)
+        # Бюджет памяти задаётся в единицах MemorySlicer (approx_tokens), а memory_tokens
+        # может быть точным подсчётом, поэтому превышение пересчитывается в единицы slicer.
+        # Если память не уменьшилась (разделы включаются целиком), шаг удваивается
+        memory_budget_used = memory_budget
+        step = 0
+        while memory_budget_used and total() > available:
+            memory_units = approx_tokens(memory)
+            overflow = -(-(total() - available) * memory_units // max(memory_tokens, 1))
+            step = max(overflow, step * 2)
+            memory_budget_used = max(0, min(memory_budget_used, memory_units) - step)
+            reduced = memory_for(thread_data, memory_budget_used)
+            if reduced != memory:
+                step = 0
+            memory = reduced
+            memory_tokens = self.counter.count(memory)
+        if memory_budget_used != memory_budget:
+            logger.warning(f"Важное: Бюджет памяти уменьшен до {memory_budget_used} токенов")
+        if total() > available:
+            logger.warning(f"Важное: Запрос (~{total()} токенов) превышает бюджет {available} токенов")
+
+        breakdown = {
+            'add_info': add_info_tokens,
+            'memory': memory_tokens,
+            'thread': header_tokens + sum(message_tokens),
+            'messages': len(messages),
+            'dropped_messages': dropped,
+            'media': media_tokens,
+            'media_parts': sum(1 for part in media_parts if not isinstance(part, str)),
+            'total': total(),
+            'budget': available,
+        }
+        return thread_data, memory, breakdown
+
+def format_breakdown(breakdown):
+    """Строка с размерами частей запроса для журнала"""
+    return (f"~{breakdown['total']} из {breakdown['budget']} токенов: add_info {breakdown['add_info']}, "
+            f"память {breakdown['memory']}, тред {breakdown['thread']} ({breakdown['messages']} сообщ., "
+            f"отброшено {breakdown['dropped_messages']}), медиа {breakdown['media']} ({breakdown['media_parts']} файлов)")
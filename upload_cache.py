@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+
+from expiring_json import load_entries, save_entries
+
+logger = logging.getLogger(__name__)
+
+# Файлы Gemini хранятся 48 часов
+DEFAULT_FILE_TTL = 48 * 3600
+
+def file_sha256(file_path):
+    """SHA-256 содержимого файла"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def api_key_id(api_key):
+    """Короткий идентификатор API ключа (сам ключ в кэш не записывается)"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+class UploadCache:
+    """
+    Кэш загруженных в Gemini файлов.
+
+    Ключ - SHA-256 содержимого и API ключ, значение - имя файла в API, срок
+    действия и локальный путь, с которого файл загружался. Записи сохраняются
+    в JSON-файл, объекты файлов держатся в памяти до истечения срока.
+    """
+    def __init__(self, cache_path="upload_cache.json", expiry_margin=3600):
+        """
+        Параметры:
+            cache_path (str): Файл для сохранения кэша
+            expiry_margin (int): За сколько секунд до истечения срока файл считается устаревшим
+        """
+        self.cache_path = cache_path
+        self.expiry_margin = expiry_margin
+        self.lock = threading.Lock()
+        self.entries = None
+        self.handles = {}
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = load_entries(self.cache_path, "Кэш загруженных файлов")
+
+    def _save(self):
+        self.entries = save_entries(self.cache_path, self.entries)
+
+    def get(self, digest, api_key, fetch_handle):
+        """
+        Объект ранее загруженного файла или None.
+
+        Параметры:
+            digest (str): SHA-256 содержимого файла
+            api_key (str): API ключ, с которым выполняется запрос
+            fetch_handle (callable): Получение объекта файла по имени (genai.get_file)
+        """
+        key = f"{api_key_id(api_key)}:{digest}"
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry['expires_at'] - self.expiry_margin <= time.time():
+                logger.debug(f"Срок действия файла {entry['name']} истекает, требуется повторная загрузка")
+                del self.entries[key]
+                self.handles.pop(entry['name'], None)
+                self._save()
+                return None
+            handle = self.handles.get(entry['name'])
+        if handle is not None:
+            return handle
+        try:
+            handle = fetch_handle(entry['name'])
+        except Exception as e:
+            logger.info(f"Файл {entry['name']} недоступен в API, требуется повторная загрузка: {e}")
+            with self.lock:
+                self.entries.pop(key, None)
+                self._save()
+            return None
+        with self.lock:
+            self.handles[entry['name']] = handle
+        return handle
+
+    def put(self, digest, api_key, handle, source_path):
+        """Сохранение загруженного файла в кэше"""
+        expiration = getattr(handle, 'expiration_time', None)
+        expires_at = expiration.timestamp() if expiration else time.time() + DEFAULT_FILE_TTL
+        with self.lock:
+            self._load()
+            self.entries[f"{api_key_id(api_key)}:{digest}"] = {
+                'name': handle.name,
+                'expires_at': expires_at,
+                'source_path': os.path.abspath(source_path)
+            }
+            self.handles[handle.name] = handle
+            self._save()
+
+    def remember_source(self, name, source_path):
+        """Обновление локального пути файла при повторном использовании загрузки"""
+        source_path = os.path.abspath(source_path)
+        with self.lock:
+            self._load()
+            changed = False
+            for entry in self.entries.values():
+                if entry['name'] == name and entry['source_path'] != source_path:
+                    entry['source_path'] = source_path
+                    changed = True
+            if changed:
+                self._save()
+
+    def source_path(self, name):
+        """Локальный путь, с которого загружался файл с данным именем в API, если он ещё существует"""
+        with self.lock:
+            self._load()
+            for entry in self.entries.values():
+                if entry['name'] == name and os.path.exists(entry['source_path']):
+                    return entry['source_path']
+        return None